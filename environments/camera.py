@@ -0,0 +1,142 @@
+"""
+Camera for the PyBullet environments
+"""
+import pkgutil
+
+import numpy as np
+import pybullet as p
+
+RENDERERS = ["tiny", "opengl", "egl"]
+
+# Parameters that can be modified with the debug sliders: (name, (min, max))
+DEBUG_SLIDERS = [("x_slider", (-10, 10)), ("y_slider", (-10, 10)), ("z_slider", (-10, 10)),
+                 ("cam_dist", (0, 10)), ("cam_yaw", (-180, 180)), ("cam_pitch", (-180, 180))]
+
+
+def loadRenderer(name="tiny"):
+    """
+    Select the renderer used by getCameraImage for the current physics client
+    :param name: (str) one of "tiny" (CPU), "opengl" (requires a GUI) or "egl" (headless GPU rendering)
+    :return: (int) the PyBullet renderer flag
+    """
+    assert name in RENDERERS, "Error: unknown renderer {}, choose one of {}".format(name, RENDERERS)
+    if name == "tiny":
+        return p.ER_TINY_RENDERER
+    if name == "egl":
+        egl = pkgutil.get_loader('eglRenderer')
+        assert egl is not None, "Error: the EGL renderer plugin is not available in this PyBullet version"
+        p.loadPlugin(egl.get_filename(), "_eglRendererPlugin")
+    return p.ER_BULLET_HARDWARE_OPENGL
+
+
+class PyBulletCamera(object):
+    """
+    Camera looking at a target position, defined by its distance, yaw, pitch and roll.
+    The view and projection matrices are only recomputed when a parameter of the camera changes.
+    :param target_pos: ((float, float, float)) position the camera is looking at
+    :param distance: (float)
+    :param yaw: (float) in degrees
+    :param pitch: (float) in degrees
+    :param roll: (float) in degrees
+    :param fov: (float) field of view, in degrees
+    :param width: (int) width of the rendered image
+    :param height: (int) height of the rendered image
+    :param renderer: (int) PyBullet renderer flag (see loadRenderer())
+    :param near_val: (float)
+    :param far_val: (float)
+    """
+
+    def __init__(self, target_pos, distance, yaw, pitch, roll=0, fov=60, width=224, height=224,
+                 renderer=p.ER_TINY_RENDERER, near_val=0.1, far_val=100.0):
+        self.target_pos = tuple(target_pos)
+        self.distance = distance
+        self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+        self.fov = fov
+        self.width = width
+        self.height = height
+        self.renderer = renderer
+        self.near_val = near_val
+        self.far_val = far_val
+        self.sliders = None
+        self._view_matrix = None
+        self._proj_matrix = None
+
+    def update(self, target_pos=None, distance=None, yaw=None, pitch=None, roll=None, fov=None):
+        """
+        Update the parameters of the camera, the matrices are invalidated only if a value changed
+        :param target_pos: ((float, float, float))
+        :param distance: (float)
+        :param yaw: (float)
+        :param pitch: (float)
+        :param roll: (float)
+        :param fov: (float)
+        """
+        view_params = {"target_pos": None if target_pos is None else tuple(target_pos),
+                       "distance": distance, "yaw": yaw, "pitch": pitch, "roll": roll}
+        for name, value in view_params.items():
+            if value is not None and getattr(self, name) != value:
+                setattr(self, name, value)
+                self._view_matrix = None
+        if fov is not None and fov != self.fov:
+            self.fov = fov
+            self._proj_matrix = None
+
+    @property
+    def view_matrix(self):
+        if self._view_matrix is None:
+            self._view_matrix = p.computeViewMatrixFromYawPitchRoll(
+                cameraTargetPosition=self.target_pos,
+                distance=self.distance,
+                yaw=self.yaw,
+                pitch=self.pitch,
+                roll=self.roll,
+                upAxisIndex=2)
+        return self._view_matrix
+
+    @property
+    def proj_matrix(self):
+        if self._proj_matrix is None:
+            self._proj_matrix = p.computeProjectionMatrixFOV(
+                fov=self.fov, aspect=float(self.width) / self.height,
+                nearVal=self.near_val, farVal=self.far_val)
+        return self._proj_matrix
+
+    def addDebugSliders(self):
+        """
+        Add debug sliders (GUI mode) for moving the camera
+        """
+        values = list(self.target_pos) + [self.distance, self.yaw, self.pitch]
+        self.sliders = [p.addUserDebugParameter(name, low, high, value)
+                        for (name, (low, high)), value in zip(DEBUG_SLIDERS, values)]
+
+    def readDebugSliders(self):
+        """
+        Update the camera with the values of the debug sliders (if any)
+        """
+        if self.sliders is None:
+            return
+        x, y, z, distance, yaw, pitch = [p.readUserDebugParameter(slider) for slider in self.sliders]
+        self.update(target_pos=(x, y, z), distance=distance, yaw=yaw, pitch=pitch)
+
+    def getImage(self):
+        """
+        :return: (numpy array) RGB image of shape (height, width, 3)
+        """
+        (_, _, px, _, _) = p.getCameraImage(
+            width=self.width, height=self.height, viewMatrix=self.view_matrix,
+            projectionMatrix=self.proj_matrix, renderer=self.renderer)
+        return np.array(px).reshape(self.height, self.width, 4)[:, :, :3]
+
+
+def renderCameras(cameras):
+    """
+    Render the images of several cameras and stack them along the channel axis
+    :param cameras: ([PyBulletCamera])
+    :return: (numpy array) of shape (height, width, 3 * n_cameras)
+    """
+    images = [camera.getImage() for camera in cameras]
+    if len(images) == 1:
+        return images[0]
+    return np.dstack(images)
@@ -160,6 +160,10 @@ class CarRacingEnv(GymCarRacing, SRLGymEnv):
 
         return np.array(self._observation), step_reward, done, {}
 
+    def close(self):
+        GymCarRacing.close(self)
+        SRLGymEnv.close(self)
+
     # Copied for the original Gym Racing Car env, it is modified to be able to remove the render window.
     def render(self, mode='human'):
         if self.viewer is None:
@@ -4,6 +4,9 @@ import shutil
 
 import numpy as np
 
+from state_representation.dataset_index import writeDatasetIndex
+from state_representation.dataset_utils import episodeIndex, relativePositions
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -23,19 +26,15 @@ def main():
     ground_truth_states = ground_truth['ground_truth_states']
     target_position = ground_truth['target_positions']
 
-    episode_num = -1
-    
     print(ground_truth_states.shape)
-    for i in range(ground_truth_states.shape[0]):
-        if episode_starts[i] is True:
-            episode_num += 1
-        ground_truth_states[i, :] = ground_truth_states[i, :] - target_position[episode_num]
+    ground_truth_states = relativePositions(ground_truth_states, target_position, episodeIndex(episode_starts))
     new_ground_truth = {}
     for key in ground_truth.keys():
         if key != 'ground_truth_states':
             new_ground_truth[key] = ground_truth[key]
     new_ground_truth['ground_truth_states'] = ground_truth_states
     np.savez(join(args.data_dst, 'ground_truth.npz'), **new_ground_truth)
+    writeDatasetIndex(args.data_dst)
 
 
 if __name__ == '__main__':
@@ -2,12 +2,91 @@ from __future__ import division, absolute_import, print_function
 
 import glob
 import argparse
+import json
 import os
 import shutil
 
 import numpy as np
 from tqdm import tqdm
 
+from state_representation.dataset_index import writeDatasetIndex
+from state_representation.dataset_utils import episodeIndex
+
+MANIFEST_FILE = "dataset_manifest.json"
+
+
+def virtualMerge(sources, destination):
+    """
+    Merge datasets without moving any frame: the fused npz files reference the frames of the sources
+    (the images paths are relative to the data folder, so the datasets must be in the same folder)
+    and a manifest records the sources with their episode and frame offsets.
+    The sources are kept, see materialize() to get a regular dataset.
+    :param sources: ([str]) paths to the datasets to merge, in order
+    :param destination: (str) path to the virtual dataset
+    """
+    sources = [os.path.normpath(source) for source in sources]
+    destination = os.path.normpath(destination)
+    data_folder = os.path.dirname(destination)
+    for source in sources:
+        assert os.path.exists(source), "Error: dataset '{}' could not be found".format(source)
+        assert os.path.samefile(os.path.dirname(source), data_folder), \
+            "Error: dataset '{}' must be in the same folder as the destination".format(source)
+        assert not os.path.exists(source + "/" + MANIFEST_FILE), \
+            "Error: '{}' is a virtual dataset, materialize it before merging it".format(source)
+    assert not os.path.exists(destination), "Error: dataset '{}' already exists".format(destination)
+    os.mkdir(destination)
+    for config_file in ["dataset_config.json", "env_globals.json"]:
+        shutil.copy(sources[0] + "/" + config_file, destination + "/" + config_file)
+
+    ground_truth_loads = [np.load(source + "/ground_truth.npz") for source in sources]
+    preprocessed_loads = [np.load(source + "/preprocessed_data.npz") for source in sources]
+    n_frames = [len(load["episode_starts"]) for load in preprocessed_loads]
+    n_episodes = [int(np.sum(load["episode_starts"])) for load in preprocessed_loads]
+    manifest = {
+        "sources": [os.path.basename(source) for source in sources],
+        "n_episodes": n_episodes,
+        "n_frames": n_frames,
+        # index of the first episode and first frame of each source in the virtual dataset
+        "episode_offsets": np.cumsum([0] + n_episodes[:-1]).tolist(),
+        "frame_offsets": np.cumsum([0] + n_frames[:-1]).tolist()
+    }
+    with open(destination + "/" + MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f)
+
+    for loads, file_name in [(ground_truth_loads, "ground_truth.npz"), (preprocessed_loads, "preprocessed_data.npz")]:
+        np.savez(destination + "/" + file_name,
+                 **{arr: np.concatenate([load[arr] for load in loads]) for arr in loads[0].files})
+    writeDatasetIndex(destination)
+
+
+def materialize(dataset):
+    """
+    Turn a virtual dataset into a regular one: copy the frames of the sources to renumbered record folders
+    and update the images paths. The sources are not modified.
+    :param dataset: (str) path to the virtual dataset
+    """
+    dataset = os.path.normpath(dataset)
+    data_folder = os.path.dirname(dataset)
+    with open(dataset + "/" + MANIFEST_FILE) as f:
+        manifest = json.load(f)
+
+    for source, episode_offset, n_episodes in zip(manifest["sources"], manifest["episode_offsets"],
+                                                  manifest["n_episodes"]):
+        for episode in tqdm(range(n_episodes), desc="Copy of the frames of " + source):
+            shutil.copytree("{}/{}/record_{:03d}".format(data_folder, source, episode),
+                            "{}/record_{:03d}".format(dataset, episode_offset + episode))
+
+    ground_truth = dict(np.load(dataset + "/ground_truth.npz"))
+    episode_starts = np.load(dataset + "/preprocessed_data.npz")["episode_starts"]
+    episode_index = episodeIndex(episode_starts)
+    record_names = np.array(["{}/record_{:03d}/".format(os.path.basename(dataset), episode)
+                             for episode in range(episode_index[-1] + 1)])
+    frame_names = [path.split("/")[-1] for path in ground_truth["images_path"]]
+    ground_truth["images_path"] = np.char.add(record_names[episode_index], frame_names)
+    np.savez(dataset + "/ground_truth.npz", **ground_truth)
+    os.remove(dataset + "/" + MANIFEST_FILE)
+    writeDatasetIndex(dataset)
+
 
 def main():
     parser = argparse.ArgumentParser(description='Dataset Manipulator: useful to merge two datasets by concatenating '
@@ -17,9 +96,21 @@ def main():
     group.add_argument('--merge', type=str, nargs=3, metavar=('source_1', 'source_2', 'destination'),
                        default=argparse.SUPPRESS,
                        help='Merge two datasets by appending the episodes, deleting sources right after.')
+    group.add_argument('--virtual-merge', type=str, nargs='+', metavar='dataset', default=argparse.SUPPRESS,
+                       help='Merge N datasets (source_1 ... source_N destination) without moving any frame: '
+                            'the destination references the frames of the sources, which are kept.')
+    group.add_argument('--materialize', type=str, metavar='dataset', default=argparse.SUPPRESS,
+                       help='Copy the frames referenced by a virtual dataset, to get a regular dataset.')
 
     args = parser.parse_args()
 
+    if 'virtual_merge' in args:
+        assert len(args.virtual_merge) >= 3, "Error: at least two sources and a destination are needed"
+        virtualMerge(args.virtual_merge[:-1], args.virtual_merge[-1])
+
+    if 'materialize' in args:
+        materialize(args.materialize)
+
     if 'merge' in args:
         # let make sure everything is in order
         assert os.path.exists(args.merge[0]), "Error: dataset '{}' could not be found".format(args.merge[0])
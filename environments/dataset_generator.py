@@ -1,10 +1,13 @@
 from __future__ import division, absolute_import, print_function
 
 import argparse
+import contextlib
 import glob
 import multiprocessing
+import multiprocessing.connection
 import os
 import shutil
+import tempfile
 import time
 
 import numpy as np
@@ -13,108 +16,266 @@ from stable_baselines.common.vec_env import DummyVecEnv, VecNormalize
 from stable_baselines.common.policies import CnnPolicy
 
 from environments import ThreadingType
+from environments.kuka_gym.kuka_button_gym_env import KukaButtonGymEnv
+from environments.mobile_robot.mobile_robot_env import MobileRobotGymEnv
 from environments.registry import registered_env
 from real_robots.constants import USING_OMNIROBOT
+from state_representation.dataset_index import writeDatasetIndex
+from state_representation.dataset_utils import episodeIndex
 from srl_zoo.utils import printRed, printYellow
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # used to remove debug info of tensorflow
+# These environments drive the global PyBullet client of their process (p.connect without physicsClientId):
+# a process can only run one of them
+PYBULLET_ENVS = (KukaButtonGymEnv, MobileRobotGymEnv)
 
 
-def convertImagePath(args, path, record_id_start):
+def nextEpisode(args, episode_counter):
     """
-    Used to convert an image path, from one location, to another
+    Pull the index of the next episode to run, shared by all the processes:
+    a process that is done with its episode takes the next one, so long episodes do not delay the others
     :param args: (ArgumentParser object)
-    :param path: (str)
-    :param record_id_start: (int) where does the current part start counting its records
-    :return:
+    :param episode_counter: (multiprocessing.Value) index of the next episode
+    :return: (int) the episode index, None if all the episodes were taken
     """
-    image_name = path.split("/")[-1]
-    # get record id for output, by adding the current offset with the record_id
-    # of the folder
-    new_record_id = record_id_start + int(path.split("/")[-2].split("_")[-1])
-    return args.name + "/record_{:03d}".format(new_record_id) + "/" + image_name
+    with episode_counter.get_lock():
+        episode_idx = episode_counter.value
+        episode_counter.value += 1
+    return episode_idx if episode_idx < args.num_episode else None
 
 
-def env_thread(args, thread_num, partition=True, use_ppo2=False):
+@contextlib.contextmanager
+def envRandomState(random_states, env_idx):
     """
-    Run a session of an environment
+    Run an environment with its own state of the global numpy random generator (used by some simulators,
+    e.g. OmniRobot): the episodes of an environment do not depend on the other environments of the process
+    :param random_states: ([tuple]) the states of the environments of the process (None: not initialised)
+    :param env_idx: (int)
+    """
+    if random_states[env_idx] is not None:
+        np.random.set_state(random_states[env_idx])
+    try:
+        yield
+    finally:
+        random_states[env_idx] = np.random.get_state()
+
+
+def printWorkerStats(workers_stats, total_time):
+    """
+    :param workers_stats: ([dict]) statistics returned by env_thread()
+    :param total_time: (float) duration of the generation, in seconds
+    """
+    print("Generation done in {:.2f}s, {:.2f} FPS".format(
+        total_time, sum(stats["frames"] for stats in workers_stats) / total_time))
+    for stats in sorted(workers_stats, key=lambda stats: stats["thread_num"]):
+        print("Worker {}: {} episodes, {} frames, {:.2f} FPS, {:.1f}% utilization".format(
+            stats["thread_num"], stats["episodes"], stats["frames"], stats["frames"] / max(stats["episode_time"], 1e-8),
+            100 * stats["episode_time"] / total_time))
+
+
+def mergePart(args, part):
+    """
+    Move the records of a finished part to the output folder and load its data.
+    The record folders are already numbered with the global episode index, so they are only moved.
     :param args: (ArgumentParser object)
-    :param thread_num: (int) The thread ID of the environment session
-    :param partition: (bool) If the output should be in multiple parts (default=True)
-    :param use_ppo2: (bool) Use ppo2 to generate the dataset
+    :param part: (str) path to the part folder
+    :return: (dict, dict) content of the preprocessed_data.npz and ground_truth.npz files of the part
+    """
+    if not os.path.exists(part + "/preprocessed_data.npz"):
+        # the other processes took all the episodes
+        shutil.rmtree(part)
+        return None
+
+    output_folder = args.save_path + args.name
+    for record in glob.glob(part + "/record_[0-9]*"):
+        os.rename(record, output_folder + "/" + os.path.basename(record))
+    for config_file in ["dataset_config.json", "env_globals.json"]:
+        # the config files are identical for all the parts
+        if os.path.exists(part + "/" + config_file):
+            os.replace(part + "/" + config_file, output_folder + "/" + config_file)
+
+    preprocessed_data = dict(np.load(part + "/preprocessed_data.npz"))
+    ground_truth = dict(np.load(part + "/ground_truth.npz"))
+    part_prefix = os.path.basename(part) + "/"
+    ground_truth['images_path'] = np.array([args.name + "/" + path[len(part_prefix):]
+                                            for path in ground_truth['images_path']])
+    shutil.rmtree(part)
+    return preprocessed_data, ground_truth
+
+
+def fuseParts(parts_data):
     """
-    env_kwargs = {
+    Fuse the data of all the parts, sorted by episode index.
+    Each array is allocated once (single concatenation), so the cost is linear in the size of the dataset.
+    :param parts_data: ([(dict, dict)]) output of mergePart() for each non-empty part, in any order
+    :return: (dict, dict) content of the fused preprocessed_data.npz and ground_truth.npz
+    """
+    def episodeIndices(data):
+        # the first step of each episode is the first frame of its record folder
+        images_path = data[1]['images_path'][data[0]['episode_starts']]
+        return [int(path.split("/")[-2].split("_")[-1]) for path in images_path]
+
+    parts_indices = [episodeIndices(data) for data in parts_data]
+    order = sorted(range(len(parts_data)), key=lambda i: parts_indices[i][0])
+    parts_data = [parts_data[i] for i in order]
+    episode_indices = np.concatenate([parts_indices[i] for i in order])
+    preprocessed_data = {key: np.concatenate([data[0][key] for data in parts_data]) for key in parts_data[0][0]}
+    ground_truth = {key: np.concatenate([data[1][key] for data in parts_data]) for key in parts_data[0][1]}
+    if np.any(np.diff(episode_indices) < 0):
+        # the episodes of the parts are interleaved: reorder the episodes, keeping the order of the steps
+        # (mergesort is the stable sort of every numpy version, kind='stable' needs numpy >= 1.15)
+        episode_of_step = episodeIndex(preprocessed_data['episode_starts'])
+        step_order = np.argsort(episode_indices[episode_of_step], kind='mergesort')
+        target_order = np.argsort(episode_indices, kind='mergesort')
+        preprocessed_data = {key: value[step_order] for key, value in preprocessed_data.items()}
+        ground_truth = {key: value[target_order if key == 'target_positions' else step_order]
+                        for key, value in ground_truth.items()}
+    return preprocessed_data, ground_truth
+
+
+def envKwargs(args, name, renders=False):
+    """
+    :param args: (ArgumentParser object)
+    :param name: (str) name of the dataset (or part) written by the environment
+    :param renders: (bool)
+    :return: (dict) the arguments of the environment
+    """
+    return {
         "max_distance": args.max_distance,
         "random_target": args.random_target,
         "force_down": True,
         "is_discrete": not args.continuous_actions,
-        "renders": thread_num == 0 and args.display,
+        "renders": renders,
         "record_data": not args.no_record_data,
         "multi_view": args.multi_view,
         "save_path": args.save_path,
-        "shape_reward": args.shape_reward
+        "shape_reward": args.shape_reward,
+        "fast_reset": args.fast_reset,
+        "backend": "numpy" if args.numpy_backend else "pybullet",
+        "name": name
     }
 
-    if partition:
-        env_kwargs["name"] = args.name + "_part-" + str(thread_num)
-    else:
-        env_kwargs["name"] = args.name
 
-    env_class = registered_env[args.env][0]
-    env = env_class(**env_kwargs)
-    using_real_omnibot = args.env == "OmnirobotEnv-v0" and USING_OMNIROBOT
+def trainPPO2(args, model_path):
+    """
+    Train the PPO2 agent used to generate the dataset (instead of a random agent), only once for all the processes
+    :param args: (ArgumentParser object)
+    :param model_path: (str) where to save the trained model
+    """
+    env_kwargs = {**envKwargs(args, args.name), "record_data": False}
+    train_env = registered_env[args.env][0](**env_kwargs)
+    train_env = DummyVecEnv([lambda: train_env])
+    train_env = VecNormalize(train_env, norm_obs=True, norm_reward=False)
 
-    model = None
-    if use_ppo2:
-        # Additional env when using a trained ppo agent to generate data
-        # instead of a random agent
-        train_env = env_class(**{**env_kwargs, "record_data": False, "renders": False})
-        train_env = DummyVecEnv([lambda: train_env])
-        train_env = VecNormalize(train_env, norm_obs=True, norm_reward=False)
+    model = PPO2(CnnPolicy, train_env).learn(args.ppo2_timesteps)
+    model.save(model_path)
 
-        model = PPO2(CnnPolicy, train_env).learn(args.ppo2_timesteps)
 
-    frames = 0
-    start_time = time.time()
-    # divide evenly, then do an extra one for only some of them in order to get the right count
-    for i_episode in range(args.num_episode // args.num_cpu + 1 * (args.num_episode % args.num_cpu > thread_num)):
-        # seed + position in this slice + size of slice (with reminder if uneven partitions)
-        seed = args.seed + i_episode + args.num_episode // args.num_cpu * thread_num + \
-               (thread_num if thread_num <= args.num_episode % args.num_cpu else args.num_episode % args.num_cpu)
+def env_thread(args, thread_num, episode_counter, partition=True, ppo2_model_path=None, stats_queue=None):
+    """
+    Run a session of args.envs_per_cpu environments, stepped together
+    :param args: (ArgumentParser object)
+    :param thread_num: (int) The thread ID of the environment session
+    :param episode_counter: (multiprocessing.Value) index of the next episode, shared by all the sessions
+    :param partition: (bool) If the output should be in multiple parts (default=True)
+    :param ppo2_model_path: (str) Use this trained PPO2 model to generate the dataset (if not None)
+    :param stats_queue: (multiprocessing.Queue) where to put the statistics of the session (if not None)
+    :return: (dict) statistics of the session
+    """
+    env_class = registered_env[args.env][0]
+    envs = []
+    for env_idx in range(args.envs_per_cpu):
+        part_idx = thread_num * args.envs_per_cpu + env_idx
+        name = args.name + "_part-" + str(part_idx) if partition else args.name
+        envs.append(env_class(**envKwargs(args, name, renders=part_idx == 0 and args.display)))
+    using_real_omnibot = args.env == "OmnirobotEnv-v0" and USING_OMNIROBOT
 
+    model = None
+    if ppo2_model_path is not None:
+        model = PPO2.load(ppo2_model_path)
+
+    def startEpisode(env_idx):
+        """
+        :param env_idx: (int)
+        :return: ([numpy array, int, bool]) the first observation of the episode, its number of steps and its
+            toward target flag, None if there are no more episodes to run
+        """
+        episode_idx = nextEpisode(args, episode_counter)
+        if episode_idx is None:
+            return None
+        # the seed only depends on the episode, so the dataset does not depend on the number of processes
+        seed = args.seed + episode_idx
+        env = envs[env_idx]
+        if getattr(env, "saver", None) is not None:
+            # Write the episode to its final record folder, whatever the process running it
+            env.saver.setEpisodeIndex(episode_idx)
         env.seed(seed)
         env.action_space.seed(seed)  # this is for the sample() function from gym.space
+        np.random.seed(seed % 2 ** 32)
         obs = env.reset()
-        done = False
-        t = 0
-        episode_toward_target_on = False
-        while not done:
-            env.render()
-
-            if use_ppo2:
-                action, _ = model.predict([obs])
-            else:
-                # Using a target reaching policy (untrained, from camera) when collecting data from real OmniRobot
-                if episode_toward_target_on and np.random.rand() < args.toward_target_timesteps_proportion and \
-                        using_real_omnibot:
-                    action = [env.actionPolicyTowardTarget()]
-                else:
-                    action = [env.action_space.sample()]
+        toward_target = np.random.rand() < args.toward_target_timesteps_proportion and using_real_omnibot
+        return [obs, 0, toward_target]
 
-            action_to_step = action[0]
-            _, _, done, _ = env.step(action_to_step)
+    frames = 0
+    n_episodes = 0
+    start_time = time.time()
+    # observation, number of steps and toward target flag of the episode running in each environment
+    running = {}
+    random_states = [None] * len(envs)
+    for env_idx in range(len(envs)):
+        with envRandomState(random_states, env_idx):
+            episode = startEpisode(env_idx)
+        if episode is not None:
+            running[env_idx] = episode
+
+    while len(running) > 0:
+        env_indices = sorted(running.keys())
+        for env_idx in env_indices:
+            with envRandomState(random_states, env_idx):
+                envs[env_idx].render()
+
+        if model is not None:
+            # a single forward pass of the policy for all the environments
+            actions, _ = model.predict(np.array([running[env_idx][0] for env_idx in env_indices]))
+        else:
+            actions = []
+            for env_idx in env_indices:
+                with envRandomState(random_states, env_idx):
+                    # Using a target reaching policy (untrained, from camera) when collecting data from real OmniRobot
+                    if running[env_idx][2] and np.random.rand() < args.toward_target_timesteps_proportion and \
+                            using_real_omnibot:
+                        actions.append(envs[env_idx].actionPolicyTowardTarget())
+                    else:
+                        actions.append(envs[env_idx].action_space.sample())
 
+        for env_idx, action_to_step in zip(env_indices, actions):
+            with envRandomState(random_states, env_idx):
+                obs, _, done, _ = envs[env_idx].step(action_to_step)
+            running[env_idx][0] = obs
+            running[env_idx][1] += 1
             frames += 1
-            t += 1
             if done:
-                if np.random.rand() < args.toward_target_timesteps_proportion and using_real_omnibot:
-                    episode_toward_target_on = True
+                print("Episode finished after {} timesteps".format(running[env_idx][1] + 1))
+                n_episodes += 1
+                if thread_num == 0:
+                    print("{:.2f} FPS".format(frames * args.num_cpu / (time.time() - start_time)))
+
+                with envRandomState(random_states, env_idx):
+                    episode = startEpisode(env_idx)
+                if episode is None:
+                    del running[env_idx]
                 else:
-                    episode_toward_target_on = False
-                print("Episode finished after {} timesteps".format(t + 1))
+                    running[env_idx] = episode
+    episode_time = time.time() - start_time
 
-        if thread_num == 0:
-            print("{:.2f} FPS".format(frames * args.num_cpu / (time.time() - start_time)))
+    # Write the pending images and the npz files before the parts are merged
+    for env in envs:
+        env.close()
+
+    stats = {"thread_num": thread_num, "episodes": n_episodes, "frames": frames, "episode_time": episode_time}
+    if stats_queue is not None:
+        stats_queue.put(stats)
+    return stats
 
 
 def main():
@@ -141,12 +302,20 @@ def main():
     parser.add_argument('--multi-view', action='store_true', default=False, help='Set a second camera to the scene')
     parser.add_argument('--shape-reward', action='store_true', default=False,
                         help='Shape the reward (reward = - distance) instead of a sparse reward')
+    parser.add_argument('--fast-reset', action='store_true', default=False,
+                        help='Do not reload the whole scene at each reset (Kuka and MobileRobot environments only)')
+    parser.add_argument('--numpy-backend', action='store_true', default=False,
+                        help='Simulate and render the scene with NumPy instead of PyBullet (MobileRobot environments only)')
     parser.add_argument('--reward-dist', action='store_true', default=False,
                         help='Prints out the reward distribution when the dataset generation is finished')
     parser.add_argument('--run-ppo2', action='store_true', default=False,
                         help='runs a ppo2 agent instead of a random agent')
     parser.add_argument('--ppo2-timesteps', type=int, default=1000,
                         help='number of timesteps to run PPO2 on before generating the dataset')
+    parser.add_argument('--envs-per-cpu', type=int, default=1,
+                        help='number of environments stepped together by each process '
+                             '(with --run-ppo2, their observations are passed to the policy in one batch), '
+                             'not available for the PyBullet environments (Kuka, MobileRobot)')
     parser.add_argument('--toward-target-timesteps-proportion', type=float, default=0.0,
                         help="propotion of timesteps that use simply towards target policy, should be 0.0 to 1.0")
     args = parser.parse_args()
@@ -158,6 +327,11 @@ def main():
         "Error: cannot display the reward distribution for continuous reward"
     assert not(registered_env[args.env][3] is ThreadingType.NONE and args.num_cpu != 1), \
         "Error: cannot have more than 1 CPU for the environment {}".format(args.env)
+    assert args.envs_per_cpu > 0, "Error: number of environments per cpu must be positive and non zero"
+    assert not(registered_env[args.env][3] is ThreadingType.NONE and args.envs_per_cpu != 1), \
+        "Error: cannot have more than 1 environment per CPU for the environment {}".format(args.env)
+    assert not(issubclass(registered_env[args.env][0], PYBULLET_ENVS) and args.envs_per_cpu != 1), \
+        "Error: the PyBullet environment {} cannot have more than 1 environment per CPU".format(args.env)
     if args.num_cpu > args.num_episode:
         args.num_cpu = args.num_episode
         printYellow("num_cpu cannot be greater than num_episode, defaulting to {} cpus.".format(args.num_cpu))
@@ -176,22 +350,60 @@ def main():
         # create the output
         os.mkdir(args.save_path + args.name)
 
+    ppo2_model_path = None
+    if args.run_ppo2:
+        # train the agent once, in its own process, then every process loads the trained weights
+        ppo2_folder = tempfile.mkdtemp()
+        ppo2_model_path = os.path.join(ppo2_folder, "ppo2_model.pkl")
+        process = multiprocessing.Process(target=trainPPO2, args=(args, ppo2_model_path))
+        process.start()
+        process.join()
+        assert process.exitcode == 0, "Error: the training of the PPO2 agent failed"
+
+    episode_counter = multiprocessing.Value('i', 0)
+    partition = args.num_cpu * args.envs_per_cpu > 1
+    parts_data = []
+
+    def mergeParts(thread_num):
+        """
+        :param thread_num: (int) merge the parts written by this process
+        """
+        if args.no_record_data or not partition:
+            return
+        for env_idx in range(args.envs_per_cpu):
+            part_idx = thread_num * args.envs_per_cpu + env_idx
+            part_data = mergePart(args, args.save_path + args.name + "_part-" + str(part_idx))
+            if part_data is not None:
+                parts_data.append(part_data)
+
+    start_time = time.time()
     if args.num_cpu == 1:
-        env_thread(args, 0, partition=False, use_ppo2=args.run_ppo2)
+        workers_stats = [env_thread(args, 0, episode_counter, partition, ppo2_model_path)]
+        mergeParts(0)
     else:
         # try and divide into multiple processes, with an environment each
         try:
-            jobs = []
+            jobs = {}
+            stats_queue = multiprocessing.Queue()
             for i in range(args.num_cpu):
-                process = multiprocessing.Process(target=env_thread, args=(args, i, True, args.run_ppo2))
-                jobs.append(process)
+                process = multiprocessing.Process(target=env_thread, args=(args, i, episode_counter, partition,
+                                                                           ppo2_model_path, stats_queue))
+                jobs[i] = process
 
-            for j in jobs:
+            for j in jobs.values():
                 j.start()
 
             try:
-                for j in jobs:
-                    j.join()
+                # merge the parts of each process as soon as it is done
+                while len(jobs) > 0:
+                    sentinels = {job.sentinel: i for i, job in jobs.items()}
+                    for sentinel in multiprocessing.connection.wait(list(sentinels.keys())):
+                        i = sentinels[sentinel]
+                        job = jobs.pop(i)
+                        job.join()
+                        assert job.exitcode == 0, "Error: process {} exited with code {}".format(i, job.exitcode)
+                        mergeParts(i)
+                workers_stats = [stats_queue.get() for _ in range(args.num_cpu)]
             except Exception as e:
                 printRed("Error: unable to join thread")
                 raise e
@@ -200,67 +412,16 @@ def main():
             printRed("Error: unable to start thread")
             raise e
 
-    if not args.no_record_data and args.num_cpu > 1:
-        # sleep 1 second, to avoid congruency issues from multiprocess (eg., files still writing)
-        time.sleep(1)
-        # get all the parts
-        file_parts = sorted(glob.glob(args.save_path + args.name + "_part-[0-9]*"), key=lambda a: int(a.split("-")[-1]))
-
-        # move the config files from any as they are identical
-        os.rename(file_parts[0] + "/dataset_config.json", args.save_path + args.name + "/dataset_config.json")
-        os.rename(file_parts[0] + "/env_globals.json", args.save_path + args.name + "/env_globals.json")
-
-        ground_truth = None
-        preprocessed_data = None
-
-        # used to convert the part record_id to the fused record_id
-        record_id = 0
-        for part in file_parts:
-            # sort the record names alphabetically, then numerically
-            records = sorted(glob.glob(part + "/record_[0-9]*"), key=lambda a: int(a.split("_")[-1]))
-
-            record_id_start = record_id
-            for record in records:
-                os.renames(record, args.save_path + args.name + "/record_{:03d}".format(record_id))
-                record_id += 1
-
-            # fuse the npz files together, in the right order
-            if ground_truth is None:
-                # init
-                ground_truth = {}
-                preprocessed_data = {}
-                ground_truth_load = np.load(part + "/ground_truth.npz")
-                preprocessed_data_load = np.load(part + "/preprocessed_data.npz")
-
-                for arr in ground_truth_load.files:
-                    if arr == "images_path":
-                        ground_truth[arr] = np.array(
-                            [convertImagePath(args, path, record_id_start) for path in ground_truth_load[arr]])
-                    else:
-                        ground_truth[arr] = ground_truth_load[arr]
-                for arr in preprocessed_data_load.files:
-                    preprocessed_data[arr] = preprocessed_data_load[arr]
-
-            else:
-                ground_truth_load = np.load(part + "/ground_truth.npz")
-                preprocessed_data_load = np.load(part + "/preprocessed_data.npz")
-
-                for arr in ground_truth_load.files:
-                    if arr == "images_path":
-                        sanitised_paths = np.array(
-                            [convertImagePath(args, path, record_id_start) for path in ground_truth_load[arr]])
-                        ground_truth[arr] = np.concatenate((ground_truth[arr], sanitised_paths))
-                    else:
-                        ground_truth[arr] = np.concatenate((ground_truth[arr], ground_truth_load[arr]))
-                for arr in preprocessed_data_load.files:
-                    preprocessed_data[arr] = np.concatenate((preprocessed_data[arr], preprocessed_data_load[arr]))
-
-            # remove the current part folder
-            shutil.rmtree(part)
+    printWorkerStats(workers_stats, time.time() - start_time)
+    if args.run_ppo2:
+        shutil.rmtree(ppo2_folder)
 
+    if not args.no_record_data and partition:
         # save the fused outputs
+        preprocessed_data, ground_truth = fuseParts(parts_data)
         np.savez(args.save_path + args.name + "/ground_truth.npz", **ground_truth)
         np.savez(args.save_path + args.name + "/preprocessed_data.npz", **preprocessed_data)
+        writeDatasetIndex(args.save_path + args.name)
 
     if args.reward_dist:
         rewards, counts = np.unique(np.load(args.save_path + args.name + "/preprocessed_data.npz")['rewards'],
@@ -25,6 +25,7 @@ class Kuka2ButtonGymEnv(KukaButtonGymEnv):
     :param env_rank: (int) the number ID of the environment
     :param srl_pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param srl_model: (str) The SRL_model used
+    :param fast_reset: (bool) load and settle the world only once, then restore a snapshot of it at each reset
     """
 
     def __init__(self, name="kuka_2button_gym", max_distance=2, force_down=False, **kwargs):
@@ -37,17 +38,9 @@ class Kuka2ButtonGymEnv(KukaButtonGymEnv):
         self.terminated = False
         self.n_contacts = [0, 0]
         self.button_all_pos = []
-        self.button_uid = []
         self.goal_id = 0  # here, goal_id is used to know which button is the next one to press
         self.n_steps_outside = 0
         self.button_pressed = [False]
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, -1])
-
-        self.table_uid = p.loadURDF(os.path.join(self._urdf_root, "table/table.urdf"), 0.5000000, 0.00000, -.820000,
-                                    0.000000, 0.000000, 0.0, 1.0)
 
         # Initialize button position
         x_pos = 0.5
@@ -58,7 +51,6 @@ class Kuka2ButtonGymEnv(KukaButtonGymEnv):
 
         x_pos = 0.5 + 0.0 * self.np_random.uniform(-1, 1)
         y_pos = 0.125 + 0.0 * self.np_random.uniform(-1, 1)
-        self.button_uid.append(p.loadURDF("/urdf/simple_button.urdf", [x_pos, y_pos, Z_TABLE]))
         self.button_all_pos.append(np.array([x_pos, y_pos, Z_TABLE + BUTTON_DISTANCE_HEIGHT]))
 
         x_pos = 0.5
@@ -67,47 +59,22 @@ class Kuka2ButtonGymEnv(KukaButtonGymEnv):
             x_pos += 0.15 * self.np_random.uniform(-1, 1)
             y_pos += 0.175 * self.np_random.uniform(-1, 0)
 
-        self.button_uid.append(p.loadURDF("/urdf/simple_button_2.urdf", [x_pos, y_pos, Z_TABLE]))
         self.button_all_pos.append(np.array([x_pos, y_pos, Z_TABLE + BUTTON_DISTANCE_HEIGHT]))
 
         # need to define this for the ground_truth model
         self.button_pos = self.button_all_pos[0]
 
-        p.setGravity(0, 0, -10)
-        self._kuka = kuka.Kuka(urdf_root_path=self._urdf_root, timestep=self._timestep,
-                               use_inverse_kinematics=(not self.action_joints), small_constraints=False)
-        self._kuka.use_null_space = True
+        buttons_load_pos = [pos - np.array([0, 0, BUTTON_DISTANCE_HEIGHT]) for pos in self.button_all_pos]
+        if self.restoreSnapshot():
+            # The world is already loaded and settled, only the buttons need to be moved
+            for uid, load_pos in zip(self.button_uid, buttons_load_pos):
+                self.moveBody(uid, load_pos)
+        else:
+            self.loadWorld()
+            self.saveSnapshot(dict(zip(self.button_uid, buttons_load_pos)))
 
         self._env_step_counter = 0
-        # Close the gripper and wait for the arm to be in rest position
-        for _ in range(500):
-            if self.action_joints:
-                self._kuka.applyAction(list(np.array(self._kuka.joint_positions)[:7]) + [0, 0])
-            else:
-                self._kuka.applyAction([0, 0, 0, 0, 0])
-            p.stepSimulation()
-
-        # Randomize init arm pos: take 5 random actions
-        for _ in range(N_RANDOM_ACTIONS_AT_INIT):
-            if self._is_discrete:
-                action = [0, 0, 0, 0, 0]
-                sign = 1 if self.np_random.rand() > 0.5 else -1
-                action_idx = self.np_random.randint(3)  # dx, dy or dz
-                action[action_idx] += sign * DELTA_V
-            else:
-                if self.action_joints:
-                    joints = np.array(self._kuka.joint_positions)[:7]
-                    joints += DELTA_THETA * self.np_random.normal(joints.shape)
-                    action = list(joints) + [0, 0]
-                else:
-                    action = np.zeros(5)
-                    rand_direction = self.np_random.normal((3,))
-                    # L2 normalize, so that the random direction is not too high or too low
-                    rand_direction /= np.linalg.norm(rand_direction, 2)
-                    action[:3] += DELTA_V_CONTINUOUS * rand_direction
-
-            self._kuka.applyAction(list(action))
-            p.stepSimulation()
+        self.randomizeArmPos()
 
         self._observation = self.getExtendedObservation()
 
@@ -119,6 +86,25 @@ class Kuka2ButtonGymEnv(KukaButtonGymEnv):
 
         return np.array(self._observation)
 
+    def loadWorld(self):
+        p.resetSimulation()
+        p.setPhysicsEngineParameter(numSolverIterations=150)
+        p.setTimeStep(self._timestep)
+        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, -1])
+
+        self.table_uid = p.loadURDF(os.path.join(self._urdf_root, "table/table.urdf"), 0.5000000, 0.00000, -.820000,
+                                    0.000000, 0.000000, 0.0, 1.0)
+
+        self.button_uid = []
+        for urdf, button_pos in zip(["/urdf/simple_button.urdf", "/urdf/simple_button_2.urdf"], self.button_all_pos):
+            self.button_uid.append(p.loadURDF(urdf, [button_pos[0], button_pos[1], Z_TABLE]))
+
+        p.setGravity(0, 0, -10)
+        self._kuka = kuka.Kuka(urdf_root_path=self._urdf_root, timestep=self._timestep,
+                               use_inverse_kinematics=(not self.action_joints), small_constraints=False)
+        self._kuka.use_null_space = True
+        self.settleArm()
+
     def step2(self, action):
         """
         :param action:([float])
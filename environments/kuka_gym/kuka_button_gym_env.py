@@ -7,6 +7,7 @@ import torch as th
 import pybullet_data
 from gym import spaces
 
+from environments.camera import PyBulletCamera, loadRenderer, renderCameras
 from environments.srl_env import SRLGymEnv
 from state_representation.episode_saver import EpisodeSaver
 from srl_zoo.preprocessing import getNChannels
@@ -32,6 +33,7 @@ NOISE_STD = 0.01  # Add noise to actions, so the env is not fully deterministic
 NOISE_STD_CONTINUOUS = 0.0001
 NOISE_STD_JOINTS = 0.002
 N_RANDOM_ACTIONS_AT_INIT = 5  # Randomize init arm pos: take 5 random actions
+N_SETTLING_STEPS = 500  # Number of simulation steps to wait for the arm to be in rest position
 BUTTON_DISTANCE_HEIGHT = 0.28  # Extra height added to the buttons position in the distance calculation
 
 CONNECTED_TO_SIMULATOR = False  # To avoid calling disconnect in the __del__ method when not needed
@@ -73,12 +75,17 @@ class KukaButtonGymEnv(SRLGymEnv):
     :param env_rank: (int) the number ID of the environment
     :param srl_pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param srl_model: (str) The SRL_model used
+    :param renderer: (str) renderer used for the camera images: "tiny", "opengl" or "egl" (see environments/camera.py)
+    :param fast_reset: (bool) load and settle the world only once, then restore a snapshot of it at each reset
+    NOTE: when the observation is a state from the environment (ground_truth, joints, ...)
+    and no data is recorded, the camera image is not rendered at each step (see getExtendedObservation)
     """
 
     def __init__(self, urdf_root=pybullet_data.getDataPath(), renders=False, is_discrete=True, multi_view=False,
                  name="kuka_button_gym", max_distance=0.8, action_repeat=1, shape_reward=False, action_joints=False,
                  record_data=False, random_target=False, force_down=True, state_dim=-1, learn_states=False,
-                 verbose=False, save_path='srl_zoo/data/', env_rank=0, srl_pipe=None, srl_model="raw_pixels", **_):
+                 verbose=False, save_path='srl_zoo/data/', env_rank=0, srl_pipe=None, srl_model="raw_pixels",
+                 renderer="tiny", fast_reset=False, **_):
         super(KukaButtonGymEnv, self).__init__(srl_model=srl_model,
                                                relative_pos=RELATIVE_POS,
                                                env_rank=env_rank,
@@ -91,18 +98,15 @@ class KukaButtonGymEnv(SRLGymEnv):
         self._renders = renders
         self._width = RENDER_WIDTH
         self._height = RENDER_HEIGHT
-        self._cam_dist = 1.1
-        self._cam_yaw = 145
-        self._cam_pitch = -36
-        self._cam_roll = 0
         self._max_distance = max_distance
         self._shape_reward = shape_reward
         self._random_target = random_target
         self._force_down = force_down
-        self.camera_target_pos = (0.316, -0.2, -0.1)
         self._is_discrete = is_discrete
         self.terminated = False
-        self.renderer = p.ER_TINY_RENDERER
+        self.renderer = None
+        self.camera = None
+        self.camera_2 = None
         self.debug = False
         self.n_contacts = 0
         self.state_dim = state_dim
@@ -120,6 +124,8 @@ class KukaButtonGymEnv(SRLGymEnv):
         self._kuka = None
         self.action = None
         self.srl_model = srl_model
+        self._fast_reset = fast_reset
+        self._snapshot = None
 
         if record_data:
             self.saver = EpisodeSaver(name, max_distance, state_dim, globals_=getGlobals(), relative_pos=RELATIVE_POS,
@@ -130,22 +136,23 @@ class KukaButtonGymEnv(SRLGymEnv):
             if client_id < 0:
                 p.connect(p.GUI)
             p.resetDebugVisualizerCamera(1.3, 180, -41, [0.52, -0.2, -0.33])
-
             self.debug = True
-            # Debug sliders for moving the camera
-            self.x_slider = p.addUserDebugParameter("x_slider", -10, 10, self.camera_target_pos[0])
-            self.y_slider = p.addUserDebugParameter("y_slider", -10, 10, self.camera_target_pos[1])
-            self.z_slider = p.addUserDebugParameter("z_slider", -10, 10, self.camera_target_pos[2])
-            self.dist_slider = p.addUserDebugParameter("cam_dist", 0, 10, self._cam_dist)
-            self.yaw_slider = p.addUserDebugParameter("cam_yaw", -180, 180, self._cam_yaw)
-            self.pitch_slider = p.addUserDebugParameter("cam_pitch", -180, 180, self._cam_pitch)
-
         else:
             p.connect(p.DIRECT)
 
         global CONNECTED_TO_SIMULATOR
         CONNECTED_TO_SIMULATOR = True
 
+        self.renderer = loadRenderer(renderer)
+        self.camera = PyBulletCamera((0.316, -0.2, -0.1), distance=1.1, yaw=145, pitch=-36,
+                                     width=RENDER_WIDTH, height=RENDER_HEIGHT, renderer=self.renderer)
+        # second camera on the other side of the robot (multi-view)
+        self.camera_2 = PyBulletCamera((0.316, 0.316, -0.105), distance=1.05, yaw=32, pitch=-13,
+                                       width=RENDER_WIDTH, height=RENDER_HEIGHT, renderer=self.renderer)
+        if self.debug:
+            # Debug sliders for moving the camera
+            self.camera.addDebugSliders()
+
         if self._is_discrete:
             self.action_space = spaces.Discrete(N_DISCRETE_ACTIONS)
         else:
@@ -172,6 +179,10 @@ class KukaButtonGymEnv(SRLGymEnv):
         else:
             self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(self.state_dim,), dtype=np.float32)
 
+        # Lazy observation: skip the camera rendering when the image is neither used
+        # by the policy/SRL model nor recorded (it can still be obtained with render())
+        self.lazy_obs = self.srl_model in ["ground_truth", "joints", "joints_position"] and not record_data
+
     def getSRLState(self, observation):
         state = []
         if self.srl_model in ["ground_truth", "joints_position"]:
@@ -215,13 +226,6 @@ class KukaButtonGymEnv(SRLGymEnv):
         self.terminated = False
         self.n_contacts = 0
         self.n_steps_outside = 0
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, -1])
-
-        self.table_uid = p.loadURDF(os.path.join(self._urdf_root, "table/table.urdf"), 0.5000000, 0.00000, -.820000,
-                                    0.000000, 0.000000, 0.0, 1.0)
 
         # Initialize button position
         x_pos = 0.5
@@ -229,24 +233,71 @@ class KukaButtonGymEnv(SRLGymEnv):
         if self._random_target:
             x_pos += 0.15 * self.np_random.uniform(-1, 1)
             y_pos += 0.3 * self.np_random.uniform(-1, 1)
-
-        self.button_uid = p.loadURDF("/urdf/simple_button.urdf", [x_pos, y_pos, Z_TABLE])
         self.button_pos = np.array([x_pos, y_pos, Z_TABLE])
 
+        if self.restoreSnapshot():
+            # The world is already loaded and settled, only the button needs to be moved
+            self.moveBody(self.button_uid, self.button_pos)
+        else:
+            self.loadWorld()
+            self.saveSnapshot({self.button_uid: self.button_pos})
+
+        self._env_step_counter = 0
+        self.randomizeArmPos()
+
+        self._observation = self.getExtendedObservation()
+
+        self.button_pos = np.array(p.getLinkState(self.button_uid, BUTTON_LINK_IDX)[0])
+        self.button_pos[2] += BUTTON_DISTANCE_HEIGHT  # Set the target position on the top of the button
+        if self.saver is not None:
+            self.saver.reset(self._observation, self.getTargetPos(), self.getGroundTruth())
+
+        if self.srl_model != "raw_pixels":
+            return self.getSRLState(self._observation)
+
+        return np.array(self._observation)
+
+    def loadWorld(self):
+        """
+        Load the scene from scratch (the button is loaded at self.button_pos)
+        and wait for the arm to be in rest position
+        """
+        p.resetSimulation()
+        p.setPhysicsEngineParameter(numSolverIterations=150)
+        p.setTimeStep(self._timestep)
+        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, -1])
+
+        self.table_uid = p.loadURDF(os.path.join(self._urdf_root, "table/table.urdf"), 0.5000000, 0.00000, -.820000,
+                                    0.000000, 0.000000, 0.0, 1.0)
+
+        self.button_uid = p.loadURDF("/urdf/simple_button.urdf", list(self.button_pos))
+
         p.setGravity(0, 0, -10)
         self._kuka = kuka.Kuka(urdf_root_path=self._urdf_root, timestep=self._timestep,
                                use_inverse_kinematics=(not self.action_joints),
                                small_constraints=(not self._random_target))
-        self._env_step_counter = 0
-        # Close the gripper and wait for the arm to be in rest position
-        for _ in range(500):
-            if self.action_joints:
-                self._kuka.applyAction(list(np.array(self._kuka.joint_positions)[:7]) + [0, 0])
-            else:
-                self._kuka.applyAction([0, 0, 0, 0, 0])
+        self.settleArm()
+
+    def getRestAction(self):
+        """
+        :return: ([float]) the action that keeps the arm in rest position, with the gripper closed
+        """
+        if self.action_joints:
+            return list(np.array(self._kuka.joint_positions)[:7]) + [0, 0]
+        return [0, 0, 0, 0, 0]
+
+    def settleArm(self):
+        """
+        Close the gripper and wait for the arm to be in rest position
+        """
+        for _ in range(N_SETTLING_STEPS):
+            self._kuka.applyAction(self.getRestAction())
             p.stepSimulation()
 
-        # Randomize init arm pos: take 5 random actions
+    def randomizeArmPos(self):
+        """
+        Randomize init arm pos: take N_RANDOM_ACTIONS_AT_INIT random actions
+        """
         for _ in range(N_RANDOM_ACTIONS_AT_INIT):
             if self._is_discrete:
                 action = [0, 0, 0, 0, 0]
@@ -268,23 +319,57 @@ class KukaButtonGymEnv(SRLGymEnv):
             self._kuka.applyAction(list(action))
             p.stepSimulation()
 
-        self._observation = self.getExtendedObservation()
-
-        self.button_pos = np.array(p.getLinkState(self.button_uid, BUTTON_LINK_IDX)[0])
-        self.button_pos[2] += BUTTON_DISTANCE_HEIGHT  # Set the target position on the top of the button
-        if self.saver is not None:
-            self.saver.reset(self._observation, self.getTargetPos(), self.getGroundTruth())
-
-        if self.srl_model != "raw_pixels":
-            return self.getSRLState(self._observation)
-
-        return np.array(self._observation)
+    def saveSnapshot(self, movable_bodies):
+        """
+        Save the settled state of the world, so the next resets only need to restore it (fast reset only)
+        :param movable_bodies: ({int: numpy array}) uid and loading position of the bodies
+            that can be moved at each reset (see moveBody())
+        """
+        if not self._fast_reset:
+            return
+        self._snapshot = {
+            "state_id": p.saveState(),
+            "end_effector_pos": np.copy(self._kuka.end_effector_pos),
+            "end_effector_angle": self._kuka.end_effector_angle,
+            "bodies": {uid: (np.array(load_pos), *p.getBasePositionAndOrientation(uid))
+                       for uid, load_pos in movable_bodies.items()}
+        }
+
+    def restoreSnapshot(self):
+        """
+        Restore the settled state of the world saved by saveSnapshot()
+        :return: (bool) False if there is no snapshot to restore
+        """
+        if self._snapshot is None:
+            return False
+        p.restoreState(self._snapshot["state_id"])
+        self._kuka.end_effector_pos = np.copy(self._snapshot["end_effector_pos"])
+        self._kuka.end_effector_angle = self._snapshot["end_effector_angle"]
+        # The motor commands are not part of the saved state
+        self._kuka.applyAction(self.getRestAction())
+        return True
+
+    def moveBody(self, uid, load_pos):
+        """
+        Move a body of the snapshot to where it would have settled, had it been loaded at load_pos
+        :param uid: (int)
+        :param load_pos: (numpy array)
+        """
+        snapshot_load_pos, settled_pos, orientation = self._snapshot["bodies"][uid]
+        p.resetBasePositionAndOrientation(uid, np.array(settled_pos) + np.array(load_pos) - snapshot_load_pos,
+                                          orientation)
 
     def __del__(self):
         if CONNECTED_TO_SIMULATOR:
             p.disconnect()
 
     def getExtendedObservation(self):
+        """
+        :return: (numpy array) the camera image, None in lazy observation mode
+        """
+        if self.lazy_obs:
+            self._observation = None
+            return self._observation
         if getNChannels() > 3:
             self.multi_view = True
         self._observation = self.render("rgb_array")
@@ -370,58 +455,14 @@ class KukaButtonGymEnv(SRLGymEnv):
     def render(self, mode='human', close=False):
         if mode != "rgb_array":
             return np.array([])
-        camera_target_pos = self.camera_target_pos
-
         if self.debug:
-            self._cam_dist = p.readUserDebugParameter(self.dist_slider)
-            self._cam_yaw = p.readUserDebugParameter(self.yaw_slider)
-            self._cam_pitch = p.readUserDebugParameter(self.pitch_slider)
-            x = p.readUserDebugParameter(self.x_slider)
-            y = p.readUserDebugParameter(self.y_slider)
-            z = p.readUserDebugParameter(self.z_slider)
-            camera_target_pos = (x, y, z)
-            # self._cam_roll = p.readUserDebugParameter(self.roll_slider)
-
-        # TODO: recompute view_matrix and proj_matrix only in debug mode
-        view_matrix1 = p.computeViewMatrixFromYawPitchRoll(
-            cameraTargetPosition=camera_target_pos,
-            distance=self._cam_dist,
-            yaw=self._cam_yaw,
-            pitch=self._cam_pitch,
-            roll=self._cam_roll,
-            upAxisIndex=2)
-        proj_matrix1 = p.computeProjectionMatrixFOV(
-            fov=60, aspect=float(RENDER_WIDTH) / RENDER_HEIGHT,
-            nearVal=0.1, farVal=100.0)
-        (_, _, px1, _, _) = p.getCameraImage(
-            width=RENDER_WIDTH, height=RENDER_HEIGHT, viewMatrix=view_matrix1,
-            projectionMatrix=proj_matrix1, renderer=self.renderer)
-        rgb_array1 = np.array(px1)
-
+            self.camera.readDebugSliders()
         if self.multi_view:
-            # adding a second camera on the other side of the robot
-            view_matrix2 = p.computeViewMatrixFromYawPitchRoll(
-                cameraTargetPosition=(0.316, 0.316, -0.105),
-                distance=1.05,
-                yaw=32,
-                pitch=-13,
-                roll=0,
-                upAxisIndex=2)
-            proj_matrix2 = p.computeProjectionMatrixFOV(
-                fov=60, aspect=float(RENDER_WIDTH) / RENDER_HEIGHT,
-                nearVal=0.1, farVal=100.0)
-            (_, _, px2, _, _) = p.getCameraImage(
-                width=RENDER_WIDTH, height=RENDER_HEIGHT, viewMatrix=view_matrix2,
-                projectionMatrix=proj_matrix2, renderer=self.renderer)
-            rgb_array2 = np.array(px2)
-            rgb_array_res = np.concatenate((rgb_array1[:, :, :3], rgb_array2[:, :, :3]), axis=2)
-        else:
-            rgb_array_res = rgb_array1[:, :, :3]
-        return rgb_array_res
+            return renderCameras([self.camera, self.camera_2])
+        return renderCameras([self.camera])
 
     def _termination(self):
         if self.terminated or self._env_step_counter > self.max_steps:
-            self._observation = self.getExtendedObservation()
             return True
         return False
 
@@ -28,6 +28,7 @@ class KukaMovingButtonGymEnv(KukaButtonGymEnv):
     :param env_rank: (int) the number ID of the environment
     :param srl_pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param srl_model: (str) The SRL_model used
+    :param fast_reset: (bool) load and settle the world only once, then restore a snapshot of it at each reset
     """
 
     def __init__(self, name="kuka_moving_button_gym", **kwargs):
@@ -38,73 +39,7 @@ class KukaMovingButtonGymEnv(KukaButtonGymEnv):
     def reset(self):
         # random initial direction
         self.button_speed = BUTTON_SPEED * self.np_random.choice([-1, 1])
-        self.terminated = False
-        self.n_contacts = 0
-        self.n_steps_outside = 0
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, -1])
-
-        self.table_uid = p.loadURDF(os.path.join(self._urdf_root, "table/table.urdf"), 0.5000000, 0.00000, -.820000,
-                                    0.000000, 0.000000, 0.0, 1.0)
-
-        # Initialize button position
-        x_pos = 0.5
-        y_pos = 0
-        if self._random_target:
-            x_pos += 0.15 * self.np_random.uniform(-1, 1)
-            y_pos += 0.3 * self.np_random.uniform(-1, 1)
-
-        self.button_uid = p.loadURDF("/urdf/simple_button.urdf", [x_pos, y_pos, Z_TABLE])
-        self.button_pos = np.array([x_pos, y_pos, Z_TABLE])
-
-        p.setGravity(0, 0, -10)
-        self._kuka = kuka.Kuka(urdf_root_path=self._urdf_root, timestep=self._timestep,
-                               use_inverse_kinematics=(not self.action_joints),
-                               small_constraints=(not self._random_target))
-        self._env_step_counter = 0
-        # Close the gripper and wait for the arm to be in rest position
-        for _ in range(500):
-            if self.action_joints:
-                self._kuka.applyAction(list(np.array(self._kuka.joint_positions)[:7]) + [0, 0])
-            else:
-                self._kuka.applyAction([0, 0, 0, 0, 0])
-            p.stepSimulation()
-
-        # Randomize init arm pos: take 5 random actions
-        for _ in range(N_RANDOM_ACTIONS_AT_INIT):
-            if self._is_discrete:
-                action = [0, 0, 0, 0, 0]
-                sign = 1 if self.np_random.rand() > 0.5 else -1
-                action_idx = self.np_random.randint(3)  # dx, dy or dz
-                action[action_idx] += sign * DELTA_V
-            else:
-                if self.action_joints:
-                    joints = np.array(self._kuka.joint_positions)[:7]
-                    joints += DELTA_THETA * self.np_random.normal(joints.shape)
-                    action = list(joints) + [0, 0]
-                else:
-                    action = np.zeros(5)
-                    rand_direction = self.np_random.normal((3,))
-                    # L2 normalize, so that the random direction is not too high or too low
-                    rand_direction /= np.linalg.norm(rand_direction, 2)
-                    action[:3] += DELTA_V_CONTINUOUS * rand_direction
-
-            self._kuka.applyAction(list(action))
-            p.stepSimulation()
-
-        self._observation = self.getExtendedObservation()
-
-        self.button_pos = np.array(p.getLinkState(self.button_uid, BUTTON_LINK_IDX)[0])
-        self.button_pos[2] += BUTTON_DISTANCE_HEIGHT  # Set the target position on the top of the button
-        if self.saver is not None:
-            self.saver.reset(self._observation, self.button_pos, self.getGroundTruth())
-
-        if self.srl_model != "raw_pixels":
-            return self.getSRLState(self._observation)
-
-        return np.array(self._observation)
+        return super(KukaMovingButtonGymEnv, self).reset()
 
     def step(self, action):
         # should the button hit the edge of the table, switch direction
@@ -26,17 +26,14 @@ class MobileRobot1DGymEnv(MobileRobotGymEnv):
     :param pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param fpv: (bool) enable first person view camera
     :param srl_model: (str) The SRL_model used
+    :param fast_reset: (bool) build the static scene only once, then only move the robot and the target at each reset
+    :param backend: (str) "pybullet" or "numpy" (rasterized top-down camera, without physics server)
     """
+    CAMERA_TARGET_POS = (2, 0, 0)
+
     def __init__(self, name="mobile_robot_1D", **kwargs):
         super(MobileRobot1DGymEnv, self).__init__(name=name, **kwargs)
 
-        self.camera_target_pos = (2, 0, 0)
-
-        if self._renders:
-            self.x_slider = p.addUserDebugParameter("x_slider", -10, 10, self.camera_target_pos[0])
-            self.y_slider = p.addUserDebugParameter("y_slider", -10, 10, self.camera_target_pos[1])
-            self.z_slider = p.addUserDebugParameter("z_slider", -10, 10, self.camera_target_pos[2])
-
         if self._is_discrete:
             self.action_space = spaces.Discrete(N_DISCRETE_ACTIONS)
         else:
@@ -56,11 +53,6 @@ class MobileRobot1DGymEnv(MobileRobotGymEnv):
 
     def reset(self):
         self.terminated = False
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, 0])
-        p.setGravity(0, 0, -10)
 
         # Init the robot randomly
         x_start = self._max_x / 2 + self.np_random.uniform(- self._max_x / 3, self._max_x / 3)
@@ -72,28 +64,10 @@ class MobileRobot1DGymEnv(MobileRobotGymEnv):
             margin = 0.1 * self._max_x
             x_pos = self.np_random.uniform(self._min_x + margin, self._max_x - margin)
 
-        self.target_uid = p.loadURDF("/urdf/cylinder.urdf", [x_pos, 0, 0], useFixedBase=True)
         self.target_pos = np.array([x_pos, 0, 0])
 
-        # Add walls
-        # Path to the urdf file
-        wall_urdf = "/urdf/wall.urdf"
-        # Rgba color
-        red = [0.8, 0, 0, 1]
-
-        wall_left = p.loadURDF(wall_urdf, [self._max_x / 2, 0, 0], useFixedBase=True)
-        # Change color
-        p.changeVisualShape(wall_left, -1, rgbaColor=red)
-
-        self.walls = [wall_left]
-
-        # Add mobile robot
-        self.robot_uid = p.loadURDF(os.path.join(self._urdf_root, "racecar/racecar.urdf"), self.robot_pos,
-                                    useFixedBase=True)
-
+        self.resetWorld()
         self._env_step_counter = 0
-        for _ in range(50):
-            p.stepSimulation()
 
         self._observation = self.getObservation()
 
@@ -105,6 +79,21 @@ class MobileRobot1DGymEnv(MobileRobotGymEnv):
 
         return np.array(self._observation)
 
+    def loadWalls(self):
+        # Path to the urdf file
+        wall_urdf = "/urdf/wall.urdf"
+        # Rgba color
+        red = [0.8, 0, 0, 1]
+
+        wall_left = p.loadURDF(wall_urdf, [self._max_x / 2, 0, 0], useFixedBase=True)
+        # Change color
+        p.changeVisualShape(wall_left, -1, rgbaColor=red)
+
+        self.walls = [wall_left]
+
+    def drawWalls(self, image):
+        self.top_down_renderer.drawBox(image, [self._max_x / 2, 0, 0], WALL_SIZE, [0.8, 0, 0, 1])
+
     def step(self, action):
         # True if it has bumped against a wall
         self.has_bumped = False
@@ -131,9 +120,7 @@ class MobileRobot1DGymEnv(MobileRobotGymEnv):
                 self.robot_pos = previous_pos
                 break
         # Update mobile robot position
-        p.resetBasePositionAndOrientation(self.robot_uid, self.robot_pos, [0, 0, 0, 1])
-
-        p.stepSimulation()
+        self.moveRobot()
         self._env_step_counter += 1
 
         self._observation = self.getObservation()
@@ -26,6 +26,8 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
     :param pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param fpv: (bool) enable first person view camera
     :param srl_model: (str) The SRL_model used
+    :param fast_reset: (bool) build the static scene only once, then only move the robot and the target at each reset
+    :param backend: (str) "pybullet" or "numpy" (rasterized top-down camera, without physics server)
     """
     def __init__(self, name="mobile_robot_2target", **kwargs):
         super(MobileRobot2TargetGymEnv, self).__init__(name=name, **kwargs)
@@ -35,11 +37,6 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
     def reset(self):
         self.current_target = 0
         self.terminated = False
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, 0])
-        p.setGravity(0, 0, -10)
 
         # Init the robot randomly
         x_start = self._max_x / 2 + self.np_random.uniform(- self._max_x / 3, self._max_x / 3)
@@ -47,7 +44,6 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
         self.robot_pos = np.array([x_start, y_start, 0])
 
         # Initialize target position
-        self.button_uid = []
         self.button_pos = []
 
         x_pos = 0.9 * self._max_x
@@ -56,7 +52,7 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
             margin = 0.1 * self._max_x
             x_pos = self.np_random.uniform(self._min_x + margin, self._max_x - margin)
             y_pos = self.np_random.uniform(self._min_y + margin, self._max_y - margin)
-        self.button_uid.append(p.loadURDF("/urdf/cylinder.urdf", [x_pos, y_pos, 0], useFixedBase=True))
+
         self.button_pos.append(np.array([x_pos, y_pos, 0]))
 
         x_pos = 0.1 * self._max_x
@@ -65,41 +61,11 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
             margin = 0.1 * self._max_x
             x_pos = self.np_random.uniform(self._min_x + margin, self._max_x - margin)
             y_pos = self.np_random.uniform(self._min_y + margin, self._max_y - margin)
-        self.button_uid.append(p.loadURDF("/urdf/cylinder.urdf", [x_pos, y_pos, 0], useFixedBase=True))
-        self.button_pos.append(np.array([x_pos, y_pos, 0]))
-        # Change color to red for the second button
-        p.changeVisualShape(self.button_uid[-1], -1, rgbaColor=[0.8, 0, 0, 1])
-
-        # Add walls
-        # Path to the urdf file
-        wall_urdf = "/urdf/wall.urdf"
-        # RGBA (red, green, blue, alpha) colors
-        red, green, blue = [0.8, 0, 0, 1], [0, 0.8, 0, 1], [0, 0, 0.8, 1]
-
-        wall_left = p.loadURDF(wall_urdf, [self._max_x / 2, 0, 0], useFixedBase=True)
-        # Change color
-        p.changeVisualShape(wall_left, -1, rgbaColor=red)
-
-        # getQuaternionFromEuler -> define orientation
-        wall_bottom = p.loadURDF(wall_urdf, [self._max_x, self._max_y / 2, 0],
-                                 p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
-
-        wall_right = p.loadURDF(wall_urdf, [self._max_x / 2, self._max_y, 0], useFixedBase=True)
-        p.changeVisualShape(wall_right, -1, rgbaColor=green)
-
-        wall_top = p.loadURDF(wall_urdf, [self._min_x, self._max_y / 2, 0],
-                              p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
-        p.changeVisualShape(wall_top, -1, rgbaColor=blue)
 
-        self.walls = [wall_left, wall_bottom, wall_right, wall_top]
-
-        # Add mobile robot
-        self.robot_uid = p.loadURDF(os.path.join(self._urdf_root, "racecar/racecar.urdf"), self.robot_pos,
-                                    useFixedBase=True)
+        self.button_pos.append(np.array([x_pos, y_pos, 0]))
 
+        self.resetWorld()
         self._env_step_counter = 0
-        for _ in range(50):
-            p.stepSimulation()
 
         self._observation = self.getObservation()
 
@@ -111,6 +77,20 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
 
         return np.array(self._observation)
 
+    def loadTarget(self):
+        self.button_uid = [p.loadURDF("/urdf/cylinder.urdf", pos, useFixedBase=True) for pos in self.button_pos]
+        # Change color to red for the second button
+        p.changeVisualShape(self.button_uid[-1], -1, rgbaColor=[0.8, 0, 0, 1])
+
+    def moveTarget(self):
+        for uid, pos in zip(self.button_uid, self.button_pos):
+            p.resetBasePositionAndOrientation(uid, pos, [0, 0, 0, 1])
+
+    def drawTarget(self, image):
+        colors = [[1, 1, 0, 1]] * (len(self.button_pos) - 1) + [[0.8, 0, 0, 1]]
+        for (x_pos, y_pos, _), color in zip(self.button_pos, colors):
+            self.top_down_renderer.drawDisc(image, [x_pos, y_pos, TARGET_HEIGHT], TARGET_RADIUS, color)
+
     def getTargetPos(self):
         # Return only the [x, y] coordinates
         return self.button_pos[self.current_target][:2]
@@ -142,9 +122,7 @@ class MobileRobot2TargetGymEnv(MobileRobotGymEnv):
                 self.robot_pos = previous_pos
                 break
         # Update mobile robot position
-        p.resetBasePositionAndOrientation(self.robot_uid, self.robot_pos, [0, 0, 0, 1])
-
-        p.stepSimulation()
+        self.moveRobot()
         self._env_step_counter += 1
 
         self._observation = self.getObservation()
@@ -6,6 +6,8 @@ import torch as th
 import pybullet_data
 from gym import spaces
 
+from environments.camera import PyBulletCamera, loadRenderer, renderCameras
+from environments.mobile_robot.top_down_renderer import TopDownRenderer
 from environments.srl_env import SRLGymEnv
 from state_representation.episode_saver import EpisodeSaver
 
@@ -26,6 +28,11 @@ CONNECTED_TO_SIMULATOR = False
 # From urdf file, to create bounding box
 ROBOT_WIDTH = 0.2
 ROBOT_LENGTH = 0.325 * 2
+# Wall and target geometry (see urdf/wall.urdf and urdf/cylinder.urdf), used by the numpy backend
+WALL_SIZE = (4, 0.1, 0.1)
+TARGET_RADIUS = 0.18
+TARGET_HEIGHT = 0.03
+BACKENDS = ["pybullet", "numpy"]
 
 
 def getGlobals():
@@ -56,12 +63,21 @@ class MobileRobotGymEnv(SRLGymEnv):
     :param pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param fpv: (bool) enable first person view camera
     :param srl_model: (str) The SRL_model used
+    :param renderer: (str) renderer used for the camera images: "tiny", "opengl" or "egl" (see environments/camera.py)
+    :param fast_reset: (bool) build the static scene only once, then only move the robot and the target at each reset
+    :param backend: (str) "pybullet" or "numpy": the numpy backend does not start a physics server,
+        the top-down camera image is rasterized with array operations (see top_down_renderer.py)
+    NOTE: when the observation is the ground truth and no data is recorded,
+    the camera image is not rendered at each step (see getObservation)
     """
+    # Target of the top-down camera (and initial value of its debug sliders)
+    CAMERA_TARGET_POS = (2, 2, 0)
 
     def __init__(self, urdf_root=pybullet_data.getDataPath(), renders=False, is_discrete=True,
                  name="mobile_robot", max_distance=1.6, shape_reward=False, record_data=False, srl_model="raw_pixels",
                  random_target=False, force_down=True, state_dim=-1, learn_states=False, verbose=False,
-                 save_path='srl_zoo/data/', env_rank=0, srl_pipe=None, fpv=False,  **_):
+                 save_path='srl_zoo/data/', env_rank=0, srl_pipe=None, fpv=False, renderer="tiny",
+                 fast_reset=False, backend="pybullet", **_):
         super(MobileRobotGymEnv, self).__init__(srl_model=srl_model,
                                                 relative_pos=RELATIVE_POS,
                                                 env_rank=env_rank,
@@ -73,18 +89,15 @@ class MobileRobotGymEnv(SRLGymEnv):
         self._renders = renders
         self._width = RENDER_WIDTH
         self._height = RENDER_HEIGHT
-        self._cam_dist = 4.4
-        self._cam_yaw = 90
-        self._cam_pitch = -90
-        self._cam_roll = 0
         self._max_distance = max_distance
         self._shape_reward = shape_reward
         self._random_target = random_target
         self._force_down = force_down
-        self.camera_target_pos = (2, 2, 0)
         self._is_discrete = is_discrete
         self.terminated = False
-        self.renderer = p.ER_TINY_RENDERER
+        self.renderer = None
+        self.camera = None
+        self.fpv_camera = None
         self.debug = False
         self.n_contacts = 0
         self.state_dim = state_dim
@@ -105,31 +118,43 @@ class MobileRobotGymEnv(SRLGymEnv):
         self.walls = None
         self.fpv = fpv
         self.srl_model = srl_model
+        self._fast_reset = fast_reset
+        assert backend in BACKENDS, "Error: unknown backend {}, choose one of {}".format(backend, BACKENDS)
+        self.backend = backend
+        self.top_down_renderer = None
+        # Static part of the numpy backend image (floor, walls and target), drawn at each reset
+        self._scene = None
 
         if record_data:
             self.saver = EpisodeSaver(name, max_distance, state_dim, globals_=getGlobals(), relative_pos=RELATIVE_POS,
                                       learn_states=learn_states, path=save_path)
 
-        if self._renders:
+        if self.backend == "numpy":
+            assert not (self._renders or self.fpv), "Error: the numpy backend only supports the top-down camera, " \
+                                                    "without GUI"
+        elif self._renders:
             client_id = p.connect(p.SHARED_MEMORY)
             if client_id < 0:
                 p.connect(p.GUI)
             p.resetDebugVisualizerCamera(1.3, 180, -41, [0.52, -0.2, -0.33])
-
             self.debug = True
-            # Debug sliders for moving the camera
-            self.x_slider = p.addUserDebugParameter("x_slider", -10, 10, self.camera_target_pos[0])
-            self.y_slider = p.addUserDebugParameter("y_slider", -10, 10, self.camera_target_pos[1])
-            self.z_slider = p.addUserDebugParameter("z_slider", -10, 10, self.camera_target_pos[2])
-            self.dist_slider = p.addUserDebugParameter("cam_dist", 0, 10, self._cam_dist)
-            self.yaw_slider = p.addUserDebugParameter("cam_yaw", -180, 180, self._cam_yaw)
-            self.pitch_slider = p.addUserDebugParameter("cam_pitch", -180, 180, self._cam_pitch)
-
         else:
             p.connect(p.DIRECT)
 
-        global CONNECTED_TO_SIMULATOR
-        CONNECTED_TO_SIMULATOR = True
+        if self.backend == "pybullet":
+            global CONNECTED_TO_SIMULATOR
+            CONNECTED_TO_SIMULATOR = True
+
+        self.renderer = loadRenderer(renderer)
+        # Top-down camera
+        self.camera = PyBulletCamera(self.CAMERA_TARGET_POS, distance=4.4, yaw=90, pitch=-90,
+                                     width=RENDER_WIDTH, height=RENDER_HEIGHT, renderer=self.renderer)
+        # First person view camera, it follows the robot (see render())
+        self.fpv_camera = PyBulletCamera((0, 0, 0.15), distance=0.3, yaw=90, pitch=-17, fov=90,
+                                         width=RENDER_WIDTH, height=RENDER_HEIGHT, renderer=self.renderer)
+        if self.debug:
+            # Debug sliders for moving the camera
+            self.camera.addDebugSliders()
 
         if self._is_discrete:
             self.action_space = spaces.Discrete(N_DISCRETE_ACTIONS)
@@ -144,6 +169,10 @@ class MobileRobotGymEnv(SRLGymEnv):
         else:
             self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(self.state_dim,), dtype=np.float32)
 
+        # Lazy observation: skip the camera rendering when the image is neither used
+        # by the policy/SRL model nor recorded (it can still be obtained with render())
+        self.lazy_obs = self.srl_model == "ground_truth" and not record_data
+
     def getTargetPos(self):
         # Return only the [x, y] coordinates
         return self.target_pos[:2]
@@ -158,11 +187,6 @@ class MobileRobotGymEnv(SRLGymEnv):
 
     def reset(self):
         self.terminated = False
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, 0])
-        p.setGravity(0, 0, -10)
 
         # Init the robot randomly
         x_start = self._max_x / 2 + self.np_random.uniform(- self._max_x / 3, self._max_x / 3)
@@ -177,10 +201,74 @@ class MobileRobotGymEnv(SRLGymEnv):
             x_pos = self.np_random.uniform(self._min_x + margin, self._max_x - margin)
             y_pos = self.np_random.uniform(self._min_y + margin, self._max_y - margin)
 
-        self.target_uid = p.loadURDF("/urdf/cylinder.urdf", [x_pos, y_pos, 0], useFixedBase=True)
         self.target_pos = np.array([x_pos, y_pos, 0])
 
-        # Add walls
+        self.resetWorld()
+        self._env_step_counter = 0
+
+        self._observation = self.getObservation()
+
+        if self.saver is not None:
+            self.saver.reset(self._observation, self.getTargetPos(), self.getGroundTruth())
+
+        if self.srl_model != "raw_pixels":
+            return self.getSRLState(self._observation)
+
+        return np.array(self._observation)
+
+    def resetWorld(self):
+        """
+        Place the robot and the target at self.robot_pos and self.target_pos.
+        The whole scene is rebuilt, unless fast reset is enabled and the static geometry is already loaded:
+        then the robot and the target are only moved.
+        With the numpy backend, the static part of the camera image is drawn instead.
+        """
+        if self.backend == "numpy":
+            if self.top_down_renderer is None:
+                self.top_down_renderer = TopDownRenderer(self.camera.target_pos, self.camera.distance, self.camera.fov,
+                                                         width=RENDER_WIDTH, height=RENDER_HEIGHT)
+            self._scene = self.top_down_renderer.floor()
+            self.drawWalls(self._scene)
+            self.drawTarget(self._scene)
+            return
+
+        if self._fast_reset and self.robot_uid is not None:
+            self.moveTarget()
+            p.resetBasePositionAndOrientation(self.robot_uid, self.robot_pos, [0, 0, 0, 1])
+            return
+
+        p.resetSimulation()
+        p.setPhysicsEngineParameter(numSolverIterations=150)
+        p.setTimeStep(self._timestep)
+        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, 0])
+        p.setGravity(0, 0, -10)
+
+        self.loadTarget()
+        self.loadWalls()
+
+        # Add mobile robot
+        self.robot_uid = p.loadURDF(os.path.join(self._urdf_root, "racecar/racecar.urdf"), self.robot_pos,
+                                    useFixedBase=True)
+
+        for _ in range(50):
+            p.stepSimulation()
+
+    def loadTarget(self):
+        """
+        Add the target to the scene, at self.target_pos
+        """
+        self.target_uid = p.loadURDF("/urdf/cylinder.urdf", self.target_pos, useFixedBase=True)
+
+    def moveTarget(self):
+        """
+        Move the target (already in the scene) to self.target_pos
+        """
+        p.resetBasePositionAndOrientation(self.target_uid, self.target_pos, [0, 0, 0, 1])
+
+    def loadWalls(self):
+        """
+        Add the walls to the scene
+        """
         # Path to the urdf file
         wall_urdf = "/urdf/wall.urdf"
         # Rgba colors
@@ -203,32 +291,45 @@ class MobileRobotGymEnv(SRLGymEnv):
 
         self.walls = [wall_left, wall_bottom, wall_right, wall_top]
 
-        # Add mobile robot
-        self.robot_uid = p.loadURDF(os.path.join(self._urdf_root, "racecar/racecar.urdf"), self.robot_pos,
-                                    useFixedBase=True)
-
-        self._env_step_counter = 0
-        for _ in range(50):
-            p.stepSimulation()
-
-        self._observation = self.getObservation()
-
-        if self.saver is not None:
-            self.saver.reset(self._observation, self.getTargetPos(), self.getGroundTruth())
+    def drawWalls(self, image):
+        """
+        Draw the walls on the top-down camera image (numpy backend), same layout as loadWalls()
+        :param image: (numpy array)
+        """
+        red, green, blue, black = [0.8, 0, 0, 1], [0, 0.8, 0, 1], [0, 0, 0.8, 1], [0, 0, 0, 1]
+        self.top_down_renderer.drawBox(image, [self._max_x / 2, 0, 0], WALL_SIZE, red)
+        self.top_down_renderer.drawBox(image, [self._max_x, self._max_y / 2, 0], WALL_SIZE, black, yaw=np.pi / 2)
+        self.top_down_renderer.drawBox(image, [self._max_x / 2, self._max_y, 0], WALL_SIZE, green)
+        self.top_down_renderer.drawBox(image, [self._min_x, self._max_y / 2, 0], WALL_SIZE, blue, yaw=np.pi / 2)
 
-        if self.srl_model != "raw_pixels":
-            return self.getSRLState(self._observation)
+    def drawTarget(self, image):
+        """
+        Draw the target on the top-down camera image (numpy backend), at self.target_pos
+        :param image: (numpy array)
+        """
+        x_pos, y_pos, _ = self.target_pos
+        self.top_down_renderer.drawDisc(image, [x_pos, y_pos, TARGET_HEIGHT], TARGET_RADIUS, [1, 1, 0, 1])
 
-        return np.array(self._observation)
+    def moveRobot(self):
+        """
+        Move the robot (already in the scene) to self.robot_pos and step the simulation
+        """
+        if self.backend == "numpy":
+            return
+        p.resetBasePositionAndOrientation(self.robot_uid, self.robot_pos, [0, 0, 0, 1])
+        p.stepSimulation()
 
     def __del__(self):
-        if CONNECTED_TO_SIMULATOR:
+        if CONNECTED_TO_SIMULATOR and self.backend == "pybullet":
             p.disconnect()
 
     def getObservation(self):
         """
-        :return: (numpy array)
+        :return: (numpy array) the camera image, None in lazy observation mode
         """
+        if self.lazy_obs:
+            self._observation = None
+            return self._observation
         self._observation = self.render("rgb_array")
         return self._observation
 
@@ -262,9 +363,7 @@ class MobileRobotGymEnv(SRLGymEnv):
                 self.robot_pos = previous_pos
                 break
         # Update mobile robot position
-        p.resetBasePositionAndOrientation(self.robot_uid, self.robot_pos, [0, 0, 0, 1])
-
-        p.stepSimulation()
+        self.moveRobot()
         self._env_step_counter += 1
 
         self._observation = self.getObservation()
@@ -282,63 +381,24 @@ class MobileRobotGymEnv(SRLGymEnv):
     def render(self, mode='human', close=False):
         if mode != "rgb_array":
             return np.array([])
-        camera_target_pos = self.camera_target_pos
-
+        if self.backend == "numpy":
+            return self.top_down_renderer.render(self._scene[None], self.robot_pos[None, :2])[0]
         if self.debug:
-            self._cam_dist = p.readUserDebugParameter(self.dist_slider)
-            self._cam_yaw = p.readUserDebugParameter(self.yaw_slider)
-            self._cam_pitch = p.readUserDebugParameter(self.pitch_slider)
-            x = p.readUserDebugParameter(self.x_slider)
-            y = p.readUserDebugParameter(self.y_slider)
-            z = p.readUserDebugParameter(self.z_slider)
-            camera_target_pos = (x, y, z)
-
-        # TODO: recompute view_matrix and proj_matrix only in debug mode
-        view_matrix = p.computeViewMatrixFromYawPitchRoll(
-            cameraTargetPosition=camera_target_pos,
-            distance=self._cam_dist,
-            yaw=self._cam_yaw,
-            pitch=self._cam_pitch,
-            roll=self._cam_roll,
-            upAxisIndex=2)
-        proj_matrix = p.computeProjectionMatrixFOV(
-            fov=60, aspect=float(RENDER_WIDTH) / RENDER_HEIGHT,
-            nearVal=0.1, farVal=100.0)
-        (_, _, px1, _, _) = p.getCameraImage(
-            width=RENDER_WIDTH, height=RENDER_HEIGHT, viewMatrix=view_matrix,
-            projectionMatrix=proj_matrix, renderer=self.renderer)
-        rgb_array = np.array(px1)
-
-        rgb_array_res = rgb_array[:, :, :3]
+            self.camera.readDebugSliders()
 
         # if first person view, then stack the obersvation from the car camera
         if self.fpv:
             # move camera
-            view_matrix = p.computeViewMatrixFromYawPitchRoll(
-                cameraTargetPosition=(self.robot_pos[0]-0.25, self.robot_pos[1], 0.15),
-                distance=0.3,
-                yaw=self._cam_yaw,
-                pitch=-17,
-                roll=self._cam_roll,
-                upAxisIndex=2)
-            proj_matrix = p.computeProjectionMatrixFOV(
-                fov=90, aspect=float(RENDER_WIDTH) / RENDER_HEIGHT,
-                nearVal=0.1, farVal=100.0)
-            # get and stack image
-            (_, _, px1, _, _) = p.getCameraImage(
-                width=RENDER_WIDTH, height=RENDER_HEIGHT, viewMatrix=view_matrix,
-                projectionMatrix=proj_matrix, renderer=self.renderer)
-            rgb_array = np.array(px1)
-            rgb_array_res = np.dstack([rgb_array_res, rgb_array[:, :, :3]])
-
-        return rgb_array_res
+            self.fpv_camera.update(target_pos=(self.robot_pos[0] - 0.25, self.robot_pos[1], 0.15),
+                                   yaw=self.camera.yaw)
+            return renderCameras([self.camera, self.fpv_camera])
+        return renderCameras([self.camera])
 
     def _termination(self):
         """
         :return: (bool)
         """
         if self.terminated or self._env_step_counter > self.max_steps:
-            self._observation = self.getObservation()
             return True
         return False
 
@@ -2,6 +2,7 @@ from .mobile_robot_env import *
 
 REWARD_DIST_THRESHOLD = 0.1
 ROBOT_OFFSET = 0.2  # Take into account the robot length for computing distance to target
+TARGET_WALL_SIZE = (4, 0.5, 0.1)  # From urdf/wall_target.urdf
 
 
 class MobileRobotLineTargetGymEnv(MobileRobotGymEnv):
@@ -27,6 +28,8 @@ class MobileRobotLineTargetGymEnv(MobileRobotGymEnv):
     :param pipe: (Queue, [Queue]) contains the input and output of the SRL model
     :param fpv: (bool) enable first person view camera
     :param srl_model: (str) The SRL_model used
+    :param fast_reset: (bool) build the static scene only once, then only move the robot and the target at each reset
+    :param backend: (str) "pybullet" or "numpy" (rasterized top-down camera, without physics server)
     """
 
     def __init__(self, name="mobile_robot_line_target", **kwargs):
@@ -41,11 +44,6 @@ class MobileRobotLineTargetGymEnv(MobileRobotGymEnv):
 
     def reset(self):
         self.terminated = False
-        p.resetSimulation()
-        p.setPhysicsEngineParameter(numSolverIterations=150)
-        p.setTimeStep(self._timestep)
-        p.loadURDF(os.path.join(self._urdf_root, "plane.urdf"), [0, 0, 0])
-        p.setGravity(0, 0, -10)
 
         # Init the robot randomly
         x_start = self._max_x / 2 + self.np_random.uniform(- self._max_x / 3, self._max_x / 3)
@@ -59,41 +57,10 @@ class MobileRobotLineTargetGymEnv(MobileRobotGymEnv):
             margin = 0.1 * self._max_x
             x_pos = self.np_random.uniform(self._min_x + margin, self._max_x - margin)
 
-        self.target_uid = p.loadURDF("/urdf/wall_target.urdf", [x_pos, y_pos / 2, -0.045],
-                                     p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
         self.target_pos = np.array([x_pos, y_pos, 0])
-        p.changeVisualShape(self.target_uid, -1, rgbaColor=[1, 1, 0, 1])  # yellow
-
-        # Add walls
-        # Path to the urdf file
-        wall_urdf = "/urdf/wall.urdf"
-        # Rgba colors
-        red, green, blue = [0.8, 0, 0, 1], [0, 0.8, 0, 1], [0, 0, 0.8, 1]
-
-        wall_left = p.loadURDF(wall_urdf, [self._max_x / 2, 0, 0], useFixedBase=True)
-        # Change color
-        p.changeVisualShape(wall_left, -1, rgbaColor=red)
-
-        # getQuaternionFromEuler -> define orientation
-        wall_bottom = p.loadURDF(wall_urdf, [self._max_x, self._max_y / 2, 0],
-                                 p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
-
-        wall_right = p.loadURDF(wall_urdf, [self._max_x / 2, self._max_y, 0], useFixedBase=True)
-        p.changeVisualShape(wall_right, -1, rgbaColor=green)
-
-        wall_top = p.loadURDF(wall_urdf, [self._min_x, self._max_y / 2, 0],
-                              p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
-        p.changeVisualShape(wall_top, -1, rgbaColor=blue)
-
-        self.walls = [wall_left, wall_bottom, wall_right, wall_top]
-
-        # Add mobile robot
-        self.robot_uid = p.loadURDF(os.path.join(self._urdf_root, "racecar/racecar.urdf"), self.robot_pos,
-                                    useFixedBase=True)
 
+        self.resetWorld()
         self._env_step_counter = 0
-        for _ in range(50):
-            p.stepSimulation()
 
         self._observation = self.getObservation()
 
@@ -105,6 +72,21 @@ class MobileRobotLineTargetGymEnv(MobileRobotGymEnv):
 
         return np.array(self._observation)
 
+    def loadTarget(self):
+        x_pos, y_pos, _ = self.target_pos
+        self.target_uid = p.loadURDF("/urdf/wall_target.urdf", [x_pos, y_pos / 2, -0.045],
+                                     p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True)
+        p.changeVisualShape(self.target_uid, -1, rgbaColor=[1, 1, 0, 1])  # yellow
+
+    def moveTarget(self):
+        x_pos, y_pos, _ = self.target_pos
+        p.resetBasePositionAndOrientation(self.target_uid, [x_pos, y_pos / 2, -0.045],
+                                          p.getQuaternionFromEuler([0, 0, np.pi / 2]))
+
+    def drawTarget(self, image):
+        x_pos, y_pos, _ = self.target_pos
+        self.top_down_renderer.drawBox(image, [x_pos, y_pos / 2, -0.045], TARGET_WALL_SIZE, [1, 1, 0, 1], yaw=np.pi / 2)
+
     def _reward(self):
         """
         :return: (float)
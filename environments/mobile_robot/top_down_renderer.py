@@ -0,0 +1,148 @@
+"""
+NumPy rasterizer for the top-down camera of the mobile robot environments.
+It draws the same scene as the PyBullet camera (checkered floor, walls, target and robot)
+using array operations only, so the environments can run without a physics server (backend="numpy").
+"""
+import numpy as np
+
+# Colors measured on the PyBullet tiny renderer images:
+# top faces are lit with an intensity of 239 / 255, visible side faces are darker
+FLOOR_COLORS = (np.array([239, 239, 239], dtype=np.uint8), np.array([162, 186, 224], dtype=np.uint8))
+TOP_INTENSITY = 239
+SIDE_INTENSITY = 153
+ROBOT_BODY_COLOR = np.array([0, 0, 191], dtype=np.uint8)
+ROBOT_WHEEL_COLOR = np.array([40, 40, 40], dtype=np.uint8)
+# Racecar footprint, relative to its base position: (x_min, x_max, y_min, y_max)
+ROBOT_BODY = (-0.07, 0.34, -0.09, 0.09)
+ROBOT_WHEELS = [(-0.07, 0.02, -0.16, -0.09), (-0.07, 0.02, 0.09, 0.16),
+                (0.23, 0.39, -0.16, -0.09), (0.23, 0.39, 0.09, 0.16)]
+# Height used to project the robot
+ROBOT_HEIGHT = 0.0
+
+
+def shadeColor(rgba, intensity):
+    """
+    :param rgba: ([float]) color in [0, 1], as used by p.changeVisualShape
+    :param intensity: (int) intensity of the light on the face
+    :return: (numpy array) uint8 RGB color
+    """
+    return (np.array(rgba[:3]) * intensity).astype(np.uint8)
+
+
+class TopDownRenderer(object):
+    """
+    Rasterize the scene seen by a camera looking straight down (yaw=90, pitch=-90, see environments/camera.py).
+    Each pixel is mapped to the world point it sees at a given height,
+    so an axis-aligned box or a disc is drawn with a few comparisons on the whole image.
+    :param target_pos: ((float, float, float)) position the camera is looking at
+    :param distance: (float) distance from the camera to the target
+    :param fov: (float) field of view, in degrees
+    :param width: (int)
+    :param height: (int)
+    """
+
+    def __init__(self, target_pos, distance, fov=60, width=224, height=224):
+        self.target_pos = tuple(target_pos)
+        self.distance = distance
+        self.width = width
+        self.height = height
+        # Half the size of the ground area seen by the camera, at the height of the target
+        half_size = distance * np.tan(np.radians(fov) / 2)
+        # Normalized coordinates of the pixels, in [-1, 1]:
+        # like the PyBullet tiny renderer, each pixel is sampled at its bottom-left corner
+        cols = 2 * np.arange(width) / width - 1
+        rows = 1 - 2 * (np.arange(height) + 1) / height
+        # The camera x-axis is the world y-axis and the camera y-axis is the world -x axis
+        self._dx = (- rows * half_size * height / width)[:, None]
+        self._dy = (cols * half_size)[None, :]
+        self._grids = {}
+        self._floor = None
+
+    def grid(self, z):
+        """
+        :param z: (float) height in the world frame
+        :return: ((numpy array, numpy array)) world x (column vector) and y (row vector) seen by each pixel at height z
+        """
+        if z not in self._grids:
+            scale = (self.distance - (z - self.target_pos[2])) / self.distance
+            self._grids[z] = (self.target_pos[0] + self._dx * scale, self.target_pos[1] + self._dy * scale)
+        return self._grids[z]
+
+    def floor(self):
+        """
+        :return: (numpy array) image of the checkered ground plane (1m x 1m squares), of shape (height, width, 3)
+        """
+        if self._floor is None:
+            x, y = self.grid(0.0)
+            odd = (np.floor(x) + np.floor(y)) % 2 == 1
+            self._floor = np.where(odd[:, :, None], FLOOR_COLORS[1], FLOOR_COLORS[0])
+        return self._floor.copy()
+
+    def boxMask(self, x_min, x_max, y_min, y_max, z):
+        """
+        :param x_min: (float)
+        :param x_max: (float)
+        :param y_min: (float)
+        :param y_max: (float)
+        :param z: (float) height of the face
+        :return: (numpy bool array) pixels covered by the horizontal rectangle at height z
+        """
+        x, y = self.grid(z)
+        return ((x >= x_min) & (x <= x_max)) & ((y >= y_min) & (y <= y_max))
+
+    def drawBox(self, image, center, size, rgba, yaw=0.0):
+        """
+        Draw an axis-aligned box: its side faces, then its top face
+        :param image: (numpy array) image to draw on, modified in place
+        :param center: ((float, float, float)) position of the center of the box
+        :param size: ((float, float, float)) size of the box along its own axes
+        :param rgba: ([float]) color in [0, 1]
+        :param yaw: (float) orientation of the box, only multiples of pi / 2 are supported
+        """
+        assert np.isclose(np.sin(2 * yaw), 0), "Error: only axis-aligned boxes are supported"
+        size_x, size_y, size_z = size
+        if not np.isclose(np.cos(yaw) ** 2, 1):
+            size_x, size_y = size_y, size_x
+        x_min, x_max = center[0] - size_x / 2, center[0] + size_x / 2
+        y_min, y_max = center[1] - size_y / 2, center[1] + size_y / 2
+        z_min, z_max = center[2] - size_z / 2, center[2] + size_z / 2
+        image[self.boxMask(x_min, x_max, y_min, y_max, z_min)] = shadeColor(rgba, SIDE_INTENSITY)
+        image[self.boxMask(x_min, x_max, y_min, y_max, z_max)] = shadeColor(rgba, TOP_INTENSITY)
+
+    def drawDisc(self, image, center, radius, rgba):
+        """
+        Draw the top face of a cylinder
+        :param image: (numpy array) image to draw on, modified in place
+        :param center: ((float, float, float)) position of the center of the top face
+        :param radius: (float)
+        :param rgba: ([float]) color in [0, 1]
+        """
+        x, y = self.grid(center[2])
+        image[(x - center[0]) ** 2 + (y - center[1]) ** 2 <= radius ** 2] = shadeColor(rgba, TOP_INTENSITY)
+
+    def drawRobots(self, images, robot_pos):
+        """
+        Draw the racecar on a batch of images, without any loop over the batch
+        :param images: (numpy array) of shape (n_envs, height, width, 3), modified in place
+        :param robot_pos: (numpy array) of shape (n_envs, 2), [x, y] positions of the robots
+        :return: (numpy array) the images
+        """
+        x, y = self.grid(ROBOT_HEIGHT)
+        # Position of each pixel relative to each robot, shapes (n_envs, height, 1) and (n_envs, 1, width)
+        rel_x = x[None] - robot_pos[:, 0, None, None]
+        rel_y = y[None] - robot_pos[:, 1, None, None]
+        for parts, color in [(ROBOT_WHEELS, ROBOT_WHEEL_COLOR), ([ROBOT_BODY], ROBOT_BODY_COLOR)]:
+            mask = np.zeros((len(robot_pos), self.height, self.width), dtype=bool)
+            for x_min, x_max, y_min, y_max in parts:
+                mask |= (rel_x >= x_min) & (rel_x <= x_max) & (rel_y >= y_min) & (rel_y <= y_max)
+            images[mask] = color
+        return images
+
+    def render(self, scenes, robot_pos):
+        """
+        Render a batch of frames
+        :param scenes: (numpy array) of shape (n_envs, height, width, 3), the static part of each scene
+        :param robot_pos: (numpy array) of shape (n_envs, 2)
+        :return: (numpy array) uint8 images of shape (n_envs, height, width, 3)
+        """
+        return self.drawRobots(np.array(scenes, dtype=np.uint8), np.asarray(robot_pos, dtype=np.float64))
@@ -0,0 +1,357 @@
+"""
+Batched version of the OmniRobot simulator: N simulated robots stepped as one VecEnv, in a single process
+"""
+import csv
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from gym import spaces
+from stable_baselines.common.vec_env import VecEnv
+
+from environments.omnirobot_gym.omnirobot_env import RENDER_HEIGHT, RENDER_WIDTH, RELATIVE_POS, N_DISCRETE_ACTIONS
+from real_robots.constants import *
+from real_robots.omnirobot_utils.utils import RingBox
+
+assert USING_OMNIROBOT_SIMULATOR, "Please set USING_OMNIROBOT_SIMULATOR to True in real_robots/constants.py"
+from real_robots.omnirobot_simulator_server import OmniRobotSimulatorSocket, NOISE_VAR_ROBOT_POS, \
+    NOISE_VAR_ROBOT_YAW, NOISE_VAR_ENVIRONMENT, NOISE_VAR_ROBOT_SIZE_PROPOTION, NOISE_VAR_TARGET_SIZE_PROPOTION
+
+# Displacement for each discrete action (see Move and OmnirobotManagerBase)
+DISCRETE_DELTAS = np.array([[STEP_DISTANCE, 0], [-STEP_DISTANCE, 0], [0, STEP_DISTANCE], [0, -STEP_DISTANCE]])
+POS_LOW = np.array([MIN_X, MIN_Y])
+POS_HIGH = np.array([MAX_X, MAX_Y])
+
+
+def normalizeAngles(angles):
+    """
+    :param angles: (numpy array) (in rad)
+    :return: (numpy array) the angles in [-pi, pi[ (in rad)
+    """
+    return (angles + np.pi) % (2 * np.pi) - np.pi
+
+
+class OmniRobotSimulatorVecEnv(VecEnv):
+    """
+    Simulate n_envs OmniRobotEnv (with the OmniRobot simulator) as arrays of positions, yaws and targets.
+    The actions and bounds checks are applied to all the robots at once (same rules as OmnirobotManagerBase)
+    and the marker images are composited on a single copy of the background, in one batched pass.
+    It replaces SubprocVecEnv([OmniRobotEnv, ...]), wrapped with a Monitor: the monitor files are written
+    in log_dir, one per rank.
+    :param n_envs: (int)
+    :param seed: (int)
+    :param log_dir: (str) where to write the monitor files, None for no log
+    :param allow_early_resets: (bool) Allow reset before the enviroment is done
+    :param is_discrete: (bool) true if action space is discrete vs continuous
+    :param srl_model: (str) The SRL_model used
+    :param state_dim: (int) When learning states
+    :param random_target: (bool) Set the target to a random position at each episode
+    :param record_data: (bool) not supported, use OmniRobotEnv instead
+    :param srl_pipe: (Queue, [Queue]) contains the input and output of the SRL model
+    """
+
+    def __init__(self, n_envs, seed=0, log_dir=None, allow_early_resets=False, is_discrete=True,
+                 srl_model="raw_pixels", state_dim=-1, random_target=True, record_data=False, srl_pipe=None, **_):
+        assert not record_data, "Error: the batched OmniRobot simulator cannot record data, use OmniRobotEnv"
+        self._is_discrete = is_discrete
+        self._random_target = random_target
+        self.srl_model = srl_model
+        self.srl_pipe = srl_pipe
+        self.allow_early_resets = allow_early_resets
+        self.np_random = np.random.RandomState(seed)
+
+        if is_discrete:
+            action_space = spaces.Discrete(N_DISCRETE_ACTIONS)
+        else:
+            action_space = RingBox(positive_low=ACTION_POSITIVE_LOW, positive_high=ACTION_POSITIVE_HIGH,
+                                   negative_low=ACTION_NEGATIVE_LOW, negative_high=ACTION_NEGATIVE_HIGH,
+                                   shape=np.array([2]), dtype=np.float32)
+        if srl_model == "ground_truth":
+            state_dim = 2
+        if srl_model == "raw_pixels":
+            observation_space = spaces.Box(low=0, high=255, shape=(RENDER_WIDTH, RENDER_HEIGHT, 3), dtype=np.uint8)
+        else:
+            observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(state_dim,), dtype=np.float32)
+        super(OmniRobotSimulatorVecEnv, self).__init__(n_envs, observation_space, action_space)
+
+        # A single simulator is created, to share its background image, camera model and markers
+        simulator = OmniRobotSimulatorSocket(output_size=[RENDER_WIDTH, RENDER_HEIGHT], random_target=random_target)
+        render = simulator.robot
+        self.pos_transformer = render.pos_transformer
+        self.robot_marker = render.robot_render
+        self.target_marker = render.target_render
+        # The markers are drawn on the cropped background, with a margin of half a marker on each side
+        self.margin = max(self.robot_marker.roi_half_length, self.target_marker.roi_half_length)
+        row_min, row_max, col_min, col_max = render.cropped_range
+        self.crop_offset = np.array([col_min, row_min])
+        self.crop_size = (row_max - row_min, col_max - col_min)
+        padded_bg = np.pad(render.bg_img, ((self.margin, self.margin), (self.margin, self.margin), (0, 0)),
+                           mode='constant')
+        self.background = padded_bg[row_min:row_max + 2 * self.margin, col_min:col_max + 2 * self.margin]
+
+        self.robot_pos_cmd = np.zeros((n_envs, 2))
+        self.robot_pos = np.zeros((n_envs, 2))
+        self.robot_yaw = np.zeros(n_envs)
+        # Size of the robot marker, sampled at each reset
+        self.robot_scale = np.ones(n_envs)
+        self.target_pos = np.zeros((n_envs, 2))
+        self.target_yaw = np.zeros(n_envs)
+        # Background with the target, around the target, for each env (it is drawn at each reset)
+        self.target_patches = np.zeros((n_envs, self.target_marker.roi_length, self.target_marker.roi_length, 3),
+                                       dtype=np.uint8)
+        self.target_roi = np.zeros((n_envs, 2), dtype=np.int64)
+        self.episode_idx = np.zeros(n_envs, dtype=np.int64)
+        self.env_step_counter = np.zeros(n_envs, dtype=np.int64)
+        self.rewards = np.zeros(n_envs, dtype=np.float32)
+        self.actions = None
+
+        # Monitor
+        self.t_start = time.time()
+        self.episode_rewards = [[] for _ in range(n_envs)]
+        self.needs_reset = np.ones(n_envs, dtype=bool)
+        self.file_handlers, self.loggers = [], []
+        if log_dir is not None:
+            for rank in range(n_envs):
+                file_handler = open(os.path.join(log_dir, "{}.monitor.csv".format(rank)), "wt")
+                file_handler.write('#%s\n' % json.dumps({"t_start": self.t_start, 'env_id': "OmnirobotEnv-v0"}))
+                logger = csv.DictWriter(file_handler, fieldnames=('r', 'l', 't'))
+                logger.writeheader()
+                file_handler.flush()
+                self.file_handlers.append(file_handler)
+                self.loggers.append(logger)
+
+    def seed(self, seed=None):
+        """
+        :param seed: (int)
+        :return: ([int])
+        """
+        self.np_random.seed(seed)
+        self.action_space.seed(seed)
+        return [seed]
+
+    def phyPosGround2PixelPos(self, positions):
+        """
+        Batched version of PosTransformer.phyPosGround2PixelPos (undistorted image)
+        :param positions: (numpy array) of shape (n, 2), positions on the ground
+        :return: (numpy array) of shape (n, 2), pixel positions (column, row) in the original image
+        """
+        homo_pos = np.concatenate([positions, np.zeros((len(positions), 1)), np.ones((len(positions), 1))], axis=1)
+        pos_coord_cam = np.matmul(homo_pos, self.pos_transformer.ground_2_camera_trans.T)[:, :3]
+        pixel_pos = np.matmul(pos_coord_cam, self.pos_transformer.camera_mat.T)
+        return pixel_pos[:, :2] / pixel_pos[:, 2:]
+
+    def transformMarkers(self, marker, positions, yaws, scales):
+        """
+        Batched version of MarkerRender.transformMarkerImage + generateNoise
+        :param marker: (MarkerRender)
+        :param positions: (numpy array) of shape (n, 2), positions on the ground
+        :param yaws: (numpy array) of shape (n,) (in rad)
+        :param scales: (numpy array) of shape (n,)
+        :return: (numpy array, numpy array, numpy array) upper-left corners of the regions of interest
+            in the margin-padded crop (row, column), marker images (noise included) and marker weights
+        """
+        pixel_pos = self.phyPosGround2PixelPos(positions)
+        fraction, integer = np.modf(pixel_pos)
+        marker_image = marker.marker_image_with_margin
+        height, width = marker_image.shape[:2]
+        center_x, center_y = width / 2, height / 2
+        alpha, beta = scales * np.cos(yaws), scales * np.sin(yaws)
+        # Same as cv2.getRotationMatrix2D, with the translation applied in MarkerRender.transformMarkerImage
+        matrices = np.zeros((len(positions), 2, 3))
+        matrices[:, 0, 0], matrices[:, 0, 1] = alpha, beta
+        matrices[:, 1, 0], matrices[:, 1, 1] = -beta, alpha
+        matrices[:, 0, 2] = (1 - alpha) * center_x - beta * center_y + \
+            fraction[:, 1] + marker.roi_half_length - height / 2
+        matrices[:, 1, 2] = beta * center_x + (1 - alpha) * center_y + \
+            fraction[:, 0] + marker.roi_half_length - width / 2
+
+        # The transformations differ for each marker: OpenCV warps them one by one (a few pixels each),
+        # the blending is then done for all the envs at once
+        noise = np.around(self.np_random.standard_normal((len(positions),) + marker_image.shape) * marker.noise_var)
+        marker_images = np.zeros((len(positions), marker.roi_length, marker.roi_length, 3))
+        marker_weights = np.zeros((len(positions), marker.roi_length, marker.roi_length, 3), dtype=np.float32)
+        for i, matrix in enumerate(matrices):
+            size = (marker.roi_length, marker.roi_length)
+            marker_images[i] = cv2.warpAffine(marker_image, matrix, size) + cv2.warpAffine(noise[i], matrix, size)
+            marker_weights[i] = cv2.warpAffine(marker.marker_weight, matrix, size)
+        corners = integer[:, ::-1].astype(np.int64) - marker.roi_half_length + self.margin
+        corners -= self.crop_offset[::-1]
+        max_corner = np.array(self.background.shape[:2]) - marker.roi_length
+        return np.clip(corners, 0, max_corner), marker_images, marker_weights
+
+    @staticmethod
+    def roiIndices(corners, length):
+        """
+        :param corners: (numpy array) of shape (n, 2), upper-left corners (row, column)
+        :param length: (int) size of the regions of interest
+        :return: (tuple) fancy index selecting the n regions of interest in a batch of images
+        """
+        rows = corners[:, 0, None] + np.arange(length)
+        cols = corners[:, 1, None] + np.arange(length)
+        return np.arange(len(corners))[:, None, None], rows[:, :, None], cols[:, None, :]
+
+    @staticmethod
+    def blend(images, index, marker_images, marker_weights):
+        """
+        Blend the markers in the regions of interest, as in MarkerRender.addMarker
+        :param images: (numpy array) batch of uint8 images, modified in place
+        :param index: (tuple) regions of interest (see roiIndices)
+        :param marker_images: (numpy array)
+        :param marker_weights: (numpy array)
+        """
+        images[index] = marker_images * marker_weights + images[index] * (1.0 - marker_weights)
+
+    def renderTargets(self, env_ids):
+        """
+        Draw the targets on the background, for the given envs
+        :param env_ids: (numpy array)
+        """
+        scales = self.np_random.randn(len(env_ids)) * NOISE_VAR_TARGET_SIZE_PROPOTION + 1.0
+        corners, marker_images, marker_weights = self.transformMarkers(self.target_marker, self.target_pos[env_ids],
+                                                                       self.target_yaw[env_ids], scales)
+        length = self.target_marker.roi_length
+        # The background is shared by all the envs: drop the batch index
+        patches = self.background[self.roiIndices(corners, length)[1:]]
+        self.blend(patches, (slice(None),), marker_images, marker_weights)
+        self.target_patches[env_ids] = patches
+        self.target_roi[env_ids] = corners
+
+    def renderObservations(self):
+        """
+        Draw the targets and the robots of all the envs, then add the luminosity noise and resize the images
+        :return: (numpy array) uint8 RGB images of shape (n_envs, RENDER_HEIGHT, RENDER_WIDTH, 3)
+        """
+        images = np.repeat(self.background[None], self.num_envs, axis=0)
+        images[self.roiIndices(self.target_roi, self.target_marker.roi_length)] = self.target_patches
+        corners, marker_images, marker_weights = self.transformMarkers(self.robot_marker, self.robot_pos,
+                                                                       self.robot_yaw, self.robot_scale)
+        self.blend(images, self.roiIndices(corners, self.robot_marker.roi_length), marker_images, marker_weights)
+
+        height, width = self.crop_size
+        images = np.ascontiguousarray(images[:, self.margin:self.margin + height, self.margin:self.margin + width])
+        # Luminosity noise (see OmniRobotEnvRender.renderEnvLuminosityNoise), the images are stacked vertically
+        # so OpenCV converts them in one call
+        images_lab = cv2.cvtColor(images.reshape(-1, width, 3), cv2.COLOR_BGR2LAB).reshape(images.shape)
+        noise = self.np_random.randn(self.num_envs, 3) * NOISE_VAR_ENVIRONMENT + 1.0
+        # Scaling a uint8 channel is a lookup table of 256 values
+        lookup_tables = (np.arange(256)[None, :, None] * noise[:, None, :]).astype(np.uint8)
+        for image_lab, lookup_table in zip(images_lab, lookup_tables):
+            cv2.LUT(image_lab, lookup_table[:, None, :], dst=image_lab)
+        images = cv2.cvtColor(images_lab.reshape(-1, width, 3), cv2.COLOR_LAB2RGB)
+        # The stacked images have the same scale factor along both axes, so resizing them at once
+        # gives the same result as resizing them one by one
+        images = cv2.resize(images, (RENDER_WIDTH, RENDER_HEIGHT * self.num_envs))
+        return images.reshape(self.num_envs, RENDER_HEIGHT, RENDER_WIDTH, 3)
+
+    def resetEnvs(self, env_ids):
+        """
+        Start a new episode for the given envs (see OmniRobotSimulatorSocket.resetEpisode)
+        :param env_ids: (numpy array)
+        """
+        n_reset = len(env_ids)
+        init_low, init_high = np.array([INIT_MIN_X, INIT_MIN_Y]), np.array([INIT_MAX_X, INIT_MAX_Y])
+        self.robot_pos_cmd[env_ids] = self.np_random.random_sample((n_reset, 2)) * (init_high - init_low) + init_low
+        self.robot_pos[env_ids] = self.robot_pos_cmd[env_ids] + self.np_random.randn(n_reset, 2) * NOISE_VAR_ROBOT_POS
+        self.robot_yaw[env_ids] = normalizeAngles(self.np_random.randn(n_reset) * NOISE_VAR_ROBOT_YAW)
+        self.robot_scale[env_ids] = self.np_random.randn(n_reset) * NOISE_VAR_ROBOT_SIZE_PROPOTION + 1.0
+
+        new_target = env_ids[np.logical_or(self._random_target, self.episode_idx[env_ids] == 0)]
+        if len(new_target) > 0:
+            target_low = np.array([TARGET_MIN_X, TARGET_MIN_Y])
+            target_high = np.array([TARGET_MAX_X, TARGET_MAX_Y])
+            self.target_pos[new_target] = self.np_random.random_sample((len(new_target), 2)) * \
+                (target_high - target_low) + target_low
+            self.target_yaw[new_target] = 2 * np.pi * self.np_random.rand(len(new_target)) - np.pi
+        self.renderTargets(env_ids)
+
+        self.episode_idx[env_ids] += 1
+        self.env_step_counter[env_ids] = 0
+        self.episode_rewards = [[] if i in env_ids else rewards for i, rewards in enumerate(self.episode_rewards)]
+        self.needs_reset[env_ids] = False
+
+    def getObservations(self):
+        """
+        :return: (numpy array) observations of all the envs
+        """
+        if self.srl_model == "raw_pixels":
+            return self.renderObservations()
+        if self.srl_model == "ground_truth":
+            if RELATIVE_POS:
+                return self.robot_pos - self.target_pos
+            return self.robot_pos.copy()
+        # Send all the observations first, so the SRL model can process them in batch
+        observations = self.renderObservations()
+        for env_id, observation in enumerate(observations):
+            self.srl_pipe[0].put((env_id, observation))
+        return np.stack([self.srl_pipe[1][env_id].get() for env_id in range(self.num_envs)])
+
+    def reset(self):
+        if not self.allow_early_resets and not self.needs_reset.all():
+            raise RuntimeError("Tried to reset an environment before done. If you want to allow early resets, "
+                               "use allow_early_resets=True")
+        self.resetEnvs(np.arange(self.num_envs))
+        return self.getObservations()
+
+    def step_async(self, actions):
+        """
+        :param actions: ([int] or [[float]])
+        """
+        self.actions = actions
+
+    def step_wait(self):
+        if self.needs_reset.any():
+            raise RuntimeError("Tried to step environment that needs reset")
+        actions = np.array(self.actions)
+        if self._is_discrete:
+            actions = actions.astype(np.int64).reshape(self.num_envs)
+            assert np.all((actions >= 0) & (actions < N_DISCRETE_ACTIONS)), "Error: invalid action"
+            deltas = DISCRETE_DELTAS[actions]
+            # Only the coordinate that changes is checked
+            checked = deltas != 0
+        else:
+            deltas = actions.reshape(self.num_envs, 2)
+            assert all(self.action_space.contains(delta.astype(np.float32)) for delta in deltas), \
+                "Error: invalid action"
+            checked = np.ones_like(deltas, dtype=bool)
+
+        # Bounds checks, on the current (noisy) position of the robots
+        next_pos = self.robot_pos + deltas
+        in_bounds = np.logical_and(next_pos > POS_LOW, next_pos < POS_HIGH)
+        has_bumped = ~np.all(np.logical_or(in_bounds, ~checked), axis=1)
+        moved = np.where(~has_bumped)[0]
+        self.robot_pos_cmd[moved] += deltas[moved]
+        self.robot_pos[moved] = self.robot_pos_cmd[moved] + self.np_random.randn(len(moved), 2) * NOISE_VAR_ROBOT_POS
+        self.robot_yaw[moved] = normalizeAngles(self.np_random.randn(len(moved)) * NOISE_VAR_ROBOT_YAW)
+
+        distances = np.linalg.norm(self.robot_pos - self.target_pos, axis=1)
+        self.rewards = np.where(distances < DIST_TO_TARGET_THRESHOLD, REWARD_TARGET_REACH,
+                                np.where(has_bumped, REWARD_BUMP_WALL, REWARD_NOTHING)).astype(np.float32)
+        self.env_step_counter += 1
+        dones = self.env_step_counter > MAX_STEPS
+
+        infos = [{} for _ in range(self.num_envs)]
+        for env_id in range(self.num_envs):
+            self.episode_rewards[env_id].append(self.rewards[env_id])
+            if dones[env_id]:
+                self.needs_reset[env_id] = True
+                episode_info = {"r": round(float(sum(self.episode_rewards[env_id])), 6),
+                                "l": len(self.episode_rewards[env_id]),
+                                "t": round(time.time() - self.t_start, 6)}
+                if len(self.loggers) > 0:
+                    self.loggers[env_id].writerow(episode_info)
+                    self.file_handlers[env_id].flush()
+                infos[env_id]['episode'] = episode_info
+
+        # Envs that are done are reset, their observation is the first of the next episode
+        if dones.any():
+            self.resetEnvs(np.where(dones)[0])
+        return self.getObservations(), self.rewards.copy(), dones, infos
+
+    def close(self):
+        for file_handler in self.file_handlers:
+            file_handler.close()
+
+    def get_images(self):
+        return list(self.renderObservations())
@@ -16,6 +16,7 @@ class SRLGymEnv(gym.Env):
         :param relative_pos: (bool) position for ground truth
         :param env_rank: (int) the number ID of the environment
         :param srl_pipe: (Queue, [Queue]) contains the input and output of the SRL model
+            (the input can also be a SharedMemoryObservationQueue, see rl_baselines/utils.py)
         """
         # the * here, means that the rest of the args need to be called as kwargs.
         # This is done to avoid unwanted situations where we might add a parameter
@@ -79,7 +80,9 @@ class SRLGymEnv(gym.Env):
 
     def close(self):
         # TODO: implement close function to close GUI
-        pass
+        # Write the images that are still pending
+        if getattr(self, "saver", None) is not None:
+            self.saver.close()
 
     def step(self, action):
         """
@@ -1,3 +1,4 @@
+import itertools
 import time
 import pickle
 
@@ -10,8 +11,11 @@ from rl_baselines.base_classes import BaseRLObject
 from environments import ThreadingType
 from environments.registry import registered_env
 from environments.utils import makeEnv
-from rl_baselines.utils import loadRunningAverage, MultiprocessSRLModel, softmax
-from srl_zoo.utils import printYellow
+from rl_baselines.evolution_strategies.distributed import Command, ESMaster, ESWorker, WORKER_TIMEOUT
+from rl_baselines.evolution_strategies.noise_table import NoiseTable
+from rl_baselines.evolution_strategies.rollouts import AsyncRollouts
+from rl_baselines.utils import loadRunningAverage, MultiprocessSRLModel, softmax, sampleActions
+from srl_zoo.utils import printGreen, printYellow
 
 
 class ARSModel(BaseRLObject):
@@ -56,6 +60,18 @@ class ARSModel(BaseRLObject):
                             help='Set the maximum update vectors amplitude (mesured in factors of step_size)')
         parser.add_argument('--deterministic', action='store_true', default=False,
                             help='do a deterministic approach for the actions on the output of the policy')
+        parser.add_argument('--async-rollouts', action='store_true', default=False,
+                            help='start the rollouts of a new perturbation as soon as an environment is done, '
+                                 'instead of waiting for the longest episode of the population')
+        parser.add_argument('--master-port', type=int, default=None,
+                            help='run as the master of a distributed training, the rollouts are done by the workers '
+                                 'connecting to this port')
+        parser.add_argument('--master-address', type=str, default=None,
+                            help='run as a rollout worker of a distributed training (e.g. tcp://hostname:7778), '
+                                 'evaluating --num-population perturbations at a time')
+        parser.add_argument('--noise-table-size', type=int, default=int(2.5e7),
+                            help='number of floats in the noise table of the perturbations '
+                                 '(distributed training: generated once per machine, in shared memory)')
         return parser
 
     def getActionProba(self, observation, dones=None, delta=0):
@@ -84,11 +100,27 @@ class ARSModel(BaseRLObject):
         assert self.M is not None, "Error: must train or load model before use"
         action = np.dot(observation, self.M + delta)
 
+        return self.selectAction(action)
+
+    def getPopulationAction(self, observations, params):
+        """
+        Compute the actions of the whole population at once: each observation is multiplied by its own parameters
+        :param observations: (numpy float) of shape (n_envs, obs_dim)
+        :param params: (numpy float) perturbed policies, of shape (n_envs, obs_dim, action_dim)
+        :return: (numpy float) one action per environment
+        """
+        return self.selectAction(np.einsum('ni,nij->nj', observations, params))
+
+    def selectAction(self, action):
+        """
+        :param action: (numpy float) output of the linear policy, of shape (n_envs, action_dim)
+        :return: (numpy float) the actions (sampled or greedy for discrete actions)
+        """
         if not self.continuous_actions:
             if self.deterministic:
                 action = np.argmax(action, axis=1)
             else:
-                action = np.array([np.random.choice(len(a), p=a) for a in softmax(action)])
+                action = sampleActions(softmax(action))
 
         return action
 
@@ -123,21 +155,19 @@ class ARSModel(BaseRLObject):
         return envs
 
     def train(self, args, callback, env_kwargs=None, train_kwargs=None):
-        assert args.top_population <= args.num_population, \
+        is_worker = args.master_address is not None
+        assert is_worker or args.top_population <= args.num_population, \
             "Cannot select top %d, from population of %d." % (args.top_population, args.num_population)
-        assert args.num_population > 1, "The population cannot be less than 2."
-
-        env = self.makeEnv(args, env_kwargs)
+        assert is_worker or args.num_population > 1, "The population cannot be less than 2."
+        assert not (is_worker and args.master_port is not None), \
+            "Error: cannot be both the master (--master-port) and a worker (--master-address)"
+        assert not ((is_worker or args.master_port is not None) and args.srl_model != "raw_pixels" and
+                    args.algo_type == "v2"), \
+            "Error: the running average normalization is not shared between the workers, use --algo-type v1"
 
         # set hyperparameters
         args.__dict__.update(train_kwargs)
 
-        if args.continuous_actions:
-            action_space = np.prod(env.action_space.shape)
-        else:
-            action_space = env.action_space.n
-
-        self.M = np.zeros((np.prod(env.observation_space.shape), action_space))
         self.n_population = args.num_population
         self.top_population = args.top_population
         self.step_size = args.step_size
@@ -147,27 +177,44 @@ class ARSModel(BaseRLObject):
         self.deterministic = args.deterministic
         num_updates = (int(args.num_timesteps) // args.num_population * 2)
 
+        if args.master_port is not None:
+            # the master does not run any environment, the rollouts are done by the workers
+            self.trainMaster(args)
+            return
+
+        env = self.makeEnv(args, env_kwargs)
+
+        if args.continuous_actions:
+            action_space = np.prod(env.action_space.shape)
+        else:
+            action_space = env.action_space.n
+
+        self.M = np.zeros((np.prod(env.observation_space.shape), action_space))
+
+        if is_worker:
+            self.runWorker(args, env)
+            return
+
+        # the perturbations are slices of a read-only noise table, generated once
+        # (private to the process, only the processes of a distributed training share it)
+        noise_table = NoiseTable(args.seed, args.noise_table_size, shared=False)
+
+        if args.async_rollouts:
+            self.trainAsync(env, noise_table, callback, num_updates)
+            return
+
         start_time = time.time()
         step = 0
         while step < num_updates:
             r = np.zeros((self.n_population, 2))
-            delta = np.random.normal(size=(self.n_population,) + self.M.shape)
+            offsets = noise_table.sampleOffsets(np.random, self.n_population, self.M.shape)
             done = np.full((self.n_population * 2,), False)
+            params = self.perturbedParams(noise_table, offsets)
             obs = env.reset()
             while not done.all():
-                actions = []
-                for k in range(self.n_population):
-                    for direction in range(2):
-                        if not done[k * 2 + direction]:
-                            current_obs = obs[k * 2 + direction].reshape(-1)
-                            if direction == 0:
-                                action = self.getAction([current_obs], delta=(self.exploration_noise * delta[k]))[0]
-                            else:
-                                action = self.getAction([current_obs], delta=(-self.exploration_noise * delta[k]))[0]
-
-                            actions.append(action)
-                        else:
-                            actions.append(None)  # do nothing, as we are done
+                actions = list(self.getPopulationAction(obs.reshape(len(obs), -1), params))
+                for env_idx in np.flatnonzero(done):
+                    actions[env_idx] = None  # do nothing, as we are done
 
                 obs, reward, new_done, info = env.step(actions)
                 step += self.n_population
@@ -183,12 +230,241 @@ class ARSModel(BaseRLObject):
                 if (step / self.n_population + 1) % 500 == 0:
                     print("{} steps - {:.2f} FPS".format(step, step / (time.time() - start_time)))
 
-            idx = np.argsort(np.max(r, axis=1))[::-1]
+            self.applyNoiseUpdate(noise_table, self.noiseUpdate(r, offsets))
+
+    def trainAsync(self, env, noise_table, callback, num_updates):
+        """
+        Asynchronous training loop: each environment starts the rollout of a new perturbation as soon as it is done
+        (see AsyncRollouts), M is updated every n_population complete pairs of rollouts.
+        A pair of rollouts is evaluated around the policy M at the time it was drawn.
+        :param env: (VecEnv)
+        :param noise_table: (NoiseTable)
+        :param callback: (function)
+        :param num_updates: (int)
+        """
+        pair_ids = itertools.count()
+        pairs = {}  # pair id -> offset of the perturbation, returns of the 2 directions and number of finished rollouts
+        pending = []  # rollouts not yet started
+
+        def nextTask():
+            if len(pending) == 0:
+                pair_id = next(pair_ids)
+                offset = noise_table.sampleOffsets(np.random, 1, self.M.shape)[0]
+                pairs[pair_id] = {"offset": offset, "r": np.zeros((2,)), "n_done": 0}
+                params = self.perturbedParams(noise_table, [offset])
+                pending.extend([((pair_id, 0), params[0]), ((pair_id, 1), params[1])])
+            return pending.pop(0)
+
+        def policy(obs, params):
+            return self.getPopulationAction(obs.reshape(len(obs), -1), params)
+
+        rollouts = AsyncRollouts(env, nextTask)
+        r, offsets = [], []
+        start_time = time.time()
+        step = 0
+        while step < num_updates:
+            results = rollouts.step(policy)
+            step += self.n_population
+
+            for (pair_id, direction), episode_return in results:
+                pair = pairs[pair_id]
+                pair["r"][direction] = episode_return
+                pair["n_done"] += 1
+                if pair["n_done"] == 2:
+                    del pairs[pair_id]
+                    r.append(pair["r"])
+                    offsets.append(pair["offset"])
+
+            if len(r) >= self.n_population:
+                self.applyNoiseUpdate(noise_table, self.noiseUpdate(np.array(r), offsets))
+                r, offsets = [], []
+
+            if callback is not None:
+                callback(locals(), globals())
+            if (step / self.n_population + 1) % 500 == 0:
+                print("{} steps - {:.2f} FPS - {} episodes".format(step, step / (time.time() - start_time),
+                                                                   rollouts.n_episodes))
+
+    def trainMaster(self, args):
+        """
+        Master of the distributed training: the workers (see runWorker()) evaluate perturbations drawn from a
+        shared noise table and return only their returns, the master sends them the offsets of the perturbations
+        to evaluate and the updates of the policy, as (offset, coefficient) pairs.
+        Each worker gets new perturbations as soon as it returns its results, the policy is updated every
+        n_population results.
+        :param args: (ArgumentParser args)
+        """
+        noise_table = NoiseTable(args.seed, args.noise_table_size)
+        rng = np.random.RandomState(args.seed)
+        master = ESMaster(args.master_port)
+        try:
+            printYellow("Waiting for the workers on port {}...".format(args.master_port))
 
-            delta_sum = 0
-            for i in range(self.top_population):
-                delta_sum += (r[idx[i], 0] - r[idx[i], 1]) * delta[idx[i]]
-            # here, we need to be careful with the normalization of step_size, as the variance can be 0 on sparse reward
-            self.M += (self.step_size /
-                       max(self.top_population * np.std(r[idx[:self.top_population]]), 1 / self.max_step_amplitude) *
-                       delta_sum)
+            workers = {}  # worker id -> number of its perturbations per batch and version of its policy
+            updates = []  # the updates of the policy, one per version
+            r, offsets = [], []
+            best_mean_reward = -np.inf
+            start_time = time.time()
+            step = 0
+            while step < args.num_timesteps:
+                message = master.receive()
+                if message is None:
+                    continue
+                worker_id, command, msg = message
+
+                if command == Command.HELLO:
+                    if self.M is None:
+                        self.M = np.zeros(msg['shape'])
+                    assert list(self.M.shape) == msg['shape'], \
+                        "Error: the worker has a policy of shape {}, expected {}".format(msg['shape'], self.M.shape)
+                    workers[worker_id] = {"n_pairs": msg['n_pairs'], "version": len(updates)}
+                    master.send(worker_id, Command.CONFIG, M=self.M.tolist(), version=len(updates),
+                                noise_seed=noise_table.seed, noise_table_size=noise_table.size,
+                                exploration_noise=self.exploration_noise)
+                    printGreen("{} worker(s) connected".format(len(workers)))
+
+                elif command == Command.RESULT:
+                    step += msg['n_steps']
+                    # results evaluated around an older policy are discarded
+                    if msg['version'] == len(updates):
+                        for offset, r_plus, r_minus in msg['results']:
+                            offsets.append(offset)
+                            r.append([r_plus, r_minus])
+
+                    if len(r) >= self.n_population:
+                        r = np.array(r)
+                        update = self.noiseUpdate(r, offsets)
+                        self.applyNoiseUpdate(noise_table, update)
+                        updates.append(update)
+                        mean_reward = np.mean(r)
+                        print("{} steps - {:.2f} FPS - mean reward of the population: {:.2f}".format(
+                            step, step / (time.time() - start_time), mean_reward))
+                        if mean_reward > best_mean_reward:
+                            best_mean_reward = mean_reward
+                            self.save(args.log_dir + "ars_model.pkl")
+                        r, offsets = [], []
+
+                worker = workers[worker_id]
+                master.send(worker_id, Command.EVALUATE, version=len(updates), updates=updates[worker['version']:],
+                            offsets=noise_table.sampleOffsets(rng, worker['n_pairs'], self.M.shape).tolist())
+                worker['version'] = len(updates)
+
+            # stop the workers when they return their last results
+            while len(workers) > 0:
+                message = master.receive(timeout=60000)
+                if message is None:
+                    printYellow("{} worker(s) did not answer, stopping".format(len(workers)))
+                    break
+                worker_id, _, _ = message
+                master.send(worker_id, Command.EXIT)
+                workers.pop(worker_id, None)
+        finally:
+            master.close()
+            noise_table.close()
+        self.save(args.log_dir + "ars_model.pkl")
+
+    def runWorker(self, args, env):
+        """
+        Rollout worker of the distributed training (see trainMaster()),
+        evaluates num_population perturbations at a time
+        :param args: (ArgumentParser args)
+        :param env: (VecEnv)
+        """
+        def receive():
+            """
+            :return: (Command, dict)
+            """
+            message = worker.receive()
+            assert message is not None, "Error: no message from the master {} for {}s, is it running?".format(
+                args.master_address, WORKER_TIMEOUT // 1000)
+            return message
+
+        noise_table = None
+        worker = ESWorker(args.master_address)
+        try:
+            worker.send(Command.HELLO, n_pairs=self.n_population, shape=list(self.M.shape))
+            command, msg = receive()
+            if command == Command.EXIT:
+                # the training ended before this worker connected
+                printYellow("The training of the master {} is over".format(args.master_address))
+                return
+            assert command == Command.CONFIG, "Error: unexpected message {}".format(msg)
+            self.M = np.array(msg['M'])
+            self.exploration_noise = msg['exploration_noise']
+            noise_table = NoiseTable(msg['noise_seed'], msg['noise_table_size'])
+            printGreen("Connected to the master {}".format(args.master_address))
+
+            while True:
+                command, msg = receive()
+                if command == Command.EXIT:
+                    break
+                for update in msg['updates']:
+                    self.applyNoiseUpdate(noise_table, update)
+
+                returns, n_steps = self.evaluatePopulation(env, self.perturbedParams(noise_table, msg['offsets']))
+                returns = returns.reshape(self.n_population, 2)
+                worker.send(Command.RESULT, version=msg['version'], n_steps=n_steps,
+                            results=[[offset, r_plus, r_minus] for offset, (r_plus, r_minus) in zip(msg['offsets'],
+                                                                                                 returns.tolist())])
+        finally:
+            worker.close()
+            if noise_table is not None:
+                noise_table.close()
+            env.close()
+
+    def evaluatePopulation(self, env, params):
+        """
+        Run one episode per environment, each one with its own policy
+        :param env: (VecEnv)
+        :param params: (numpy float) the policies, of shape (n_envs, obs_dim, action_dim)
+        :return: (numpy float, int) the return of each episode and the number of steps
+        """
+        returns = np.zeros((len(params),))
+        done = np.full((len(params),), False)
+        n_steps = 0
+        obs = env.reset()
+        while not done.all():
+            actions = list(self.getPopulationAction(obs.reshape(len(obs), -1), params))
+            for env_idx in np.flatnonzero(done):
+                actions[env_idx] = None  # do nothing, as we are done
+
+            obs, reward, new_done, info = env.step(actions)
+            n_steps += int(np.sum(~done))
+            returns[~done] += reward[~done]
+            done = np.bitwise_or(done, new_done)
+        return returns, n_steps
+
+    def perturbedParams(self, noise_table, offsets):
+        """
+        :param noise_table: (NoiseTable)
+        :param offsets: ([int]) offsets of the perturbations delta[k] in the noise table
+        :return: (numpy float) the policies M + delta[k] (index 2 * k) and M - delta[k] (index 2 * k + 1),
+            of shape (2 * len(offsets), obs_dim, action_dim)
+        """
+        params = np.repeat(self.M[None], 2 * len(offsets), axis=0)
+        for k, offset in enumerate(offsets):
+            delta = self.exploration_noise * noise_table.get(offset, self.M.shape)
+            params[2 * k] += delta
+            params[2 * k + 1] -= delta
+        return params
+
+    def noiseUpdate(self, r, offsets):
+        """
+        Compute the update of M from the returns of the perturbed policies
+        :param r: (numpy float) returns of each perturbation, of shape (n, 2) (directions +delta and -delta)
+        :param offsets: ([int]) offsets of the perturbations in the noise table
+        :return: ([(int, float)]) the update, as (offset, coefficient) pairs
+        """
+        idx = np.argsort(np.max(r, axis=1))[::-1][:self.top_population]
+        # here, we need to be careful with the normalization of step_size, as the variance can be 0 on sparse reward
+        scale = self.step_size / max(self.top_population * np.std(r[idx]), 1 / self.max_step_amplitude)
+        return [(int(offsets[i]), float(scale * (r[i, 0] - r[i, 1]))) for i in idx]
+
+    def applyNoiseUpdate(self, noise_table, update):
+        """
+        Apply an update of noiseUpdate() (the distributed master and workers get the same policy)
+        :param noise_table: (NoiseTable)
+        :param update: ([(int, float)])
+        """
+        for offset, coefficient in update:
+            self.M += coefficient * noise_table.get(offset, self.M.shape)
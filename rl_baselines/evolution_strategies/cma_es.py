@@ -8,7 +8,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from rl_baselines.base_classes import BaseRLObject
-from rl_baselines.utils import createEnvs
+from rl_baselines.evolution_strategies.rollouts import AsyncRollouts
+from rl_baselines.utils import createEnvs, sampleActions
 
 
 def detachToNumpy(tensor):
@@ -59,6 +60,9 @@ class CMAESModel(BaseRLObject):
                             help='use gpu for the neural network')
         parser.add_argument('--deterministic', action='store_true', default=False,
                             help='do a deterministic approach for the actions on the output of the policy')
+        parser.add_argument('--async-rollouts', action='store_true', default=False,
+                            help='start the episode of a new candidate as soon as an environment is done, '
+                                 'instead of waiting for the longest episode of the population')
         return parser
 
     def getActionProba(self, observation, dones=None):
@@ -101,11 +105,24 @@ class CMAESModel(BaseRLObject):
         self.mu = args.mu
         self.sigma = args.sigma
         self.continuous_actions = args.continuous_actions
-        self.es = cma.CMAEvolutionStrategy(self.policy.getParamSpace() * [self.mu], self.sigma,
-                                           {'popsize': self.n_population})
+        options = {'popsize': self.n_population}
+        if args.async_rollouts:
+            # the results are told in the order the episodes end: force the cumulative step-size adaptation,
+            # as the two-point adaptation (TPA) expects the first two solutions of ask() to be told first
+            options['AdaptSigma'] = cma.sigma_adaptation.CMAAdaptSigmaCSA
+            # no selective mirroring: the mirrored solutions are injected in ask() and must all be told,
+            # while the candidates still running when the distribution is updated are discarded
+            options['CMA_mirrors'] = 0
+        self.es = cma.CMAEvolutionStrategy(self.policy.getParamSpace() * [self.mu], self.sigma, options)
         self.best_model = np.array(self.policy.getParamSpace() * [self.mu])
+        # the network holds the best parameters, used by getAction() and saved with the model
+        self.policy.setParam(self.best_model)
         num_updates = int(args.num_timesteps)
 
+        if args.async_rollouts:
+            self.trainAsync(env, callback, num_updates)
+            return
+
         start_time = time.time()
         step = 0
         while step < num_updates:
@@ -113,16 +130,13 @@ class CMAESModel(BaseRLObject):
             r = np.zeros((self.n_population,))
             # here, CMAEvolutionStrategy will return a list of param for each of the population
             population = self.es.ask()
+            # the parameters of the whole population, as one tensor
+            params = self.policy.toTensor(np.array(population))
             done = np.full((self.n_population,), False)
             while not done.all():
-                actions = []
-                for k in range(self.n_population):
-                    if not done[k]:
-                        self.policy.setParam(population[k])
-                        action = self.policy.getAction(np.array([obs[k]]))[0]
-                        actions.append(action)
-                    else:
-                        actions.append(None)  # do nothing, as we are done
+                actions = list(self.policy.getPopulationAction(np.asarray(obs), params))
+                for k in np.flatnonzero(done):
+                    actions[k] = None  # do nothing, as we are done
 
                 obs, reward, new_done, info = env.step(actions)
                 step += np.sum(~done)
@@ -138,6 +152,57 @@ class CMAESModel(BaseRLObject):
             print("{} steps - {:.2f} FPS".format(step, step / (time.time() - start_time)))
             self.es.tell(population, -r)
             self.best_model = self.es.result.xbest
+            self.policy.setParam(self.best_model)
+
+    def trainAsync(self, env, callback, num_updates):
+        """
+        Asynchronous training loop: each environment starts the episode of a new candidate as soon as it is done
+        (see AsyncRollouts). Once the candidates of the generation are all started, the free environments evaluate
+        extra candidates of the same distribution, and the distribution is updated with the first n_population
+        results. Each candidate is tagged with its generation: the candidates still running when the distribution
+        is updated are discarded, they are not told to the next generation.
+        :param env: (VecEnv)
+        :param callback: (function)
+        :param num_updates: (int)
+        """
+        # candidates of the current generation not yet started
+        population = list(self.es.ask())
+
+        def nextTask():
+            if len(population) == 0:
+                population.extend(self.es.ask(1))
+            candidate = population.pop(0)
+            # the generation is the number of updates of the distribution the candidate was sampled from
+            return (self.es.countiter, candidate), candidate
+
+        def policy(obs, params):
+            return self.policy.getPopulationAction(np.asarray(obs), self.policy.toTensor(params))
+
+        rollouts = AsyncRollouts(env, nextTask)
+        solutions, r = [], []
+        start_time = time.time()
+        step = 0
+        while step < num_updates:
+            results = rollouts.step(policy)
+            step += env.num_envs
+
+            for (generation, candidate), episode_return in results:
+                if generation == self.es.countiter:
+                    solutions.append(candidate)
+                    r.append(episode_return)
+
+            if len(r) >= self.n_population:
+                print("{} steps - {:.2f} FPS - {} episodes".format(step, step / (time.time() - start_time),
+                                                                   rollouts.n_episodes))
+                # the extra results (episodes ending at the same step) are discarded, as the running candidates
+                self.es.tell(solutions[:self.n_population], -np.array(r[:self.n_population]))
+                self.best_model = self.es.result.xbest
+                self.policy.setParam(self.best_model)
+                solutions, r = [], []
+                population[:] = self.es.ask()
+
+            if callback is not None:
+                callback(locals(), globals())
 
 
 class Policy(object):
@@ -222,16 +287,46 @@ class PytorchPolicy(Policy):
             obs = np.transpose(obs / 255.0, (0, 3, 1, 2))
 
         with torch.no_grad():
-            if self.continuous_actions:
-                action = detachToNumpy(self.model(self.toTensor(obs)))
+            return self.selectAction(self.model(self.toTensor(obs)))
+
+    def getPopulationAction(self, obs, params):
+        """
+        Returns the actions of a population of policies, each one with its own parameters and observation.
+        If the network implements batchedForward(), the whole population is evaluated in a single forward pass,
+        otherwise the parameters of each member are copied into the network in turn (then restored).
+        :param obs: (numpy float or numpy int) one observation per member of the population
+        :param params: (Tensor) parameters of the population, of shape (n_population, param_len)
+        :return: the actions
+        """
+        if not self.srl_model:
+            obs = np.transpose(obs / 255.0, (0, 3, 1, 2))
+
+        obs = self.toTensor(obs)
+        with torch.no_grad():
+            if hasattr(self.model, "batchedForward"):
+                output = self.model.batchedForward(obs, params)
             else:
-                action = detachToNumpy(F.softmax(self.model(self.toTensor(obs)), dim=-1))
-                if self.deterministic:
-                    action = np.argmax(action, axis=1)
-                else:
-                    action = np.array([np.random.choice(len(a), p=a) for a in action])
+                model_params = nn.utils.parameters_to_vector(self.model.parameters())
+                output = []
+                for k in range(len(params)):
+                    nn.utils.vector_to_parameters(params[k], self.model.parameters())
+                    output.append(self.model(obs[k:k + 1]))
+                nn.utils.vector_to_parameters(model_params, self.model.parameters())
+                output = torch.cat(output)
+            return self.selectAction(output)
+
+    def selectAction(self, output):
+        """
+        :param output: (Tensor) output of the network
+        :return: the actions (sampled or greedy for discrete actions)
+        """
+        if self.continuous_actions:
+            return detachToNumpy(output)
 
-        return action
+        action = detachToNumpy(F.softmax(output, dim=-1))
+        if self.deterministic:
+            return np.argmax(action, axis=1)
+        return sampleActions(action)
 
     def toTensor(self, arr):
         """
@@ -324,3 +419,25 @@ class MLPPolicyPytorch(nn.Module):
             x = F.relu(getattr(self, name)(x))
         x = self.fc_out(x)
         return x
+
+    def batchedForward(self, x, params):
+        """
+        Forward pass of a population of networks, with batched matrix multiplications
+        :param x: (Tensor) one input per network, of shape (n_networks, in_dim)
+        :param params: (Tensor) flat parameters of each network (in the order of self.parameters()),
+            of shape (n_networks, n_params)
+        :return: (Tensor) of shape (n_networks, out_dim)
+        """
+        layers = [self.fc_in] + [getattr(self, name) for name in self.fc_hidden_name] + [self.fc_out]
+        x = x.unsqueeze(1)
+        offset = 0
+        for i, layer in enumerate(layers):
+            out_dim, in_dim = layer.weight.shape
+            weight = params[:, offset:offset + out_dim * in_dim].view(-1, out_dim, in_dim)
+            offset += out_dim * in_dim
+            bias = params[:, offset:offset + out_dim]
+            offset += out_dim
+            x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+            if i < len(layers) - 1:
+                x = F.relu(x)
+        return x.squeeze(1)
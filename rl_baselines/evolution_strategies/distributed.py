@@ -0,0 +1,86 @@
+"""
+Transport of the distributed evolution strategies: a master and rollout workers, exchanging json messages over ZeroMQ
+(the master binds a ROUTER socket, the workers connect DEALER sockets).
+The workers can run on other hosts, or on the same machine through the loopback interface (tcp://localhost:port).
+"""
+import json
+from enum import Enum
+
+import zmq
+
+# Time (in ms) a worker waits for a message of the master, before considering that the master is not running
+WORKER_TIMEOUT = 120000
+
+
+class Command(Enum):
+    HELLO = 0  # worker -> master: a new worker is ready
+    CONFIG = 1  # master -> worker: the current policy and the parameters of the training
+    EVALUATE = 2  # master -> worker: the perturbations to evaluate, with the policy updates the worker missed
+    RESULT = 3  # worker -> master: the returns of the perturbations
+    EXIT = 4  # master -> worker: the training is over
+
+
+class ESMaster(object):
+    """
+    Master side of the transport
+    :param port: (int) port the workers connect to
+    """
+
+    def __init__(self, port):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind("tcp://*:{}".format(port))
+
+    def receive(self, timeout=1000):
+        """
+        :param timeout: (int) in ms
+        :return: (bytes, Command, dict) id of the worker, command and message, None if no message was received
+        """
+        if self.socket.poll(timeout) == 0:
+            return None
+        worker_id, data = self.socket.recv_multipart()
+        msg = json.loads(data.decode())
+        return worker_id, Command(msg['command']), msg
+
+    def send(self, worker_id, command, **kwargs):
+        """
+        :param worker_id: (bytes)
+        :param command: (Command)
+        """
+        self.socket.send_multipart([worker_id, json.dumps(dict(command=command.value, **kwargs)).encode()])
+
+    def close(self):
+        self.socket.close(linger=1000)
+        self.context.term()
+
+
+class ESWorker(object):
+    """
+    Worker side of the transport
+    :param address: (str) address of the master, e.g. tcp://localhost:7778
+    """
+
+    def __init__(self, address):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(address)
+
+    def receive(self, timeout=WORKER_TIMEOUT):
+        """
+        :param timeout: (int) in ms
+        :return: (Command, dict) command and message, None if no message was received
+        """
+        if self.socket.poll(timeout) == 0:
+            return None
+        msg = self.socket.recv_json()
+        return Command(msg['command']), msg
+
+    def send(self, command, **kwargs):
+        """
+        :param command: (Command)
+        """
+        self.socket.send_json(dict(command=command.value, **kwargs))
+
+    def close(self):
+        self.socket.close(linger=1000)
+        self.context.term()
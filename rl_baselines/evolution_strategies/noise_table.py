@@ -0,0 +1,131 @@
+import atexit
+import os
+import signal
+import tempfile
+import threading
+
+import numpy as np
+
+# Folder of the shared noise tables: in memory (tmpfs) when available
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+# Number of floats generated at once when filling a table
+CHUNK_SIZE = int(1e6)
+# Paths of the shared tables created by this process, removed at exit (and on SIGTERM) if they were not closed
+_owned_paths = set()
+
+
+def _removeOwnedTables():
+    for path in list(_owned_paths):
+        if os.path.isfile(path):
+            os.remove(path)
+    _owned_paths.clear()
+
+
+def _onTerminate(signum, _frame):
+    """
+    Remove the shared tables, then terminate as without the handler
+    """
+    _removeOwnedTables()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+atexit.register(_removeOwnedTables)
+
+
+class NoiseTable(object):
+    """
+    A table of gaussian noise, generated from a seed: two processes creating a table with the same seed and size
+    get the same noise, so a perturbation can be exchanged as an offset in the table instead of an array
+    (shared noise table of https://arxiv.org/abs/1703.03864)
+
+    The table is read-only. With shared=True, it is generated once per machine in a file of SHARED_MEMORY_DIR,
+    which every process with the same seed and size maps in memory: the processes share the same physical pages.
+    The process which created the file removes it on close(), at exit or on SIGTERM (not if it is killed).
+    :param seed: (int)
+    :param size: (int) number of float32 in the table
+    :param shared: (bool) share the table with the other processes of the machine
+    """
+
+    def __init__(self, seed, size, shared=True):
+        self.seed = seed
+        self.size = size
+        self.path = None
+        self.owner = False
+        if shared:
+            self.path = os.path.join(SHARED_MEMORY_DIR, "es_noise_table_{}_{}.npy".format(seed, size))
+            self.noise = None
+            while self.noise is None:
+                if not os.path.isfile(self.path):
+                    self.owner = self._generate(self.path)
+                try:
+                    self.noise = np.load(self.path, mmap_mode='r')
+                except FileNotFoundError:
+                    # removed by its owner in the meantime, generated again
+                    pass
+        else:
+            self.noise = np.empty((size,), dtype=np.float32)
+            self._fill(self.noise)
+            self.noise.flags.writeable = False
+
+    def _fill(self, noise):
+        """
+        Fill the table by chunks, so the memory usage does not depend on the size of the table
+        :param noise: (numpy float32)
+        """
+        rng = np.random.RandomState(self.seed)
+        for start in range(0, self.size, CHUNK_SIZE):
+            noise[start:start + CHUNK_SIZE] = rng.randn(min(CHUNK_SIZE, self.size - start))
+
+    def _generate(self, path):
+        """
+        Write the table to a temporary file, then rename it: the processes generating the same table at the same time
+        do not see a partial table
+        :param path: (str)
+        :return: (bool) whether this process created the file
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        noise = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(self.size,))
+        self._fill(noise)
+        noise.flush()
+        del noise
+        if os.path.isfile(path):
+            os.remove(tmp_path)
+            return False
+        os.rename(tmp_path, path)
+        _owned_paths.add(path)
+        if (threading.current_thread() is threading.main_thread() and
+                signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+            signal.signal(signal.SIGTERM, _onTerminate)
+        return True
+
+    def get(self, offset, shape):
+        """
+        :param offset: (int)
+        :param shape: (tuple) shape of the perturbation
+        :return: (numpy float32) read-only view of the table, starting at offset
+        """
+        return self.noise[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def sampleOffsets(self, rng, n, shape):
+        """
+        :param rng: (numpy RandomState)
+        :param n: (int) number of perturbations
+        :param shape: (tuple) shape of a perturbation
+        :return: (numpy int) the offsets of n random perturbations
+        """
+        dim = int(np.prod(shape))
+        assert dim <= self.size, "Error: the noise table is smaller than a perturbation ({} < {})".format(self.size,
+                                                                                                           dim)
+        return rng.randint(0, self.size - dim + 1, size=n)
+
+    def close(self):
+        """
+        Remove the shared table if this process created it
+        (the processes which already mapped it keep their mapping)
+        """
+        if self.owner and os.path.isfile(self.path):
+            os.remove(self.path)
+        if self.owner:
+            _owned_paths.discard(self.path)
+        self.owner = False
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class AsyncRollouts(object):
+    """
+    Asynchronous evaluation scheduler for the evolution strategies.
+    Each environment of the VecEnv runs the episode of one task (e.g. a perturbation or a candidate) at a time:
+    as soon as its episode ends, the environment (reset by the VecEnv) starts the episode of the next task,
+    instead of waiting for the longest episode of the generation.
+    :param env: (VecEnv) must reset the environments when they are done (e.g. SubprocVecEnv)
+    :param next_task: (callable) returns the next task to evaluate, as a tuple (key, params):
+        the key identifies the task in the results, the params are the parameters of its policy (numpy array)
+    """
+
+    def __init__(self, env, next_task):
+        self.env = env
+        self.next_task = next_task
+        self.obs = env.reset()
+        tasks = [next_task() for _ in range(env.num_envs)]
+        self.keys = [key for key, _ in tasks]
+        # parameters of the policy run by each environment
+        self.params = np.array([params for _, params in tasks])
+        self.returns = np.zeros((env.num_envs,))
+        self.n_episodes = 0
+
+    def step(self, policy):
+        """
+        Step all the environments, each one with the policy of its task,
+        then start the next tasks in the environments whose episode ended
+        :param policy: (callable) (observations, params) -> one action per environment
+        :return: ([(key, float)]) the tasks whose episode ended at this step, with their return
+        """
+        self.obs, reward, done, _ = self.env.step(list(policy(self.obs, self.params)))
+        # the reward of the last step of the episode is included in its return
+        self.returns += reward
+
+        results = []
+        for env_idx in np.flatnonzero(done):
+            results.append((self.keys[env_idx], self.returns[env_idx]))
+            self.returns[env_idx] = 0
+            self.keys[env_idx], self.params[env_idx] = self.next_task()
+        self.n_episodes += len(results)
+        return results
@@ -1,27 +1,40 @@
 import argparse
+import atexit
+import itertools
 import subprocess
 import os
+import queue
 import shutil
+import signal
+import threading
 import glob
 import pprint
 import math
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import pandas as pd
 import numpy as np
 import hyperopt
 
 from rl_baselines.registry import registered_rl
+from rl_baselines.trial_runner import TrialWorkerPool
+from rl_baselines.visualize import loadCsv
 from environments.registry import registered_env
 from state_representation.registry import registered_srl
 from srl_zoo.utils import printGreen
 
 ITERATION_SCALE = 10000
 MIN_ITERATION = 30000
+# Early stopping: number of episodes of the moving average of the learning curves,
+# minimal fraction of the timesteps before stopping a training, and minimal number of finished trainings to compare to
+CURVE_WINDOW = 10
+EARLY_STOPPING_MIN_FRACTION = 0.25
+EARLY_STOPPING_MIN_CURVES = 3
 
 
 class HyperParameterOptimizer(object):
-    def __init__(self, opt_param, train, seed=0):
+    def __init__(self, opt_param, train, seed=0, num_workers=1):
         """
         the base class for hyper parameter optimizer
 
@@ -34,10 +47,13 @@ class HyperParameterOptimizer(object):
             - returns: (float) the score of the training to minimize
 
         :param seed: (int) the initial seed for the random number generator
+        :param num_workers: (int) the number of trainings running at the same time
+            (train is then called from several threads)
         """
         self.opt_param = opt_param
         self.train = train
         self.seed = seed
+        self.num_workers = num_workers
 
         self.history = []
 
@@ -48,10 +64,76 @@ class HyperParameterOptimizer(object):
         raise NotImplementedError
 
 
+class SuccessiveHalving(object):
+    def __init__(self, sampler, n_configs, min_iters, n_rungs, eta):
+        """
+        A bracket of Hyperband, scheduled asynchronously (ASHA: https://arxiv.org/abs/1810.05934):
+        a configuration is promoted to the next rung as soon as it is in the top 1/eta of the finished trainings
+        of its rung, instead of waiting for the whole rung.
+        The number of configurations of each rung is the same as in the synchronous successive halving.
+
+        :param sampler: (function (): dict) returns a new configuration
+        :param n_configs: (int) the number of configurations of the first rung
+        :param min_iters: (float) the number of iterations of the first rung
+        :param n_rungs: (int) the number of rungs, each one eta times longer than the previous one
+        :param eta: (float) the reduction factor of the search
+        """
+        self.sampler = sampler
+        self.min_iters = min_iters
+        self.n_rungs = n_rungs
+        self.eta = eta
+        self.capacity = [n_configs]
+        for rung in range(n_rungs - 1):
+            self.capacity.append(int(math.floor(int(math.floor(n_configs * eta**(-rung))) / eta)))
+
+        self.configs = []
+        # for each rung, the configurations started and the losses of the finished ones
+        self.started = [set() for _ in range(n_rungs)]
+        self.losses = [{} for _ in range(n_rungs)]
+
+    def numIters(self, rung):
+        """
+        :param rung: (int)
+        :return: (float) the number of iterations of the trainings of the rung
+        """
+        return self.min_iters * self.eta**rung
+
+    def nextJob(self):
+        """
+        :return: ((int, int)) the rung and the index of the configuration to train next,
+            None if no training can start until a running one is finished
+        """
+        # promotions first, starting from the last rung
+        for rung in reversed(range(self.n_rungs - 1)):
+            if len(self.started[rung + 1]) >= self.capacity[rung + 1]:
+                continue
+            ranking = sorted(self.losses[rung], key=self.losses[rung].get)
+            for config_idx in ranking[:int(len(ranking) // self.eta)]:
+                if config_idx not in self.started[rung + 1]:
+                    self.started[rung + 1].add(config_idx)
+                    return rung + 1, config_idx
+
+        if len(self.configs) < self.capacity[0]:
+            self.configs.append(self.sampler())
+            self.started[0].add(len(self.configs) - 1)
+            return 0, len(self.configs) - 1
+        return None
+
+    def report(self, rung, config_idx, loss):
+        """
+        :param rung: (int)
+        :param config_idx: (int)
+        :param loss: (float)
+        """
+        self.losses[rung][config_idx] = loss
+
+
 class Hyperband(HyperParameterOptimizer):
-    def __init__(self, opt_param, train, seed=0, max_iter=100, eta=3.0):
+    def __init__(self, opt_param, train, seed=0, max_iter=100, eta=3.0, num_workers=1):
         """
-        A Hyperband implementation, it is similar to a targeted random search
+        A Hyperband implementation, it is similar to a targeted random search.
+        The brackets are run with asynchronous successive halving (see SuccessiveHalving),
+        a free worker takes the next training of the first bracket which has one.
 
         Hyperband: https://arxiv.org/abs/1603.06560
 
@@ -66,8 +148,9 @@ class Hyperband(HyperParameterOptimizer):
         :param seed: (int) the initial seed for the random number generator
         :param max_iter: (int) the maximum budget for hyperband's search
         :param eta: (float) the reduction factor of the search
+        :param num_workers: (int) the number of trainings running at the same time
         """
-        super(Hyperband, self).__init__(opt_param, train, seed=seed)
+        super(Hyperband, self).__init__(opt_param, train, seed=seed, num_workers=num_workers)
         self.max_iter = max_iter
         self.eta = eta
         self.max_steps = int(math.floor(math.log(self.max_iter) / math.log(self.eta)))
@@ -94,26 +177,47 @@ class Hyperband(HyperParameterOptimizer):
         return _sample
 
     def run(self):
+        brackets = []
         for step in reversed(range(self.max_steps + 1)):
             max_n_param_sampled = int(math.ceil(self.budget / self.max_iter * self.eta**step / (step + 1)))
             max_iters = self.max_iter * self.eta**(-step)
-
-            all_parameters = np.array([self.param_sampler() for _ in range(max_n_param_sampled)])
-            for i in range(step + 1):
-                printGreen("\npop_itt:{}/{}, itt:{}/{}, pop_size:{}".format(self.max_steps - step, self.max_steps + 1,
-                                                                            i, step+1, len(all_parameters)))
-                n_param_sampled = int(math.floor(max_n_param_sampled * self.eta**(-i)))
-                num_iters = max_iters * self.eta**i
-                losses = [self.train(params, num_iters, train_id) for train_id, params in enumerate(all_parameters)]
-
-                self.history.extend(zip([(params, num_iters) for params in all_parameters], losses))
-                all_parameters = all_parameters[np.argsort(losses)[:int(math.floor(n_param_sampled / self.eta))]]
+            brackets.append(SuccessiveHalving(self.param_sampler, max_n_param_sampled, max_iters, step + 1, self.eta))
+
+        train_ids = itertools.count()
+        running = {}  # future -> bracket index, rung, configuration index
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            while True:
+                while len(running) < self.num_workers:
+                    job = None
+                    for bracket_idx, bracket in enumerate(brackets):
+                        job = bracket.nextJob()
+                        if job is not None:
+                            break
+                    if job is None:
+                        break
+                    rung, config_idx = job
+                    printGreen("\nbracket:{}/{}, rung:{}/{}, config:{}/{}".format(
+                        bracket_idx + 1, len(brackets), rung + 1, bracket.n_rungs, config_idx + 1,
+                        bracket.capacity[0]))
+                    future = executor.submit(self.train, bracket.configs[config_idx], bracket.numIters(rung),
+                                             next(train_ids))
+                    running[future] = (bracket_idx, rung, config_idx)
+
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bracket_idx, rung, config_idx = running.pop(future)
+                    bracket = brackets[bracket_idx]
+                    loss = future.result()
+                    bracket.report(rung, config_idx, loss)
+                    self.history.append(((bracket.configs[config_idx], bracket.numIters(rung)), loss))
 
         return self.history[int(np.argmin([val[1] for val in self.history]))]
 
 
 class Hyperopt(HyperParameterOptimizer):
-    def __init__(self, opt_param, train, seed=0, num_eval=100):
+    def __init__(self, opt_param, train, seed=0, num_eval=100, num_workers=1):
         """
         A Hyperopt implementation, it is similar to a bayesian search
 
@@ -129,8 +233,9 @@ class Hyperopt(HyperParameterOptimizer):
 
         :param seed: (int) the initial seed for the random number generator
         :param num_eval: (int) the number of evaluation to do
+        :param num_workers: (int) the number of trainings running at the same time
         """
-        super(Hyperopt, self).__init__(opt_param, train, seed=seed)
+        super(Hyperopt, self).__init__(opt_param, train, seed=seed, num_workers=num_workers)
         self.num_eval = num_eval
         self.search_space = {}
         for name, (param_type, val) in self.opt_param.items():
@@ -144,23 +249,115 @@ class Hyperopt(HyperParameterOptimizer):
                 raise AssertionError("Error: unknown type {}".format(param_type))
 
     def run(self):
+        # The trials are suggested and told one by one (instead of fmin), so num_workers of them can run at once.
+        # TPE only uses the finished trials: a suggestion does not depend on the trials still running
         trials = hyperopt.Trials()
-        hyperopt.fmin(fn=lambda kwargs: {'loss': self.train(kwargs), 'status': hyperopt.STATUS_OK},
-                      space=self.search_space,
-                      algo=hyperopt.tpe.suggest,
-                      max_evals=self.num_eval,
-                      trials=trials,
-                      verbose=10)
-
-        # from the trials, get the values for every parameter
-        # set the number of iter to None as they are not changed in Hyperopt
-        # and zip the loss
-        self.history.extend(zip([(
-            {name: val[0] for name, val in params["misc"]["vals"].items()}, None)
-            for params in trials.trials], trials.losses()))
+        domain = hyperopt.Domain(self.train, self.search_space)
+        rng = np.random.RandomState(self.seed)
+
+        running = {}  # future -> trial id
+        n_suggested = 0
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            while n_suggested < self.num_eval or len(running) > 0:
+                while len(running) < self.num_workers and n_suggested < self.num_eval:
+                    trial = hyperopt.tpe.suggest(trials.new_trial_ids(1), domain, trials, rng.randint(2 ** 31 - 1))[0]
+                    trial['state'] = hyperopt.JOB_STATE_RUNNING
+                    trials.insert_trial_docs([trial])
+                    trials.refresh()
+                    params = hyperopt.space_eval(self.search_space,
+                                                 {name: val[0] for name, val in trial['misc']['vals'].items()})
+                    running[executor.submit(self.train, params, None, trial['tid'])] = (trial['tid'], params)
+                    n_suggested += 1
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tid, params = running.pop(future)
+                    loss = future.result()
+                    trial = next(trial for trial in trials.trials if trial['tid'] == tid)
+                    trial['result'] = {'loss': loss, 'status': hyperopt.STATUS_OK}
+                    trial['state'] = hyperopt.JOB_STATE_DONE
+                    # set the number of iter to None as they are not changed in Hyperopt
+                    self.history.append(((params, None), loss))
+                trials.refresh()
+
         return self.history[int(np.argmin([val[1] for val in self.history]))]
 
 
+def stopTraining(process, timeout=30):
+    """
+    Stop a training and the processes of its environments (the training has its own process group)
+    :param process: (subprocess.Popen or Trial) the training, or the persistent worker running it
+    :param timeout: (float) time in seconds before killing the training, if it did not exit
+    """
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def learningCurve(log_folder):
+    """
+    :param log_folder: (str) folder of the monitor files of a training, which can be running
+    :return: ((numpy array, numpy array)) the timesteps and the mean reward of the last CURVE_WINDOW episodes,
+        at the end of each episode, None if no episode is finished
+    """
+    try:
+        result, total_timesteps = loadCsv(log_folder)
+    except (ValueError, IndexError):
+        # the last line of a monitor file is being written
+        return None
+    if len(result) == 0:
+        return None
+    # loadCsv() gives the timesteps at the start of each episode
+    timesteps = np.append(np.array(result)[1:, 0], total_timesteps)
+    rewards = pd.Series(np.array(result)[:, 1]).rolling(CURVE_WINDOW, min_periods=1).mean().values
+    return timesteps, rewards
+
+
+class EarlyStopping(object):
+    def __init__(self):
+        """
+        Stop the trainings whose learning curve is below the median of the finished trainings with the same budget,
+        at the same timestep (median stopping rule).
+        A training in the bottom half of its rung is very unlikely to be promoted (top 1/eta, with eta >= 2),
+        while the comparison with the single best curve would stop nearly every training.
+        """
+        self.curves = {}  # budget -> learning curves of the finished trainings
+        self.lock = threading.Lock()
+
+    def addCurve(self, budget, curve):
+        """
+        :param budget: (float) the number of iterations of the training (None for hyperopt)
+        :param curve: ((numpy array, numpy array)) see learningCurve()
+        """
+        with self.lock:
+            self.curves.setdefault(budget, []).append(curve)
+
+    def shouldStop(self, budget, curve, num_timesteps):
+        """
+        :param budget: (float) the number of iterations of the training (None for hyperopt)
+        :param curve: ((numpy array, numpy array)) learning curve of the running training
+        :param num_timesteps: (int) the number of timesteps of the training
+        :return: (bool)
+        """
+        timesteps, rewards = curve
+        if timesteps[-1] < EARLY_STOPPING_MIN_FRACTION * num_timesteps:
+            return False
+        with self.lock:
+            curves = list(self.curves.get(budget, []))
+
+        references = []
+        for ref_timesteps, ref_rewards in curves:
+            idx = np.searchsorted(ref_timesteps, timesteps[-1], side='right') - 1
+            if idx >= 0:
+                references.append(ref_rewards[idx])
+        if len(references) < EARLY_STOPPING_MIN_CURVES:
+            return False
+        return rewards[-1] < np.median(references)
+
+
 def makeRlTrainingFunction(args, train_args):
     """
     makes a training function for the hyperparam optimizers
@@ -180,15 +377,40 @@ def makeRlTrainingFunction(args, train_args):
     else:
         stdout = open(os.devnull, 'w')
 
+    # Each of the num_workers trainings running at the same time has a slot of num_cpu cores
+    cores_per_slot = args.num_cpu if args.num_cpu is not None else 1
+    slots = queue.Queue()
+    for slot in range(args.num_workers):
+        slots.put(slot)
+    train_env = os.environ.copy()
+    if args.num_workers > 1:
+        # limit the threads of numpy, pytorch and tensorflow to the cores of the slot
+        for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+            train_env[name] = str(cores_per_slot)
+    # the cores each slot is pinned to (None: not pinned)
+    slot_cores = []
+    for slot in range(args.num_workers):
+        cores = list(range(slot * cores_per_slot, (slot + 1) * cores_per_slot))
+        if (args.num_workers > 1 and args.num_cpu is not None and hasattr(os, "sched_setaffinity") and
+                cores[-1] < os.cpu_count()):
+            slot_cores.append(cores)
+        else:
+            slot_cores.append(None)
+    if args.subprocess:
+        pool = None
+    else:
+        # a persistent worker per slot, which keeps the training code imported between the trainings
+        pool = TrialWorkerPool(args.num_workers, stdout=stdout, env=train_env, cores=slot_cores)
+        atexit.register(pool.close)
+    current_ids = itertools.count()
+    early_stopping = EarlyStopping() if args.early_stopping else None
+
     def _train(params, num_iters=None, train_id=None):
         # generate a print string
         print_str = "\nID_num={}, "
         format_args = []
         if train_id is None:
-            if not hasattr(_train, "current_id"):
-                _train.current_id = 0
-            train_id = _train.current_id
-            _train.current_id += 1
+            train_id = next(current_ids)
         format_args.append(train_id)
         if num_iters is not None:
             print_str += "Num-timesteps={}, "
@@ -198,15 +420,21 @@ def makeRlTrainingFunction(args, train_args):
         printGreen(print_str.format(*format_args))
         pprint.pprint(params)
 
-        # cleanup old files
-        if os.path.exists(args.log_dir):
-            shutil.rmtree(args.log_dir)
+        # each training has its own log folder
+        log_dir = "{}trial_{}/".format(args.log_dir, train_id)
+        if os.path.exists(log_dir):
+            shutil.rmtree(log_dir)
 
         # add the training args that where parsed for the hyperparam optimizers
+        loop_args = ['--log-dir', log_dir]
+        if args.num_cpu is not None:
+            loop_args += ['--num-cpu', str(args.num_cpu)]
         if num_iters is not None:
-            loop_args = ['--num-timesteps', str(int(max(MIN_ITERATION, num_iters * ITERATION_SCALE)))]
+            num_timesteps = int(max(MIN_ITERATION, num_iters * ITERATION_SCALE))
         else:
-            loop_args = ['--num-timesteps', str(int(args.num_timesteps))]
+            num_timesteps = int(args.num_timesteps)
+        loop_args += ['--num-timesteps', str(num_timesteps)]
+        run_folders = "{}/{}/{}/{}/*".format(log_dir, args.env, args.srl_model, args.algo)
 
         # redefine the hyperparam args for rl_baselines.train
         if len(params) > 0:
@@ -214,14 +442,41 @@ def makeRlTrainingFunction(args, train_args):
             for param_name, param_val in params.items():
                 loop_args.append("{}:{}".format(param_name, param_val))
 
-        # call the training
-        ok = subprocess.call(['python', '-m', 'rl_baselines.train'] + train_args + loop_args, stdout=stdout)
-        if ok != 0:
+        # call the training, pinned to the cores of a free slot
+        slot = slots.get()
+        try:
+            if pool is not None:
+                # the worker of the slot has its own process group, like the subprocess
+                process = pool.start(slot, train_args + loop_args)
+            else:
+                cores = slot_cores[slot]
+                preexec_fn = (lambda: os.sched_setaffinity(0, cores)) if cores is not None else None
+                # in its own process group, so it can be stopped with the processes of its environments
+                process = subprocess.Popen(['python', '-m', 'rl_baselines.train'] + train_args + loop_args,
+                                           stdout=stdout, env=train_env, preexec_fn=preexec_fn,
+                                           start_new_session=True)
+            stopped = False
+            while True:
+                try:
+                    ok = process.wait(timeout=args.monitor_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    if early_stopping is None or len(glob.glob(run_folders)) == 0:
+                        continue
+                    curve = learningCurve(glob.glob(run_folders)[0])
+                    if curve is not None and early_stopping.shouldStop(num_iters, curve, num_timesteps):
+                        printGreen("ID_num={}: early stopping at {} timesteps".format(train_id, int(curve[0][-1])))
+                        stopTraining(process)
+                        stopped = True
+                        break
+        finally:
+            slots.put(slot)
+        if not stopped and ok != 0:
             # throw the error down to the terminal
             raise ChildProcessError("An error occured, error code: {}".format(ok))
 
         # load the logging of the training, and extract the reward
-        folders = glob.glob("{}/{}/{}/{}/*".format(args.log_dir, args.env, args.srl_model, args.algo))
+        folders = glob.glob(run_folders)
         assert len(folders) != 0, "Error: Could not find generated directory, halting {} search.".format(args.optimizer)
         rewards = []
         for monitor_path in glob.glob(folders[0] + "/*.monitor.csv"):
@@ -230,6 +485,11 @@ def makeRlTrainingFunction(args, train_args):
             rewards = -np.inf
         print("reward: ", np.mean(rewards))
 
+        if early_stopping is not None and not stopped:
+            curve = learningCurve(folders[0])
+            if curve is not None:
+                early_stopping.addCurve(num_iters, curve)
+
         # negative reward, as we are minimizing with hyperparameter search
         return -np.mean(rewards)
     return _train
@@ -249,12 +509,27 @@ def main():
     parser.add_argument('--num-timesteps', type=int, default=1e6, help='number of timesteps the baseline should run')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Display baseline STDOUT')
     parser.add_argument('--max-eval', type=int, default=100, help='Number of evalutation to try for hyperopt')
+    parser.add_argument('--num-cpu', type=int, default=None,
+                        help='number of cpu of each training (for the algorithms using several processes)')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of trainings running at the same time (each one with --num-cpu cores)')
+    parser.add_argument('--early-stopping', action='store_true', default=False,
+                        help='stop the trainings whose learning curve is below the median of the finished ones')
+    parser.add_argument('--monitor-interval', type=float, default=10,
+                        help='interval (in s) between two reads of the monitor files of a running training')
+    parser.add_argument('--subprocess', action='store_true', default=False,
+                        help='run each training in a new python process, instead of a persistent worker')
 
     args, train_args = parser.parse_known_args()
+    assert args.num_cpu is None or args.num_cpu >= 1, "Error: --num-cpu cannot be less than 1"
+    assert args.num_workers >= 1, "Error: --num-workers cannot be less than 1"
     args.log_dir = "logs/_{}_search/".format(args.optimizer)
+    # cleanup the trainings of the previous search
+    if os.path.exists(args.log_dir):
+        shutil.rmtree(args.log_dir)
 
     train_args.extend(['--srl-model', args.srl_model, '--seed', str(args.seed), '--algo', args.algo, '--env', args.env,
-                       '--log-dir', args.log_dir, '--no-vis'])
+                       '--no-vis'])
 
     # verify the algorithm has defined it, and that it returnes an expected value
     try:
@@ -265,9 +540,10 @@ def main():
 
     if args.optimizer == "hyperband":
         opt = Hyperband(opt_param, makeRlTrainingFunction(args, train_args), seed=args.seed,
-                        max_iter=args.num_timesteps // ITERATION_SCALE)
+                        max_iter=args.num_timesteps // ITERATION_SCALE, num_workers=args.num_workers)
     elif args.optimizer == "hyperopt":
-        opt = Hyperopt(opt_param, makeRlTrainingFunction(args, train_args), seed=args.seed, num_eval=args.max_eval)
+        opt = Hyperopt(opt_param, makeRlTrainingFunction(args, train_args), seed=args.seed, num_eval=args.max_eval,
+                       num_workers=args.num_workers)
     else:
         raise ValueError("Error: optimizer {} was defined but not implemented, Halting.".format(args.optimizer))
 
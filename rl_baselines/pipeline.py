@@ -9,6 +9,7 @@ import yaml
 import numpy as np
 
 from rl_baselines.registry import registered_rl
+from rl_baselines.trial_runner import TrialWorkerPool
 from environments.registry import registered_env
 from state_representation.registry import registered_srl
 from state_representation import SRLType
@@ -36,6 +37,8 @@ def main():
                         help='initial seed for each unique combination of environment and srl-model.')
     parser.add_argument('--srl-config-file', type=str, default="config/srl_models.yaml",
                         help='Set the location of the SRL model path configuration.')
+    parser.add_argument('--subprocess', action='store_true', default=False,
+                        help='run each training in a new python process, instead of a persistent worker')
 
     # returns the parsed arguments, and the rest are assumed to be arguments for rl_baselines.train
     args, train_args = parser.parse_known_args()
@@ -116,6 +119,25 @@ def main():
     print("environments:\t{}".format(envs))
     print("verbose:\t{}".format(args.verbose))
     print("timesteps:\t{}".format(args.num_timesteps))
+    # a persistent worker keeps the training code imported (and the SRL models loaded) between the trainings
+    pool = None if args.subprocess else TrialWorkerPool(1, stdout=stdout)
+    try:
+        runBenchmarks(args, train_args, srl_models, envs, seeds, stdout, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def runBenchmarks(args, train_args, srl_models, envs, seeds, stdout, pool):
+    """
+    :param args: (ArgumentParser) the pipeline arguments
+    :param train_args: ([str]) the arguments for rl_baselines.train
+    :param srl_models: ([str])
+    :param envs: ([str])
+    :param seeds: ([int])
+    :param stdout: (file) output of the trainings, None for the terminal
+    :param pool: (TrialWorkerPool) None to run each training in a new process
+    """
     for model in srl_models:
         for env in envs:
             for i in range(args.num_iteration):
@@ -127,7 +149,11 @@ def main():
                 loop_args = ['--srl-model', model, '--seed', str(seeds[i]), '--algo', args.algo, '--env', env,
                              '--num-timesteps', str(int(args.num_timesteps)), '--srl-config-file', args.srl_config_file]
 
-                ok = subprocess.call(['python', '-m', 'rl_baselines.train'] + train_args + loop_args, stdout=stdout)
+                if pool is not None:
+                    ok = pool.start(0, train_args + loop_args).wait()
+                else:
+                    ok = subprocess.call(['python', '-m', 'rl_baselines.train'] + train_args + loop_args,
+                                         stdout=stdout)
 
                 if ok != 0:
                     # throw the error down to the terminal
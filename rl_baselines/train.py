@@ -97,6 +97,10 @@ def configureEnvAndLogFolder(args, env_kwargs, all_models):
             # Path depending on whether to load the latest model or not
             srl_model_path = models['log_folder'] + path
             env_kwargs["srl_model_path"] = srl_model_path
+        # Batched inference of the SRL model (shared between the environments)
+        env_kwargs["srl_batch_size"] = args.srl_batch_size
+        env_kwargs["srl_batch_timeout"] = args.srl_batch_timeout
+        env_kwargs["srl_shared_memory"] = args.srl_shared_memory
 
     # Add date + current time
     args.log_dir += "{}/{}/".format(ALGO_NAME, datetime.now().strftime("%y-%m-%d_%Hh%M_%S"))
@@ -169,10 +173,21 @@ def callback(_locals, _globals):
     return True
 
 
-def main():
+def main(argv=None):
+    """
+    :param argv: ([str]) the arguments of the training, None for the command line arguments
+        (a persistent trial worker runs several trainings in the same process, see rl_baselines/trial_runner.py)
+    """
     # Global variables for callback
     global ENV_NAME, ALGO, ALGO_NAME, LOG_INTERVAL, VISDOM_PORT, viz
     global SAVE_INTERVAL, EPISODE_WINDOW, MIN_EPISODES_BEFORE_SAVE
+    global win, win_smooth, win_episodes, n_steps, params_saved, best_mean_reward
+    # State of the callback, left by the previous training of the process
+    viz = None
+    n_steps = 0
+    params_saved = False
+    best_mean_reward = -10000
+    win, win_smooth, win_episodes = None, None, None
     parser = argparse.ArgumentParser(description="Train script for RL algorithms")
     parser.add_argument('--algo', default='ppo2', choices=list(registered_rl.keys()), help='RL algo to use',
                         type=str)
@@ -200,6 +215,15 @@ def main():
                         help='Set the button to a random position')
     parser.add_argument('--srl-config-file', type=str, default="config/srl_models.yaml",
                         help='Set the location of the SRL model path configuration.')
+    parser.add_argument('--srl-batch-size', type=int, default=None,
+                        help='Max number of observations processed at once by the SRL model (default: num-cpu)')
+    parser.add_argument('--srl-batch-timeout', type=float, default=0.005,
+                        help='Max time (in s) the SRL model waits for other envs before processing a batch')
+    parser.add_argument('--srl-shared-memory', action='store_true', default=False,
+                        help='Send the observations to the SRL model through shared memory instead of pipes')
+    parser.add_argument('--batched-env', action='store_true', default=False,
+                        help='Simulate all the environments in a single process, as one batch '
+                             '(OmniRobot simulator only)')
     parser.add_argument('--hyperparam', type=str, nargs='+', default=[])
     parser.add_argument('--min-episodes-save', type=int, default=100,
                         help="Min number of episodes before saving best model")
@@ -209,7 +233,7 @@ def main():
                         help="load the trained RL model, should be with the same algorithm type")
     
     # Ignore unknown args for now
-    args, unknown = parser.parse_known_args()
+    args, unknown = parser.parse_known_args(argv)
     env_kwargs = {}
 
     # LOAD SRL models list
@@ -223,6 +247,10 @@ def main():
     assert args.num_timesteps >= 1, "Error: --num-timesteps cannot be less than 1"
     assert args.num_stack >= 1, "Error: --num-stack cannot be less than 1"
     assert args.action_repeat >= 1, "Error: --action-repeat cannot be less than 1"
+    assert args.srl_batch_size is None or args.srl_batch_size >= 1, "Error: --srl-batch-size cannot be less than 1"
+    assert args.srl_batch_timeout >= 0, "Error: --srl-batch-timeout cannot be negative"
+    assert not args.batched_env or args.env == "OmnirobotEnv-v0", \
+        "Error: --batched-env is only available for the OmniRobot simulator (OmnirobotEnv-v0)"
     assert 0 <= args.port < 65535, "Error: invalid visdom port number {}, ".format(args.port) + \
                                    "port number must be an unsigned 16bit number [0,65535]."
     assert registered_srl[args.srl_model][0] == SRLType.ENVIRONMENT or args.env in all_models, \
@@ -268,13 +296,15 @@ def main():
     env_kwargs["action_repeat"] = args.action_repeat
     # Random init position for button
     env_kwargs["random_target"] = args.random_target
+    # Step all the environments in the same process (see environments/omnirobot_gym/omnirobot_vec_env.py)
+    env_kwargs["batched_env"] = args.batched_env
     # Allow up action
     # env_kwargs["force_down"] = False
 
     # allow multi-view
     env_kwargs['multi_view'] = args.srl_model == "multi_view_srl"
     parser = algo.customArguments(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     args, env_kwargs = configureEnvAndLogFolder(args, env_kwargs, all_models)
     args_dict = filterJSONSerializableObjects(vars(args))
@@ -0,0 +1,205 @@
+"""
+Persistent trial workers: a worker process imports the training code (tensorflow, pytorch, stable-baselines, ...)
+once, then runs the trainings it receives one after the other (rl_baselines.train.main), with a fresh tensorflow graph
+each time, instead of a new python process per training.
+The SRL model of the trainings is also kept loaded in the worker (see SRL_MODEL_CACHE in rl_baselines/utils.py).
+
+The trainings of a worker are not isolated from each other (global state of the libraries, memory leaks, ...):
+the hyperparameter search and the pipeline can still run each training in a new process (--subprocess).
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import traceback
+from multiprocessing.connection import Connection
+
+# Time (in s) given to a worker to exit when closing the pool
+CLOSE_TIMEOUT = 30
+
+
+class Trial(object):
+    """
+    A training running in a worker, with the interface of subprocess.Popen used by the callers
+    (wait() and pid: it can be stopped with os.killpg(trial.pid, ...), the worker has its own process group)
+    :param worker: (TrialWorker)
+    :param args: ([str]) the arguments of the training
+    """
+
+    def __init__(self, worker, args):
+        self.worker = worker
+        self.args = args
+        self.pid = worker.process.pid
+        self.returncode = None
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: (float) in s, None to wait until the end of the training
+        :return: (int) 0 if the training succeeded, its exit code or the one of the worker otherwise
+        """
+        if self.returncode is not None:
+            return self.returncode
+        if not self.worker.conn.poll(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        try:
+            self.returncode = self.worker.conn.recv()
+        except (EOFError, ConnectionResetError):
+            # the worker died (or was stopped) during the training
+            self.returncode = self.worker.process.wait()
+        return self.returncode
+
+
+class TrialWorker(object):
+    """
+    A persistent worker process, communicating through a socket pair
+    :param stdout: (file) output of the trainings, None for the terminal
+    :param env: (dict) environment variables of the worker, None for the ones of the current process
+    :param cores: ([int]) the cores the worker is pinned to, None to not pin it
+    """
+
+    def __init__(self, stdout=None, env=None, cores=None):
+        if cores is not None:
+            preexec_fn = lambda: os.sched_setaffinity(0, cores)
+        else:
+            preexec_fn = None
+        conn, worker_conn = socket.socketpair()
+        # in its own process group, so it can be stopped with the processes of its environments
+        self.process = subprocess.Popen(['python', '-m', 'rl_baselines.trial_runner',
+                                         '--conn-fd', str(worker_conn.fileno())],
+                                        stdout=stdout, env=env, preexec_fn=preexec_fn, start_new_session=True,
+                                        pass_fds=(worker_conn.fileno(),))
+        worker_conn.close()
+        self.conn = Connection(conn.detach())
+
+    def alive(self):
+        """
+        :return: (bool) False if the worker exited (e.g. stopped with its training)
+        """
+        return self.process.poll() is None
+
+    def start(self, args):
+        """
+        :param args: ([str]) the arguments of rl_baselines.train
+        :return: (Trial)
+        """
+        self.conn.send(args)
+        return Trial(self, args)
+
+    def close(self):
+        if self.alive():
+            try:
+                self.conn.send(None)
+                self.process.wait(timeout=CLOSE_TIMEOUT)
+            except (BrokenPipeError, subprocess.TimeoutExpired):
+                # with the processes of the environments of its training
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        self.conn.close()
+
+
+class TrialWorkerPool(object):
+    """
+    A fixed number of persistent workers, started at once so they import the training code in parallel.
+    A worker which exited (e.g. stopped by the early stopping) is replaced when a training is started on it.
+    :param num_workers: (int)
+    :param stdout: (file) output of the trainings, None for the terminal
+    :param env: (dict) environment variables of the workers, None for the ones of the current process
+    :param cores: ([[int]]) the cores each worker is pinned to (None: not pinned), None to not pin any worker
+    """
+
+    def __init__(self, num_workers, stdout=None, env=None, cores=None):
+        assert cores is None or len(cores) == num_workers, "Error: the cores of each worker must be given"
+        self.stdout = stdout
+        self.env = env
+        self.cores = cores
+        self.workers = [self._startWorker(idx) for idx in range(num_workers)]
+
+    def _startWorker(self, idx):
+        """
+        :param idx: (int)
+        :return: (TrialWorker)
+        """
+        return TrialWorker(stdout=self.stdout, env=self.env, cores=None if self.cores is None else self.cores[idx])
+
+    def start(self, idx, args):
+        """
+        Start a training on a worker. The worker must not be running an other training.
+        :param idx: (int) index of the worker
+        :param args: ([str]) the arguments of rl_baselines.train
+        :return: (Trial)
+        """
+        if not self.workers[idx].alive():
+            self.workers[idx].close()
+            self.workers[idx] = self._startWorker(idx)
+        return self.workers[idx].start(args)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def runTrial(args):
+    """
+    Run a training in the current process
+    :param args: ([str]) the arguments of rl_baselines.train
+    :return: (int) the exit code of the training
+    """
+    # imported by the worker only (loaded once by main()), not by the processes starting the workers
+    import tensorflow as tf
+    from rl_baselines import train
+
+    returncode = 0
+    tf.reset_default_graph()
+    try:
+        train.main(args)
+    except SystemExit as e:
+        # argparse errors and sys.exit() of the training
+        if e.code is not None:
+            returncode = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        returncode = 1
+        traceback.print_exc()
+    finally:
+        # the environments and SRL model processes of the training (not always closed by the algorithms)
+        for child in multiprocessing.active_children():
+            child.terminate()
+            child.join()
+        # release the model, its graph and its session
+        train.ALGO = None
+        tf.reset_default_graph()
+        gc.collect()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent worker running the trainings it receives")
+    parser.add_argument('--conn-fd', type=int, required=True,
+                        help='file descriptor of the socket connected to the pool')
+    args = parser.parse_args()
+
+    # the training code is imported once, before the first training
+    import rl_baselines.train
+    import rl_baselines.utils
+
+    conn = Connection(args.conn_fd)
+    rl_baselines.utils.SRL_MODEL_CACHE = {}
+    while True:
+        try:
+            train_args = conn.recv()
+        except EOFError:
+            break
+        # None is sent when the pool is closed
+        if train_args is None:
+            break
+        conn.send(runTrial(train_args))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
+import ctypes
+import queue
+import time
 from collections import OrderedDict
 from multiprocessing import Queue, Process
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 import tensorflow as tf
@@ -12,6 +16,13 @@ from rl_baselines.visualize import loadCsv
 from srl_zoo.utils import printYellow, printGreen
 from state_representation.models import loadSRLModel, getSRLDim
 
+# Max time (in s) the SRL model process waits for other environments before processing a batch
+SRL_BATCH_TIMEOUT = 0.005
+# SRL model kept loaded between the trainings of a persistent trial worker (see rl_baselines/trial_runner.py),
+# the SRL model process of a training inherits the weights instead of loading them. None: no cache.
+# key: path of the SRL model, only the last loaded model is kept
+SRL_MODEL_CACHE = None
+
 
 def createTensorflowSession():
     """
@@ -159,36 +170,124 @@ class WrapFrameStack(VecFrameStack):
     load_running_average = loadRunningAverage
 
 
+class SharedMemoryObservationQueue(object):
+    """
+    Drop-in replacement for the input Queue of the SRL model (see MultiprocessSRLModel):
+    each env writes its observation in place into its own preallocated shared-memory slot,
+    only the env rank and the shape of the observation go through the queue.
+    The slot of an env is not overwritten before the SRL model has answered,
+    because the env waits for its state before sending a new observation.
+    :param num_cpu: (int) the number of environments that will spawn
+    :param max_obs_size: (int) the maximum number of elements of an observation (uint8 image)
+    """
+
+    def __init__(self, num_cpu, max_obs_size):
+        self.max_obs_size = max_obs_size
+        self.slots = [RawArray(ctypes.c_uint8, max_obs_size) for _ in range(num_cpu)]
+        self.index_queue = Queue()
+
+    def _slotView(self, env_id, shape):
+        """
+        :param env_id: (int)
+        :param shape: (tuple)
+        :return: (numpy uint8 array) view on the shared-memory slot (no copy)
+        """
+        return np.frombuffer(self.slots[env_id], dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+
+    def put(self, item):
+        """
+        :param item: ((int, numpy array)) env rank and observation
+        """
+        env_id, observation = item
+        observation = np.asarray(observation)
+        assert observation.size <= self.max_obs_size, \
+            "Error: observation of shape {} does not fit in the shared memory slot".format(observation.shape)
+        np.copyto(self._slotView(env_id, observation.shape), observation, casting='unsafe')
+        self.index_queue.put((env_id, observation.shape))
+
+    def get(self, block=True, timeout=None):
+        """
+        :param block: (bool)
+        :param timeout: (float)
+        :return: ((int, numpy array)) env rank and a view on its observation
+        """
+        env_id, shape = self.index_queue.get(block, timeout)
+        return env_id, self._slotView(env_id, shape)
+
+
 class MultiprocessSRLModel:
     """
-    Allows multiple environments to use a single SRL model
+    Allows multiple environments to use a single SRL model.
+    The pending requests of all the environments are gathered
+    and processed in batch (one forward pass per batch)
     :param num_cpu: (int) the number of environments that will spawn
     :param env_id: (str) the environment id string
-    :param env_kwargs: (dict)
+    :param env_kwargs: (dict) "srl_batch_size" (max number of observations per batch, default: num_cpu)
+        and "srl_batch_timeout" (max time in s to wait for the batch to be filled) can be set in it.
+        If "srl_shared_memory" is True, the observations are sent through shared memory instead of being pickled
     """
 
     def __init__(self, num_cpu, env_id, env_kwargs):
+        module_env, class_name, _ = dynamicEnvLoad(env_id)
+        if env_kwargs.get("srl_shared_memory", False):
+            n_channels = 6 if env_kwargs.get("multi_view", False) else 3
+            input_queue = SharedMemoryObservationQueue(num_cpu,
+                                                       module_env.RENDER_HEIGHT * module_env.RENDER_WIDTH * n_channels)
+        else:
+            input_queue = Queue()
         # Create a duplex pipe between env and srl model, where all the inputs are unified and the origin
         # marked with a index number
-        self.pipe = (Queue(), [Queue() for _ in range(num_cpu)])
-        module_env, class_name, _ = dynamicEnvLoad(env_id)
+        self.pipe = (input_queue, [Queue() for _ in range(num_cpu)])
         # we need to know the expected dim output of the SRL model, before it is created
         self.state_dim = getSRLDim(env_kwargs.get("srl_model_path", None), module_env.__dict__[class_name])
+        # Each env waits for its state before sending a new observation,
+        # so there cannot be more than num_cpu pending requests
+        self.max_batch_size = min(env_kwargs.get("srl_batch_size", None) or num_cpu, num_cpu)
+        self.batch_timeout = env_kwargs.get("srl_batch_timeout", SRL_BATCH_TIMEOUT)
+        assert self.max_batch_size >= 1, "Error: srl_batch_size cannot be less than 1"
+        assert self.batch_timeout >= 0, "Error: srl_batch_timeout cannot be negative"
+        self.model = None
+        # the cached model is inherited by the forked process (not possible once cuda is initialised)
+        if SRL_MODEL_CACHE is not None and not th.cuda.is_available():
+            srl_model_path = env_kwargs.get("srl_model_path", None)
+            if srl_model_path not in SRL_MODEL_CACHE:
+                # e.g. a pipeline over several SRL models does not keep all of them loaded
+                SRL_MODEL_CACHE.clear()
+                SRL_MODEL_CACHE[srl_model_path] = loadSRLModel(srl_model_path, False, self.state_dim, env_object=None)
+            self.model = SRL_MODEL_CACHE[srl_model_path]
         self.p = Process(target=self._run, args=(env_kwargs,))
         self.p.daemon = True
         self.p.start()
 
+    def _getBatch(self):
+        """
+        Wait for a first request, then gather the other pending ones
+        until the batch is full or the timeout is reached
+        :return: ([(int, numpy array)]) list of (env_id, observation)
+        """
+        requests = [self.pipe[0].get()]
+        deadline = time.time() + self.batch_timeout
+        while len(requests) < self.max_batch_size:
+            try:
+                requests.append(self.pipe[0].get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return requests
+
     def _run(self, env_kwargs):
         # this is to control the number of CPUs that torch is allowed to use.
         # By default it will use all CPUs, even with GPU acceleration
         th.set_num_threads(1)
-        self.model = loadSRLModel(env_kwargs.get("srl_model_path", None), th.cuda.is_available(), self.state_dim,
-                                  env_object=None)
+        if self.model is None:
+            self.model = loadSRLModel(env_kwargs.get("srl_model_path", None), th.cuda.is_available(),
+                                      self.state_dim, env_object=None)
         # run until the end of the caller thread
         while True:
-            # pop an item, get state, and return to sender.
-            env_id, var = self.pipe[0].get()
-            self.pipe[1][env_id].put(self.model.getState(var, env_id=env_id))
+            # pop a batch of items, get states, and return them to their senders.
+            env_ids, observations = zip(*self._getBatch())
+            states = self.model.getStates(np.stack(observations), env_ids=list(env_ids))
+            for env_id, state in zip(env_ids, states):
+                self.pipe[1][env_id].put(state)
 
 
 def createEnvs(args, allow_early_resets=False, env_kwargs=None, load_path_normalise=None):
@@ -210,14 +309,21 @@ def createEnvs(args, allow_early_resets=False, env_kwargs=None, load_path_normal
         srl_model = MultiprocessSRLModel(args.num_cpu, args.env, env_kwargs)
         env_kwargs["state_dim"] = srl_model.state_dim
         env_kwargs["srl_pipe"] = srl_model.pipe
-    envs = [makeEnv(args.env, args.seed, i, args.log_dir, allow_early_resets=allow_early_resets, env_kwargs=env_kwargs)
-            for i in range(args.num_cpu)]
-
-    if len(envs) == 1:
-        # No need for subprocesses when having only one env
-        envs = DummyVecEnv(envs)
+    if env_kwargs is not None and env_kwargs.get("batched_env", False):
+        # imported here, it requires the OmniRobot simulator
+        from environments.omnirobot_gym.omnirobot_vec_env import OmniRobotSimulatorVecEnv
+        envs = OmniRobotSimulatorVecEnv(args.num_cpu, seed=args.seed, log_dir=args.log_dir,
+                                        allow_early_resets=allow_early_resets, **env_kwargs)
     else:
-        envs = SubprocVecEnv(envs)
+        envs = [makeEnv(args.env, args.seed, i, args.log_dir, allow_early_resets=allow_early_resets,
+                        env_kwargs=env_kwargs)
+                for i in range(args.num_cpu)]
+
+        if len(envs) == 1:
+            # No need for subprocesses when having only one env
+            envs = DummyVecEnv(envs)
+        else:
+            envs = SubprocVecEnv(envs)
 
     envs = VecFrameStack(envs, args.num_stack)
 
@@ -249,3 +355,15 @@ def softmax(x):
     """
     e_x = np.exp(x.T - np.max(x.T, axis=0))
     return (e_x / e_x.sum(axis=0)).T
+
+
+def sampleActions(probas):
+    """
+    Sample one action per row of probabilities, without any loop over the rows (inverse transform sampling)
+    :param probas: (numpy float) of shape (n_samples, n_actions)
+    :return: (numpy int) of shape (n_samples,)
+    """
+    cumulative = np.cumsum(probas, axis=1)
+    # scale by the total, so the rounding errors of the sum cannot select an action out of range
+    uniform = np.random.rand(len(probas), 1) * cumulative[:, -1:]
+    return np.argmax(uniform < cumulative, axis=1)
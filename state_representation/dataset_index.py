@@ -0,0 +1,184 @@
+"""
+Integrity index of a dataset: a small json file (dataset_index.json) recording the length of the arrays,
+the number of frames of each episode, the size and hash of the npz files
+and the number of files and bytes of each record folder.
+A dataset is then validated by checking the index against the filesystem (a directory listing per record),
+without loading the frames.
+
+Usage: python -m state_representation.dataset_index --validate srl_zoo/data/dataset_1 srl_zoo/data/dataset_2
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from srl_zoo.utils import printGreen, printRed
+from state_representation.dataset_utils import episodeIndex, episodeLengths
+
+INDEX_FILE = "dataset_index.json"
+# Files hashed in the index, the other files of the dataset (e.g. packed frames) are only checked by size
+HASHED_FILES = ["preprocessed_data.npz", "ground_truth.npz", "dataset_config.json", "env_globals.json"]
+SIZED_FILES = ["frames.npy", "frames_index.npz", "dataset_manifest.json"]
+
+
+def fileHash(path):
+    """
+    :param path: (str)
+    :return: (str) sha1 of the content of the file
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def scanRecord(record_path):
+    """
+    :param record_path: (str) path to a record folder
+    :return: ((int, int)) number of files and number of bytes of the folder, None if it does not exist
+    """
+    try:
+        entries = [entry for entry in os.scandir(record_path) if entry.is_file()]
+    except FileNotFoundError:
+        return None
+    return len(entries), sum(entry.stat().st_size for entry in entries)
+
+
+def recordFolders(images_path):
+    """
+    :param images_path: (numpy array) images paths of a dataset, relative to the data folder
+    :return: ([str]) the record folders containing the frames, relative to the data folder
+    """
+    return sorted({path.rsplit("/", 1)[0] for path in images_path})
+
+
+def writeDatasetIndex(data_folder, n_workers=8):
+    """
+    Build the integrity index of a dataset, from its current content
+    :param data_folder: (str) path to the dataset folder
+    :param n_workers: (int) number of threads listing the record folders
+    :return: (dict) the index
+    """
+    data_folder = os.path.normpath(data_folder)
+    data_root = os.path.dirname(data_folder)
+    preprocessed_data = np.load(data_folder + "/preprocessed_data.npz")
+    ground_truth = np.load(data_folder + "/ground_truth.npz")
+
+    records = recordFolders(ground_truth["images_path"])
+    with ThreadPoolExecutor(n_workers) as executor:
+        records_content = list(executor.map(scanRecord, [os.path.join(data_root, record) for record in records]))
+    missing = [record for record, content in zip(records, records_content) if content is None]
+    assert len(missing) == 0, "Error: missing record folders {}".format(missing)
+
+    index = {
+        "arrays": {name: {arr: len(load[arr]) for arr in load.files}
+                   for name, load in [("preprocessed_data.npz", preprocessed_data), ("ground_truth.npz", ground_truth)]},
+        "episode_lengths": episodeLengths(episodeIndex(preprocessed_data["episode_starts"])).tolist(),
+        "files": {},
+        "records": {record: {"n_files": n_files, "size": size} for record, (n_files, size) in zip(records,
+                                                                                                 records_content)}
+    }
+    for name in HASHED_FILES + SIZED_FILES:
+        path = os.path.join(data_folder, name)
+        if os.path.isfile(path):
+            index["files"][name] = {"size": os.path.getsize(path)}
+            if name in HASHED_FILES:
+                index["files"][name]["sha1"] = fileHash(path)
+
+    with open(os.path.join(data_folder, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def validateDataset(data_folder, executor):
+    """
+    Check a dataset against its integrity index
+    :param data_folder: (str) path to the dataset folder
+    :param executor: (ThreadPoolExecutor) used to list the record folders in parallel
+    :return: ([str]) the errors found, empty if the dataset is valid
+    """
+    data_folder = os.path.normpath(data_folder)
+    data_root = os.path.dirname(data_folder)
+    index_path = os.path.join(data_folder, INDEX_FILE)
+    if not os.path.isfile(index_path):
+        return ["no integrity index ({})".format(INDEX_FILE)]
+    with open(index_path) as f:
+        index = json.load(f)
+
+    errors = []
+    for name, expected in index["files"].items():
+        path = os.path.join(data_folder, name)
+        if not os.path.isfile(path):
+            errors.append("missing file {}".format(name))
+        elif os.path.getsize(path) != expected["size"]:
+            errors.append("{}: size {} != {}".format(name, os.path.getsize(path), expected["size"]))
+        elif "sha1" in expected and fileHash(path) != expected["sha1"]:
+            errors.append("{}: the content changed".format(name))
+
+    # Consistency of the index itself: one entry per step, one target position per episode
+    n_steps = sum(index["episode_lengths"])
+    for name, arrays in index["arrays"].items():
+        for arr, length in arrays.items():
+            expected_length = len(index["episode_lengths"]) if arr == "target_positions" else n_steps
+            if length != expected_length:
+                errors.append("{}['{}']: length {} != {}".format(name, arr, length, expected_length))
+
+    records = sorted(index["records"].keys())
+    for record, content in zip(records, executor.map(scanRecord, [os.path.join(data_root, record)
+                                                                  for record in records])):
+        expected = index["records"][record]
+        if content is None:
+            errors.append("missing record folder {}".format(record))
+        elif content != (expected["n_files"], expected["size"]):
+            errors.append("{}: {} files, {} bytes != {} files, {} bytes".format(
+                record, content[0], content[1], expected["n_files"], expected["size"]))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or check the integrity index of datasets')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--build', type=str, nargs='+', metavar='dataset', default=argparse.SUPPRESS,
+                       help='Build the index of the datasets, from their current content')
+    group.add_argument('--validate', type=str, nargs='+', metavar='dataset', default=argparse.SUPPRESS,
+                       help='Check the datasets against their index')
+    parser.add_argument('--num-workers', type=int, default=16,
+                        help='number of threads checking the files (the work is I/O bound)')
+    args = parser.parse_args()
+    assert args.num_workers > 0, "Error: number of workers must be positive and non zero"
+
+    if 'build' in args:
+        for data_folder in args.build:
+            writeDatasetIndex(data_folder, args.num_workers)
+            printGreen("Index written for {}".format(data_folder))
+        return
+
+    start_time = time.time()
+    n_invalid = 0
+    with ThreadPoolExecutor(args.num_workers) as executor:
+        # the datasets are checked in parallel, each one also lists its records in parallel
+        with ThreadPoolExecutor(len(args.validate)) as datasets_executor:
+            results = list(datasets_executor.map(lambda data_folder: validateDataset(data_folder, executor),
+                                                 args.validate))
+    for data_folder, errors in zip(args.validate, results):
+        if len(errors) == 0:
+            printGreen("{}: OK".format(data_folder))
+        else:
+            n_invalid += 1
+            printRed("{}: {} error(s)".format(data_folder, len(errors)))
+            for error in errors:
+                print("  " + error)
+    print("Checked {} dataset(s) in {:.2f}s".format(len(args.validate), time.time() - start_time))
+    if n_invalid > 0:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Per-episode operations on the datasets written by the EpisodeSaver.
+The episode of each frame (episode_index) is computed once from episode_starts with a cumulative sum,
+then the per-episode operations are broadcasted or reduced over it, without any loop over the frames.
+"""
+import numpy as np
+
+
+def episodeIndex(episode_starts):
+    """
+    :param episode_starts: (numpy bool array) True at the first frame of each episode
+    :return: (numpy int array) index of the episode of each frame
+    """
+    episode_starts = np.asarray(episode_starts, dtype=bool)
+    assert len(episode_starts) == 0 or episode_starts[0], "Error: the first frame must start an episode"
+    return np.cumsum(episode_starts) - 1
+
+
+def episodeLengths(episode_index):
+    """
+    :param episode_index: (numpy int array) see episodeIndex()
+    :return: (numpy int array) number of frames of each episode
+    """
+    return np.bincount(episode_index)
+
+
+def relativePositions(ground_truth_states, target_positions, episode_index):
+    """
+    :param ground_truth_states: (numpy array) positions in the world frame, one per frame
+    :param target_positions: (numpy array) position of the target, one per episode
+    :param episode_index: (numpy int array) see episodeIndex()
+    :return: (numpy array) positions relative to the target of their episode
+    """
+    return ground_truth_states - target_positions[episode_index]
+
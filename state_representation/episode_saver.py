@@ -1,19 +1,154 @@
+import argparse
+import atexit
+import glob
 import os
 import json
+import queue
+import shutil
+import threading
 import time
 
 import cv2
 import numpy as np
 
-from srl_zoo.utils import printYellow
+from srl_zoo.utils import printGreen, printYellow
 from rl_baselines.utils import filterJSONSerializableObjects
 from state_representation.client import SRLClient
+from state_representation.dataset_index import writeDatasetIndex
+from state_representation.dataset_utils import episodeIndex
+
+
+CHUNKS_FOLDER = "chunks"
+PREPROCESSED_DATA_KEYS = ['rewards', 'actions', 'episode_starts']
+GROUND_TRUTH_KEYS = ['target_positions', 'ground_truth_states', 'images_path']
+
+
+def loadChunks(chunks_folder):
+    """
+    Concatenate the chunks saved by an EpisodeSaver
+    :param chunks_folder: (str)
+    :return: (dict, dict) the content of preprocessed_data.npz and ground_truth.npz
+    """
+    chunks = sorted(glob.glob("{}/chunk_[0-9]*.npz".format(chunks_folder)))
+    assert len(chunks) > 0, "Error: no chunk found in {}".format(chunks_folder)
+    arrays = {key: [] for key in PREPROCESSED_DATA_KEYS + GROUND_TRUTH_KEYS}
+    for chunk in chunks:
+        chunk_data = np.load(chunk)
+        for key in arrays:
+            arrays[key].append(chunk_data[key])
+    arrays = {key: np.concatenate(values) for key, values in arrays.items()}
+    assert episodeIndex(arrays['episode_starts'])[-1] + 1 == len(arrays['target_positions']), \
+        "Error: the number of target positions does not match the number of episodes"
+    return ({key: arrays[key] for key in PREPROCESSED_DATA_KEYS},
+            {key: arrays[key] for key in GROUND_TRUTH_KEYS})
+
+
+def finalizeDataset(data_folder, remove_chunks=False):
+    """
+    Merge the chunks of a dataset into preprocessed_data.npz and ground_truth.npz, and write its index
+    :param data_folder: (str)
+    :param remove_chunks: (bool) remove the chunks once merged
+    """
+    chunks_folder = "{}/{}".format(data_folder, CHUNKS_FOLDER)
+    data, ground_truth = loadChunks(chunks_folder)
+    print("Saving preprocessed data...")
+    np.savez('{}/preprocessed_data.npz'.format(data_folder), **data)
+    np.savez('{}/ground_truth.npz'.format(data_folder), **ground_truth)
+    writeDatasetIndex(data_folder)
+    if remove_chunks:
+        shutil.rmtree(chunks_folder)
+
+
+def writeImage(image_path, observation):
+    """
+    Encode a BGR observation and write it to disk as JPEG
+    (one file per camera in the case of dual/multi-camera)
+    :param image_path: (str) path of the frame, without extension
+    :param observation: (numpy matrix) BGR image
+    """
+    if observation.shape[2] > 3:
+        observation1 = cv2.cvtColor(observation[:, :, :3], cv2.COLOR_BGR2RGB)
+        observation2 = cv2.cvtColor(observation[:, :, 3:], cv2.COLOR_BGR2RGB)
+
+        cv2.imwrite("{}_1.jpg".format(image_path), observation1)
+        cv2.imwrite("{}_2.jpg".format(image_path), observation2)
+    else:
+        observation = cv2.cvtColor(observation, cv2.COLOR_BGR2RGB)
+        cv2.imwrite("{}.jpg".format(image_path), observation)
+
+
+class ImageWriter(object):
+    """
+    Encode and write the frames in background threads, so the JPEG encoding is not done in env.step().
+    The frames are passed through a bounded queue: when the disk cannot keep up,
+    write() blocks until a slot is free (backpressure) instead of accumulating frames in memory.
+    OpenCV releases the GIL while encoding, so the threads run alongside the simulation.
+    :param n_threads: (int) number of writer threads
+    :param max_pending: (int) maximum number of frames waiting to be written
+    """
+
+    def __init__(self, n_threads=1, max_pending=64):
+        assert n_threads > 0, "Error: the number of writer threads must be positive"
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.threads = []
+        for _ in range(n_threads):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                writeImage(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, image_path, observation):
+        """
+        :param image_path: (str) path of the frame, without extension
+        :param observation: (numpy matrix) BGR image, it is copied so the caller can reuse its buffer
+        """
+        self._checkError()
+        self.queue.put((image_path, np.array(observation, copy=True)))
+
+    def flush(self):
+        """
+        Wait until all the pending frames are written to disk
+        """
+        self.queue.join()
+        self._checkError()
+
+    def close(self):
+        """
+        Write the pending frames and stop the threads
+        """
+        if len(self.threads) == 0:
+            return
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._checkError()
+
+    def _checkError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
 
 
 class EpisodeSaver(object):
     """
     Save the experience data from a gym env to a file
-    and notify the srl server so it learns from the gathered data
+    and notify the srl server so it learns from the gathered data.
+    The data of each episode is appended to the dataset as a chunk (see save()),
+    the legacy preprocessed_data.npz and ground_truth.npz files are written by finalize().
     :param name: (str)
     :param max_dist: (float)
     :param state_dim: (int)
@@ -22,10 +157,12 @@ class EpisodeSaver(object):
     :param learn_states: (bool)
     :param path: (str)
     :param relative_pos: (bool)
+    :param n_writers: (int) number of threads writing the images in background, 0 to write them in env.step()
+    :param max_pending_frames: (int) maximum number of frames waiting to be written
     """
 
     def __init__(self, name, max_dist, state_dim=-1, globals_=None, learn_every=3, learn_states=False,
-                 path='data/', relative_pos=False):
+                 path='data/', relative_pos=False, n_writers=1, max_pending_frames=64):
         super(EpisodeSaver, self).__init__()
         self.name = name
         self.data_folder = path + name
@@ -52,6 +189,19 @@ class EpisodeSaver(object):
         self.srl_model_path = ""
         self.n_steps = 0
         self.max_steps = 10000
+        self.chunks_folder = "{}/{}".format(self.data_folder, CHUNKS_FOLDER)
+        self.n_chunks = 0
+        self.n_episodes = 0
+        self.n_saved_targets = 0
+        self.closed = False
+        # The chunks of an interrupted run are the only copy of its data: they are not removed silently
+        assert len(glob.glob("{}/chunk_[0-9]*.npz".format(self.chunks_folder))) == 0, \
+            "Error: {} contains the chunks of an interrupted run, recover them with " \
+            "'python -m state_representation.episode_saver --finalize {}' or remove the folder" \
+            .format(self.chunks_folder, self.data_folder)
+        # Partially written chunks (see save())
+        shutil.rmtree(self.chunks_folder, ignore_errors=True)
+        os.makedirs(self.chunks_folder)
 
         self.dataset_config = {'relative_pos': relative_pos, 'max_dist': str(max_dist)}
         with open("{}/dataset_config.json".format(self.data_folder), "w") as f:
@@ -62,6 +212,12 @@ class EpisodeSaver(object):
             with open("{}/env_globals.json".format(self.data_folder), "w") as f:
                 json.dump(filterJSONSerializableObjects(globals_), f)
 
+        self.image_writer = None
+        if n_writers > 0:
+            self.image_writer = ImageWriter(n_writers, max_pending_frames)
+        # Do not lose the last episodes if the env is not closed explicitly
+        atexit.register(self.close)
+
         if self.learn_states:
             self.socket_client = SRLClient(self.name)
             self.socket_client.waitForServer()
@@ -74,16 +230,48 @@ class EpisodeSaver(object):
         image_path = "{}/{}/frame{:06d}".format(self.data_folder, self.episode_folder, self.episode_step)
         relative_path = "{}/{}/frame{:06d}".format(self.name, self.episode_folder, self.episode_step)
         self.images_path.append(relative_path)
-        # in the case of dual/multi-camera
-        if observation.shape[2] > 3:
-            observation1 = cv2.cvtColor(observation[:, :, :3], cv2.COLOR_BGR2RGB)
-            observation2 = cv2.cvtColor(observation[:, :, 3:], cv2.COLOR_BGR2RGB)
-
-            cv2.imwrite("{}_1.jpg".format(image_path), observation1)
-            cv2.imwrite("{}_2.jpg".format(image_path), observation2)
+        if self.image_writer is not None:
+            self.image_writer.write(image_path, observation)
         else:
-            observation = cv2.cvtColor(observation, cv2.COLOR_BGR2RGB)
-            cv2.imwrite("{}.jpg".format(image_path), observation)
+            writeImage(image_path, observation)
+
+    def flush(self):
+        """
+        Wait until all the images are written to disk
+        """
+        if self.image_writer is not None:
+            self.image_writer.flush()
+
+    def close(self):
+        """
+        Write the pending images, stop the writer threads
+        and merge the saved chunks into the legacy npz files
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.image_writer is not None:
+            self.image_writer.close()
+        self.finalize(remove_chunks=True)
+
+    def finalize(self, remove_chunks=False):
+        """
+        Merge the chunks written by save() into preprocessed_data.npz and ground_truth.npz
+        :param remove_chunks: (bool) remove the chunks once merged (no more data can be saved afterward)
+        """
+        if self.n_chunks == 0:
+            return
+        finalizeDataset(self.data_folder, remove_chunks=remove_chunks)
+
+    def setEpisodeIndex(self, episode_idx):
+        """
+        Set the index of the next episode, and so its record folder (record_XXX).
+        Used when several processes write the episodes of the same dataset.
+        :param episode_idx: (int)
+        """
+        assert len(self.episode_starts) == 0 or self.episode_starts[-1] is False, \
+            "Error: the episode index must be set before resetting the environment"
+        self.episode_idx = episode_idx - 1
 
     def reset(self, observation, target_pos, ground_truth):
         """
@@ -94,10 +282,13 @@ class EpisodeSaver(object):
         """
         if len(self.episode_starts) == 0 or self.episode_starts[-1] is False:
             self.episode_idx += 1
+            self.n_episodes += 1
 
             if self.learn_states and (self.episode_idx + 1) % self.learn_every == 0 and self.n_steps <= self.max_steps:
                 print("Learning a state representation ...")
                 start_time = time.time()
+                # The SRL server reads the legacy npz files
+                self.finalize()
                 ok, self.srl_model_path = self.socket_client.waitForSRLModel(self.state_dim)
                 print("Took {:.2f}s".format(time.time() - start_time))
 
@@ -137,14 +328,15 @@ class EpisodeSaver(object):
     
     def save(self):
         """
-        Write data and ground truth to disk
+        Write the data and ground truth gathered since the last call to a new chunk,
+        then clear them from memory: the cost of a call does not depend on the size of the dataset
         """
         # Sanity checks
         assert len(self.actions) == len(self.rewards)
         assert len(self.actions) == len(self.episode_starts)
         assert len(self.actions) == len(self.images_path)
         assert len(self.actions) == len(self.ground_truth_states)
-        assert len(self.target_positions) == self.episode_idx + 1
+        assert self.n_saved_targets + len(self.target_positions) == self.n_episodes
 
         data = {
             'rewards': np.array(self.rewards),
@@ -157,9 +349,18 @@ class EpisodeSaver(object):
             'ground_truth_states': np.array(self.ground_truth_states),
             'images_path': np.array(self.images_path)
         }
-        print("Saving preprocessed data...")
-        np.savez('{}/preprocessed_data.npz'.format(self.data_folder), **data)
-        np.savez('{}/ground_truth.npz'.format(self.data_folder), **ground_truth)
+        # The images listed in the chunk must be on disk
+        self.flush()
+        # Written under a temporary name, so a killed process does not leave a truncated chunk
+        chunk_path = '{}/chunk_{:06d}.npz'.format(self.chunks_folder, self.n_chunks)
+        with open(chunk_path + '.tmp', 'wb') as f:
+            np.savez(f, **data, **ground_truth)
+        os.rename(chunk_path + '.tmp', chunk_path)
+        self.n_chunks += 1
+        self.n_saved_targets += len(self.target_positions)
+
+        self.rewards, self.actions, self.episode_starts = [], [], []
+        self.target_positions, self.ground_truth_states, self.images_path = [], [], []
 
 
 class LogRLStates(object):
@@ -232,3 +433,19 @@ class LogRLStates(object):
                  **{'states': data['states'], 'rewards': data['rewards']})
         np.savez('{}/normalized_states_rewards.npz'.format(self.log_folder),
                  **{'states': data['normalized_states'], 'rewards': data['rewards']})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recover the datasets of an interrupted run of the EpisodeSaver")
+    parser.add_argument('--finalize', type=str, nargs='+', metavar='DATA_FOLDER', required=True,
+                        help='Merge the chunks of the datasets (e.g. left by a killed dataset generator) '
+                             'into their npz files')
+    args = parser.parse_args()
+
+    for data_folder in args.finalize:
+        finalizeDataset(data_folder.rstrip("/"), remove_chunks=True)
+        printGreen("{}: dataset finalized".format(data_folder))
+
+
+if __name__ == '__main__':
+    main()
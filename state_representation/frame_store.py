@@ -0,0 +1,146 @@
+"""
+Packed frame store: all the images of a dataset in a single uint8 array of shape (n_frames, height, width, n_channels),
+saved in the .npy format so it can be memory-mapped.
+Loading a minibatch is then a read from the page cache instead of one file open and JPEG decoding per frame.
+
+The packed dataset is opt-in and lives next to the original files:
+    <dataset>/frames.npy: the frames, in the order of ground_truth.npz['images_path'] (row i = step i)
+    <dataset>/frames_index.npz: 'images_path', the path of each row
+
+Usage: python -m state_representation.frame_store --data-folder srl_zoo/data/kuka_button
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from srl_zoo.utils import printGreen
+
+FRAMES_FILE = "frames.npy"
+INDEX_FILE = "frames_index.npz"
+
+
+def readFrame(data_root, image_path):
+    """
+    Read a frame of a dataset written by the EpisodeSaver
+    (the cameras of multi-view datasets are stacked along the channel axis)
+    :param data_root: (str) folder containing the dataset folder
+    :param image_path: (str) path of the frame, relative to data_root and without extension
+    :return: (numpy array) the image, as returned by cv2.imread()
+    """
+    path = os.path.join(data_root, image_path)
+    if os.path.isfile(path + ".jpg"):
+        views = [path + ".jpg"]
+    else:
+        views = ["{}_{}.jpg".format(path, i) for i in (1, 2)]
+    images = [cv2.imread(view) for view in views]
+    for view, image in zip(views, images):
+        assert image is not None, "Error: cannot read the frame {}".format(view)
+    return images[0] if len(images) == 1 else np.dstack(images)
+
+
+def packFrames(data_folder):
+    """
+    Convert the one-JPEG-per-frame layout of a dataset to a packed frame store.
+    The frames are decoded and written one by one, the memory usage does not depend on the size of the dataset.
+    :param data_folder: (str) path to the dataset folder (containing ground_truth.npz)
+    :return: (FrameStore)
+    """
+    data_folder = os.path.normpath(data_folder)
+    data_root = os.path.dirname(data_folder)
+    images_path = np.load(os.path.join(data_folder, "ground_truth.npz"))['images_path']
+    assert len(images_path) > 0, "Error: the dataset {} is empty".format(data_folder)
+
+    first_frame = readFrame(data_root, images_path[0])
+    frames = np.lib.format.open_memmap(os.path.join(data_folder, FRAMES_FILE), mode='w+', dtype=np.uint8,
+                                       shape=(len(images_path),) + first_frame.shape)
+    frames[0] = first_frame
+    for idx in range(1, len(images_path)):
+        frame = readFrame(data_root, images_path[idx])
+        assert frame.shape == first_frame.shape, \
+            "Error: all the frames must have the same shape, {} != {}".format(frame.shape, first_frame.shape)
+        frames[idx] = frame
+    frames.flush()
+    del frames
+
+    np.savez(os.path.join(data_folder, INDEX_FILE), images_path=images_path)
+    return FrameStore(data_folder)
+
+
+def hasFrameStore(data_folder):
+    """
+    :param data_folder: (str)
+    :return: (bool) whether the dataset was converted to a packed frame store
+    """
+    return all(os.path.isfile(os.path.join(data_folder, name)) for name in [FRAMES_FILE, INDEX_FILE])
+
+
+class FrameStore(object):
+    """
+    Read-only access to a packed frame store (see packFrames()).
+    The frames are memory-mapped: integer and slice indexing return views without any copy,
+    the pages of the file are loaded by the OS when they are first accessed.
+    :param data_folder: (str) path to the dataset folder
+    """
+
+    def __init__(self, data_folder):
+        assert hasFrameStore(data_folder), \
+            "Error: no frame store in {}, convert the dataset with packFrames() first".format(data_folder)
+        self.frames = np.load(os.path.join(data_folder, FRAMES_FILE), mmap_mode='r')
+        self.images_path = np.load(os.path.join(data_folder, INDEX_FILE))['images_path']
+        assert len(self.frames) == len(self.images_path), "Error: the frame store index does not match the frames"
+        self._rows = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        """
+        :param idx: (int, slice or array of int) step(s) of the dataset
+        :return: (numpy array) a view for int and slices (a copy for arrays of indices)
+        """
+        return self.frames[idx]
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    def getFrame(self, image_path):
+        """
+        :param image_path: (str) path of the frame, as stored in ground_truth.npz['images_path']
+        :return: (numpy array) view of the frame
+        """
+        if self._rows is None:
+            self._rows = {path: row for row, path in enumerate(self.images_path)}
+        return self.frames[self._rows[image_path]]
+
+    def getBatch(self, indices):
+        """
+        Gather a minibatch of frames, reading the file in increasing order
+        :param indices: ([int] or numpy array) steps of the dataset
+        :return: (numpy array) uint8 array of shape (len(indices), height, width, n_channels)
+        """
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind='mergesort')
+        batch = np.empty((len(indices),) + self.frames.shape[1:], dtype=np.uint8)
+        batch[order] = self.frames[indices[order]]
+        return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the frames of a dataset in a memory-mappable array')
+    parser.add_argument('--data-folder', type=str, required=True,
+                        help='Dataset folder (containing ground_truth.npz), e.g. srl_zoo/data/kuka_button')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    store = packFrames(args.data_folder)
+    printGreen("Packed {} frames of shape {} in {:.2f}s".format(len(store), store.shape[1:], time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -137,6 +137,20 @@ class SRLBaseClass(object):
         """
         raise NotImplementedError("getState() not implemented")
 
+    def getStates(self, observations, env_ids=None):
+        """
+        Predict the states for a batch of observations
+        (by default, it calls getState() on each observation)
+
+        :param observations: (numpy Number) the input observations, stacked along the first axis
+        :param env_ids: ([int]) the environment IDs associated to each observation (default: all 0)
+        :return: (numpy Number)
+        """
+        if env_ids is None:
+            env_ids = [0] * len(observations)
+        return np.array([self.getState(observation, env_id=env_id)
+                         for observation, env_id in zip(observations, env_ids)])
+
 
 class SRLNeuralNetwork(SRLBaseClass):
     """SRL using a neural network as a state representation model"""
@@ -176,21 +190,25 @@ class SRLNeuralNetwork(SRLBaseClass):
         self.model.load_state_dict(th.load(path))
 
     def getState(self, observation, env_id=0):
+        return self.getStates(observation[None], env_ids=[env_id])[0]
+
+    def getStates(self, observations, env_ids=None):
         if getNChannels() > 3:
-            observation = np.dstack((preprocessImage(observation[:, :, :3], convert_to_rgb=False),
-                                     preprocessImage(observation[:, :, 3:], convert_to_rgb=False)))
+            observations = [np.dstack((preprocessImage(observation[:, :, :3], convert_to_rgb=False),
+                                       preprocessImage(observation[:, :, 3:], convert_to_rgb=False)))
+                            for observation in observations]
         else:
-            observation = preprocessImage(observation, convert_to_rgb=False)
+            observations = [preprocessImage(observation, convert_to_rgb=False) for observation in observations]
 
         # Create 4D Tensor
-        observation = observation.reshape(1, *observation.shape)
+        observations = np.stack(observations)
         # Channel first
-        observation = np.transpose(observation, (0, 3, 2, 1))
-        observation = th.from_numpy(observation).float().to(self.device)
+        observations = np.transpose(observations, (0, 3, 2, 1))
+        observations = th.from_numpy(observations).float().to(self.device)
 
         with th.no_grad():
-            state = self.model.getStates(observation)[0]
-        return state.to(th.device("cpu")).detach().numpy()
+            states = self.model.getStates(observations)
+        return states.to(th.device("cpu")).detach().numpy()
 
 
 class SRLPCA(SRLBaseClass):
@@ -215,3 +233,7 @@ class SRLPCA(SRLBaseClass):
         # Convert to a 1D array
         observation = observation.reshape(-1, n_features)
         return self.model.transform(observation)[0]
+
+    def getStates(self, observations, env_ids=None):
+        n_features = np.prod(observations.shape[1:])
+        return self.model.transform(observations.reshape(-1, n_features))
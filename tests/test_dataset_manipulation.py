@@ -1,13 +1,23 @@
+import glob
+import signal
 import subprocess
 import pytest
 import os
 import shutil
+import time
+
+import cv2
+import numpy as np
+
+from state_representation.frame_store import FrameStore
 
 DATA_FOLDER_NAME_1 = "kuka_test_f1"
 DATA_FOLDER_NAME_2 = "kuka_test_f2"
 DATA_FOLDER_NAME_3 = "kuka_test_f3"
 DEFAULT_ENV = "KukaButtonGymEnv-v0"
 PATH_SRL = "srl_zoo/data/"
+# Time (in s) given to the dataset generator to save its first episodes
+CHUNK_TIMEOUT = 300
 
 
 def assertEq(left, right):
@@ -41,3 +51,159 @@ def testDataGenForFusion():
 
     # Removing fusionned test dataset
     shutil.rmtree(PATH_SRL + DATA_FOLDER_NAME_3)
+
+
+@pytest.mark.fast
+def testVirtualFusion():
+    for name in [DATA_FOLDER_NAME_1, DATA_FOLDER_NAME_2]:
+        args = ['--num-cpu', 4, '--num-episode', 8, '--name', name, '--force', '--env', DEFAULT_ENV]
+        args = list(map(str, args))
+
+        ok = subprocess.call(['python', '-m', 'environments.dataset_generator'] + args)
+        assertEq(ok, 0)
+
+    args = ['--virtual-merge', PATH_SRL + DATA_FOLDER_NAME_1, PATH_SRL + DATA_FOLDER_NAME_2,
+            PATH_SRL + DATA_FOLDER_NAME_3]
+    ok = subprocess.call(['python', '-m', 'environments.dataset_fusioner'] + args)
+    assertEq(ok, 0)
+
+    # The sources are kept, the destination only references their frames
+    assert os.path.isdir(PATH_SRL + DATA_FOLDER_NAME_1)
+    assert os.path.isdir(PATH_SRL + DATA_FOLDER_NAME_2)
+    assert os.path.isfile(PATH_SRL + DATA_FOLDER_NAME_3 + "/dataset_manifest.json")
+
+    ok = subprocess.call(['python', '-m', 'environments.dataset_fusioner', '--materialize',
+                          PATH_SRL + DATA_FOLDER_NAME_3])
+    assertEq(ok, 0)
+    assert not os.path.isfile(PATH_SRL + DATA_FOLDER_NAME_3 + "/dataset_manifest.json")
+    assertEq(len([name for name in os.listdir(PATH_SRL + DATA_FOLDER_NAME_3) if name.startswith("record_")]), 16)
+
+    for name in [DATA_FOLDER_NAME_1, DATA_FOLDER_NAME_2, DATA_FOLDER_NAME_3]:
+        shutil.rmtree(PATH_SRL + name)
+
+
+@pytest.mark.fast
+def testDatasetValidation():
+    args = ['--num-cpu', 2, '--num-episode', 4, '--name', DATA_FOLDER_NAME_1, '--force', '--env', DEFAULT_ENV]
+    args = list(map(str, args))
+    ok = subprocess.call(['python', '-m', 'environments.dataset_generator'] + args)
+    assertEq(ok, 0)
+
+    validate_args = ['python', '-m', 'state_representation.dataset_index', '--validate', PATH_SRL + DATA_FOLDER_NAME_1]
+    ok = subprocess.call(validate_args)
+    assertEq(ok, 0)
+
+    # A missing frame must be detected
+    os.remove(PATH_SRL + DATA_FOLDER_NAME_1 + "/record_001/frame000000.jpg")
+    ok = subprocess.call(validate_args)
+    assert ok != 0
+
+    shutil.rmtree(PATH_SRL + DATA_FOLDER_NAME_1)
+
+
+@pytest.mark.fast
+def testFinalizeInterruptedDataset():
+    """
+    The episodes saved by a killed dataset generator must be recoverable from its chunks
+    """
+    args = ['--num-cpu', 1, '--num-episode', 100, '--name', DATA_FOLDER_NAME_1, '--force', '--env', DEFAULT_ENV]
+    args = list(map(str, args))
+    process = subprocess.Popen(['python', '-m', 'environments.dataset_generator'] + args, start_new_session=True)
+    chunks_pattern = PATH_SRL + DATA_FOLDER_NAME_1 + "/chunks/chunk_[0-9]*.npz"
+    try:
+        start_time = time.time()
+        while len(glob.glob(chunks_pattern)) < 2 and time.time() - start_time < CHUNK_TIMEOUT:
+            assert process.poll() is None, "Error: the dataset generator exited before being killed"
+            time.sleep(0.5)
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    n_chunks = len(glob.glob(chunks_pattern))
+    assert n_chunks >= 2, "Error: no episode saved after {}s".format(CHUNK_TIMEOUT)
+
+    ok = subprocess.call(['python', '-m', 'state_representation.episode_saver',
+                          '--finalize', PATH_SRL + DATA_FOLDER_NAME_1])
+    assertEq(ok, 0)
+    assert not os.path.exists(PATH_SRL + DATA_FOLDER_NAME_1 + "/chunks")
+    assert np.load(PATH_SRL + DATA_FOLDER_NAME_1 + "/preprocessed_data.npz")['episode_starts'].sum() >= n_chunks
+
+    ok = subprocess.call(['python', '-m', 'state_representation.dataset_index', '--validate',
+                          PATH_SRL + DATA_FOLDER_NAME_1])
+    assertEq(ok, 0)
+
+    shutil.rmtree(PATH_SRL + DATA_FOLDER_NAME_1)
+
+
+@pytest.mark.fast
+def testEnvsPerCpu():
+    """
+    Several environments stepped by the same process must generate the same dataset as one environment per process
+    (with a random target per episode: a fixed target is sampled once by each environment)
+    """
+    datasets = {}
+    for envs_per_cpu, name in [(1, DATA_FOLDER_NAME_1), (2, DATA_FOLDER_NAME_2)]:
+        args = ['--num-cpu', 1, '--envs-per-cpu', envs_per_cpu, '--num-episode', 4, '--name', name, '--force',
+                '--env', 'OmnirobotEnv-v0', '--random-target']
+        args = list(map(str, args))
+        ok = subprocess.call(['python', '-m', 'environments.dataset_generator'] + args)
+        assertEq(ok, 0)
+        datasets[envs_per_cpu] = dict(np.load(PATH_SRL + name + "/ground_truth.npz"))
+        datasets[envs_per_cpu].update(np.load(PATH_SRL + name + "/preprocessed_data.npz"))
+
+    assertEq(sorted(datasets[1].keys()), sorted(datasets[2].keys()))
+    for key in datasets[1].keys():
+        if key == 'images_path':
+            # relative to the dataset folder
+            for data in datasets.values():
+                data[key] = np.array([path.split("/", 1)[1] for path in data[key]])
+        assert np.array_equal(datasets[1][key], datasets[2][key]), "{} differs".format(key)
+
+    # The PyBullet environments share the client of their process, they cannot be stepped together
+    args = ['--num-cpu', 1, '--envs-per-cpu', 2, '--num-episode', 4, '--name', DATA_FOLDER_NAME_3, '--force',
+            '--env', DEFAULT_ENV]
+    args = list(map(str, args))
+    ok = subprocess.call(['python', '-m', 'environments.dataset_generator'] + args)
+    assert ok != 0
+
+    for name in [DATA_FOLDER_NAME_1, DATA_FOLDER_NAME_2]:
+        shutil.rmtree(PATH_SRL + name)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("multi_view", [False, True])
+def testFrameStore(multi_view):
+    """
+    The packed frames must match the JPEG images of the dataset
+    :param multi_view: (bool) two cameras per frame, stacked along the channel axis
+    """
+    args = ['--num-cpu', 1, '--num-episode', 2, '--name', DATA_FOLDER_NAME_1, '--force', '--env', DEFAULT_ENV]
+    if multi_view:
+        args.append('--multi-view')
+    args = list(map(str, args))
+    ok = subprocess.call(['python', '-m', 'environments.dataset_generator'] + args)
+    assertEq(ok, 0)
+
+    ok = subprocess.call(['python', '-m', 'state_representation.frame_store',
+                          '--data-folder', PATH_SRL + DATA_FOLDER_NAME_1])
+    assertEq(ok, 0)
+
+    images_path = np.load(PATH_SRL + DATA_FOLDER_NAME_1 + "/ground_truth.npz")['images_path']
+    if multi_view:
+        images = [np.dstack([cv2.imread("{}{}_{}.jpg".format(PATH_SRL, path, i)) for i in (1, 2)])
+                  for path in images_path]
+    else:
+        images = [cv2.imread(PATH_SRL + path + ".jpg") for path in images_path]
+    images = np.array(images)
+    assertEq(images.shape[-1], 6 if multi_view else 3)
+
+    store = FrameStore(PATH_SRL + DATA_FOLDER_NAME_1)
+    assertEq(store.shape, images.shape)
+    for idx, path in enumerate(images_path):
+        assert np.array_equal(store.getFrame(path), images[idx])
+        assert np.array_equal(store[idx], images[idx])
+    assert np.array_equal(store[2:10:3], images[2:10:3])
+    # unsorted, with duplicates
+    indices = [7, 1, 7, 0, len(images) - 1, 3]
+    assert np.array_equal(store.getBatch(indices), images[indices])
+
+    shutil.rmtree(PATH_SRL + DATA_FOLDER_NAME_1)
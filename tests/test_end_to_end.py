@@ -3,6 +3,8 @@ from __future__ import print_function, division, absolute_import
 import subprocess
 import os
 import json
+import shutil
+import socket
 from collections import OrderedDict
 
 import pytest
@@ -26,6 +28,7 @@ TRAINING_SET_SIZE = 2000
 KNN_SAMPLES = 1000
 
 SEED = 0
+DISTRIBUTED_TIMEOUT = 600  # max duration (in s) of the distributed training
 
 
 def buildTestConfig():
@@ -203,3 +206,53 @@ def testAllSrlonRLTrain(algo):
 
     ok = subprocess.call(['python', '-m', 'rl_baselines.pipeline'] + args)
     assertEq(ok, 0)
+
+
+@pytest.mark.parametrize("algo", ['ars', 'cma-es'])
+def testAsyncESRollouts(algo):
+    """
+    Testing the asynchronous rollouts of the evolution strategies
+    :param algo: (str) RL algorithm name
+    """
+    args = ['--algo', algo, '--env', DEFAULT_ENV, '--srl-model', DEFAULT_SRL,
+            '--num-timesteps', NUM_TIMESTEP, '--seed', SEED, '--num-iteration', NUM_ITERATION,
+            '--no-vis', '--srl-config-file', DEFAULT_SRL_CONFIG_YAML, '--async-rollouts']
+    args = list(map(str, args))
+
+    ok = subprocess.call(['python', '-m', 'rl_baselines.pipeline'] + args)
+    assertEq(ok, 0)
+
+
+def testDistributedARS():
+    """
+    Testing the distributed ARS, with a master and two workers on the same machine
+    """
+    # a free port of the machine
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+    args = ['--algo', 'ars', '--env', DEFAULT_ENV, '--srl-model', DEFAULT_SRL, '--algo-type', 'v1',
+            '--num-timesteps', NUM_TIMESTEP, '--no-vis', '--srl-config-file', DEFAULT_SRL_CONFIG_YAML,
+            '--noise-table-size', int(1e6)]
+    args = list(map(str, args))
+
+    processes = []
+    try:
+        master = subprocess.Popen(['python', '-m', 'rl_baselines.train', '--log-dir', 'logs/test_distributed/master/',
+                                   '--master-port', str(port), '--seed', str(SEED)] + args)
+        processes.append(master)
+        workers = [subprocess.Popen(['python', '-m', 'rl_baselines.train',
+                                     '--log-dir', 'logs/test_distributed/worker_{}/'.format(i),
+                                     '--master-address', 'tcp://localhost:{}'.format(port), '--num-population', '2',
+                                     '--seed', str(SEED + i + 1)] + args)
+                   for i in range(2)]
+        processes.extend(workers)
+        assertEq(master.wait(timeout=DISTRIBUTED_TIMEOUT), 0)
+        for worker in workers:
+            assertEq(worker.wait(timeout=DISTRIBUTED_TIMEOUT), 0)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        shutil.rmtree('logs/test_distributed', ignore_errors=True)
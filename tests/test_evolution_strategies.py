@@ -0,0 +1,133 @@
+from __future__ import print_function, division, absolute_import
+
+import argparse
+import warnings
+
+import cma
+import numpy as np
+import pytest
+import torch.nn as nn
+from gym import spaces
+
+from rl_baselines.evolution_strategies.cma_es import CMAESModel
+
+NUM_POPULATION = 4
+NUM_TIMESTEP = 400
+OBS_DIM = 5
+N_ACTIONS = 3
+
+
+class DummyVecEnv(object):
+    """
+    A deterministic VecEnv, with episodes of different lengths,
+    the environments are reset when they are done (like the SubprocVecEnv)
+    :param num_envs: (int)
+    :param episode_length: (int) length of all the episodes, None for episodes of different lengths
+    """
+
+    def __init__(self, num_envs, episode_length=None):
+        self.num_envs = num_envs
+        self.episode_length = episode_length
+        self.observation_space = spaces.Box(low=-1, high=1, shape=(OBS_DIM,), dtype=np.float32)
+        self.action_space = spaces.Discrete(N_ACTIONS)
+        self.t = np.zeros(num_envs, dtype=int)
+        self.state = np.zeros(num_envs)
+        self.n_episodes = np.zeros(num_envs, dtype=int)
+
+    def observations(self):
+        return np.sin(np.arange(OBS_DIM)[None] * (1 + self.state[:, None]) + self.t[:, None])
+
+    def reset(self):
+        self.t[:] = 0
+        self.state[:] = 0
+        return self.observations()
+
+    def step(self, actions):
+        rewards, dones = np.zeros(self.num_envs), np.full((self.num_envs,), False)
+        for idx, action in enumerate(actions):
+            if action is None:
+                continue
+            self.state[idx] += 0.1 * action
+            self.t[idx] += 1
+            rewards[idx] = np.cos(self.state[idx])
+            episode_length = self.episode_length
+            if episode_length is None:
+                episode_length = 3 + (idx + self.n_episodes[idx]) % 5
+            if self.t[idx] >= episode_length:
+                dones[idx] = True
+                self.n_episodes[idx] += 1
+                self.t[idx], self.state[idx] = 0, 0
+        return self.observations(), rewards, dones, [{} for _ in range(self.num_envs)]
+
+    def close(self):
+        pass
+
+
+class DummyEnvCMAESModel(CMAESModel):
+    """
+    CMA-ES trained on a DummyVecEnv
+    """
+
+    @classmethod
+    def makeEnv(cls, args, env_kwargs=None, load_path_normalise=None):
+        return DummyVecEnv(args.num_cpu, getattr(args, "episode_length", None))
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("async_rollouts", [False, True])
+def testCMAESSavedModel(tmpdir, async_rollouts):
+    """
+    The network of the saved CMA-ES model must hold the best parameters found by the training
+    :param async_rollouts: (bool)
+    """
+    args = argparse.Namespace(num_population=NUM_POPULATION, mu=0, sigma=0.14, cuda=False, deterministic=True,
+                              async_rollouts=async_rollouts, continuous_actions=False, srl_model="ground_truth",
+                              num_timesteps=NUM_TIMESTEP)
+    model = DummyEnvCMAESModel()
+    model.train(args, None, env_kwargs={}, train_kwargs={})
+
+    save_path = str(tmpdir.join("cma-es_model.pkl"))
+    model.save(save_path)
+    loaded_model = CMAESModel.load(save_path)
+    params = nn.utils.parameters_to_vector(loaded_model.policy.model.parameters()).detach().numpy()
+    assert np.abs(loaded_model.best_model).max() > 0, "Error: the training did not update the best parameters"
+    assert np.allclose(params, loaded_model.best_model, atol=1e-6), "Error: the saved model is not the best model"
+
+    obs = DummyVecEnv(1).reset()
+    assert np.array_equal(loaded_model.getAction(obs), model.getAction(obs))
+
+
+@pytest.mark.fast
+def testCMAESAsyncGenerations(monkeypatch):
+    """
+    With the asynchronous rollouts, each update of the distribution must be told candidates sampled from it:
+    with episodes of the same length, the candidates of ask()
+    """
+    asked, told = [], []
+    ask, tell = cma.CMAEvolutionStrategy.ask, cma.CMAEvolutionStrategy.tell
+
+    def spyAsk(es, number=None, *args, **kwargs):
+        solutions = ask(es, number, *args, **kwargs)
+        if number is None:
+            asked.append([np.array(solution) for solution in solutions])
+        return solutions
+
+    def spyTell(es, solutions, *args, **kwargs):
+        told.append([np.array(solution) for solution in solutions])
+        return tell(es, solutions, *args, **kwargs)
+
+    monkeypatch.setattr(cma.CMAEvolutionStrategy, "ask", spyAsk)
+    monkeypatch.setattr(cma.CMAEvolutionStrategy, "tell", spyTell)
+
+    args = argparse.Namespace(num_population=NUM_POPULATION, mu=0, sigma=0.14, cuda=False, deterministic=True,
+                              async_rollouts=True, continuous_actions=False, srl_model="ground_truth",
+                              num_timesteps=NUM_TIMESTEP, episode_length=5)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", cma.evolution_strategy.InjectionWarning)
+        DummyEnvCMAESModel().train(args, None, env_kwargs={}, train_kwargs={})
+
+    assert len(told) > 1
+    for population, solutions in zip(asked, told):
+        assert len(solutions) == NUM_POPULATION
+        assert all(np.array_equal(a, b) for a, b in zip(population, solutions)), \
+            "Error: the candidates of the generation were not told"
@@ -61,3 +61,50 @@ def testRLHyperparamSearch(algo):
 
     ok = subprocess.call(['python', '-m', 'rl_baselines.hyperparam_search'] + args)
     assertEq(ok, 0)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("optimizer", ['hyperband', 'hyperopt'])
+def testParallelHyperparamSearch(optimizer):
+    """
+    test for the given hyperparam optimizer, with several trainings at the same time
+    :param optimizer: (str) RL algorithm name
+    """
+    args = ['--optimizer', optimizer, '--algo', DEFAULT_ALGO, '--srl-model', DEFAULT_SRL, '--max-eval', MAX_EVAL,
+            '--num-timesteps', NUM_TIMESTEP, '--seed', SEED, '--env', DEFAULT_ENV, "--num-cpu", 2,
+            "--num-workers", 2]
+
+    args = list(map(str, args))
+
+    ok = subprocess.call(['python', '-m', 'rl_baselines.hyperparam_search'] + args)
+    assertEq(ok, 0)
+
+
+@pytest.mark.slow
+def testEarlyStoppingHyperparamSearch():
+    """
+    test the early stopping of the trainings, from their monitor files
+    """
+    args = ['--optimizer', DEFAULT_OPTIMIZER, '--algo', DEFAULT_ALGO, '--srl-model', DEFAULT_SRL,
+            '--num-timesteps', NUM_TIMESTEP, '--seed', SEED, '--env', DEFAULT_ENV, "--num-cpu", 2,
+            "--num-workers", 2, "--early-stopping", "--monitor-interval", 1]
+
+    args = list(map(str, args))
+
+    ok = subprocess.call(['python', '-m', 'rl_baselines.hyperparam_search'] + args)
+    assertEq(ok, 0)
+
+
+@pytest.mark.slow
+def testSubprocessHyperparamSearch():
+    """
+    test the hyperparam search with a new process per training, instead of the persistent workers
+    """
+    args = ['--optimizer', DEFAULT_OPTIMIZER, '--algo', DEFAULT_ALGO, '--srl-model', DEFAULT_SRL,
+            '--num-timesteps', NUM_TIMESTEP, '--seed', SEED, '--env', DEFAULT_ENV, "--num-cpu", 2,
+            "--num-workers", 2, "--subprocess"]
+
+    args = list(map(str, args))
+
+    ok = subprocess.call(['python', '-m', 'rl_baselines.hyperparam_search'] + args)
+    assertEq(ok, 0)
@@ -137,3 +137,20 @@ def testContinousEnvTrain(env, algo):
 
     ok = subprocess.call(['python', '-m', 'rl_baselines.pipeline'] + args)
     assertEq(ok, 0)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("use_subprocess", [False, True])
+def testPipelineTrialRunner(use_subprocess):
+    """
+    test several trainings in the same persistent worker, or in a new process each
+    :param use_subprocess: (bool) run each training in a new process
+    """
+    args = ['--algo', DEFAULT_ALGO, '--env', DEFAULT_ENV, '--srl-model', DEFAULT_SRL, '--num-timesteps', NUM_TIMESTEP,
+            '--seed', SEED, '--num-iteration', 2, '--no-vis', '--num-cpu', 4]
+    if use_subprocess:
+        args.append('--subprocess')
+    args = list(map(str, args))
+
+    ok = subprocess.call(['python', '-m', 'rl_baselines.pipeline'] + args)
+    assertEq(ok, 0)